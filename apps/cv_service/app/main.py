@@ -2,6 +2,7 @@ import os
 from pathlib import Path
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 
 from dotenv import load_dotenv
@@ -41,6 +42,22 @@ app.include_router(assets_router.router)
 # 静态托管 output/ 到 /files
 app.mount("/files", StaticFiles(directory=str(OUTPUT_DIR)), name="files")
 
+# SAM 模型在后台线程加载 + 预热，不阻塞服务启动
+@app.on_event("startup")
+def start_sam_loader():
+    segment.loader.start()
+
 @app.get("/health")
 def health():
-    return {"ok": True, "service": "kids-art-cv-sam", "version": "1.1.0"}
+    """live：进程存活即为 true；ready：SAM 模型已加载并预热，可以处理 /sam/* 请求"""
+    sam = segment.loader.describe()
+    return {"ok": True, "service": "kids-art-cv-sam", "version": "1.1.0",
+            "live": True, "ready": sam["ready"], "sam": sam}
+
+@app.get("/health/ready")
+def health_ready():
+    """就绪探针：模型未就绪时返回 503"""
+    sam = segment.loader.describe()
+    if not sam["ready"]:
+        return JSONResponse(status_code=503, content={"ready": False, "sam": sam}, headers={"Retry-After": "2"})
+    return {"ready": True, "sam": sam}
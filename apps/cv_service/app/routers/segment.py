@@ -1,206 +1,468 @@
-import os, base64
+import os, time
+from functools import partial
 from pathlib import Path
-import numpy as np
-import cv2
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import FileResponse
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
 
 from ..schemas import (
     InitRequest, InitResponse,
     SegmentRequest, SegmentResponse, MaskInfo,
+    SegmentBatchRequest, SegmentBatchResponse, SegmentBatchItem,
+    AutoSegmentRequest, AutoSegmentResponse, AutoMaskInfo,
     ExportROIRequest, ExportROIResponse,
-    BrushRefinementRequest, BrushRefinementResponse,
-    UpdateImageRequest, UpdateImageResponse
+    ExportJobsRequest, ExportJobsResponse, ExportJobStatus, ExportJobsStatusResponse,
+    SplitRequest, SplitResponse,
+    BrushRefinementRequest, BrushRefinementResponse, BrushHistoryRequest,
+    UpdateImageRequest, UpdateImageResponse,
+    SessionStatusResponse
 )
-from ..services.sam_engine import SamEngine
-from ..services.splitter import export_single
-from ..services.postprocess import make_output_path
+from ..services.brush import BrushSample
+from ..services.engine_loader import EngineLoader
+from ..services.errors import EngineNotReady, SessionNotReady, InferenceQueueFull
+from ..services.mask_codec import FORMATS as MASK_FORMATS
+from ..services.export_jobs import ExportJobQueue
+from ..services.splitter import export_roi as export_roi_png, split_and_export
+from ..services.postprocess import decode_mask_png, make_output_path, make_split_dir
 
 router = APIRouter(prefix="/sam", tags=["sam"])
-engine = SamEngine()
+# 模型在应用启动后由后台线程加载（见 main.py 的 startup），加载完成前 SAM 路由返回 503
+loader = EngineLoader()
+# 批量导出任务的线程池（与模型无关，模型加载前也可创建）
+exports = ExportJobQueue()
+
+def _engine():
+    try:
+        return loader.get()
+    except EngineNotReady as e:
+        headers = {"Retry-After": "2"} if e.state != "failed" else None
+        raise HTTPException(status_code=503, detail=str(e), headers=headers)
 
 # ---- 0) 获取当前活动sessions（调试用）----
 @router.get("/sessions")
 def list_sessions():
     """列出当前活动的会话，用于调试"""
+    engine = _engine()
     return {
-        "active_sessions": list(engine.sessions.keys()),
-        "session_count": len(engine.sessions)
+        "active_sessions": engine.list_sessions(),
+        "session_count": len(engine.list_sessions())
     }
 
+@router.get("/stats")
+def stats():
+    """运行时统计：embedding 缓存命中/未命中、模型加载状态等"""
+    if not loader.ready:
+        return {"engine": loader.describe(), "export_jobs": exports.stats()}
+    return {**loader.get().stats(), "engine": loader.describe(), "export_jobs": exports.stats()}
+
 # ---- 1) 初始化会话 ----
 @router.post("/init", response_model=InitResponse)
 def init(req: InitRequest):
+    engine = _engine()
     try:
-        # 如果不保留旧会话，先整体清空，确保新图片不复用旧 predictor 与掩码
+        # 如果不保留旧会话，先整体清空，确保新图片不复用旧 embedding 与掩码
         if not req.keep_session:
             engine.clear_all_sessions()
-        sess = engine.init_session(req.image_path, req.image_b64, req.image_name, req.max_side)
-        return InitResponse(session_id=sess.id, width=sess.w, height=sess.h, image_name=sess.image_name)
+        sess = engine.init_session(req.image_path, req.image_b64, req.image_name, req.max_side, background=req.async_embed)
+        return InitResponse(session_id=sess.id, width=sess.w, height=sess.h, image_name=sess.image_name, status=sess.status,
+                            timings=engine.public_timings(sess))
+    except InferenceQueueFull as e:
+        raise _busy(e)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+async def _read_upload(request: Request):
+    """读取上传图像：multipart/form-data（文件字段 file 或 image）或原始 image/* 请求体。
+    其余参数取自表单字段，缺省时取 query string。返回 (字节, 参数, 读取耗时 ms)。"""
+    t0 = time.perf_counter()
+    ctype = request.headers.get("content-type", "").lower()
+    params = dict(request.query_params)
+    if ctype.startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file") or form.get("image")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="multipart upload requires a 'file' field")
+        data = await upload.read()
+        params.update({k: v for k, v in form.items() if isinstance(v, str)})
+        if not params.get("image_name") and getattr(upload, "filename", None):
+            params["image_name"] = upload.filename
+    elif ctype.startswith("image/") or ctype.startswith("application/octet-stream"):
+        data = await request.body()
+    else:
+        raise HTTPException(status_code=415, detail="Expected image/* body or multipart/form-data upload")
+    if not data:
+        raise HTTPException(status_code=400, detail="Empty image upload")
+    return data, params, round((time.perf_counter() - t0) * 1000, 1)
+
+def _flag(params: dict, name: str, default: bool = False) -> bool:
+    value = params.get(name)
+    return default if value is None else value.lower() in ("1", "true", "yes")
+
+def _int_param(params: dict, name: str) -> Optional[int]:
+    value = params.get(name)
+    if value in (None, ""):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be an integer")
+
+# ---- 1b) 初始化会话（二进制上传）：请求体直接是 JPEG/PNG，或 multipart 文件，省去 base64 膨胀与大 JSON 解析 ----
+@router.post("/init/upload", response_model=InitResponse)
+async def init_upload(request: Request):
+    engine = _engine()
+    data, params, upload_ms = await _read_upload(request)
+    max_side = _int_param(params, "max_side")
+
+    def run():
+        if not _flag(params, "keep_session"):
+            engine.clear_all_sessions()
+        return engine.init_session(None, None, params.get("image_name"), max_side,
+                                   background=_flag(params, "async_embed"), image_bytes=data)
+    try:
+        sess = await run_in_threadpool(run)
+    except InferenceQueueFull as e:
+        raise _busy(e)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return InitResponse(session_id=sess.id, width=sess.w, height=sess.h, image_name=sess.image_name, status=sess.status,
+                        timings={"upload_ms": upload_ms, "upload_bytes": len(data), **engine.public_timings(sess)})
+
+@router.get("/session/{session_id}/status", response_model=SessionStatusResponse)
+def session_status(session_id: str):
+    """查询会话 embedding 状态：pending / ready / failed 及耗时"""
+    engine = _engine()
+    try:
+        return SessionStatusResponse(**engine.session_status(session_id))
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+def _busy(e: InferenceQueueFull) -> HTTPException:
+    # 推理队列已满：429 + Retry-After，前端按提示稍后重试
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+def _not_ready(e: SessionNotReady) -> HTTPException:
+    # pending：409 + Retry-After，前端稍后重试；failed：500，需要重新 /sam/init
+    if e.status == "pending":
+        return HTTPException(status_code=409, detail=str(e), headers={"Retry-After": "1"})
+    return HTTPException(status_code=500, detail=str(e))
+
 @router.post('/update-image', response_model=UpdateImageResponse)
 def update_image(req: UpdateImageRequest):
+    engine = _engine()
     if not req.session_id:
         raise HTTPException(status_code=400, detail='session_id required')
     if not (req.image_path or req.image_b64):
         raise HTTPException(status_code=400, detail='image_path 或 image_b64 至少一个')
     try:
         if req.image_path:
-            sess = engine.update_session_image(req.session_id, req.image_path)
+            sess = engine.update_session_image(req.session_id, req.image_path, force_embed=req.force_embed,
+                                               max_side=req.max_side)
         else:
-            sess = engine.update_session_image_b64(req.session_id, req.image_b64, req.max_side)
+            sess = engine.update_session_image_b64(req.session_id, req.image_b64, req.max_side, force_embed=req.force_embed)
+    except InferenceQueueFull as e:
+        raise _busy(e)
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail='image file not found')
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
-    return UpdateImageResponse(session_id=sess.id, width=sess.w, height=sess.h, image_name=sess.image_name)
+    return UpdateImageResponse(session_id=sess.id, width=sess.w, height=sess.h, image_name=sess.image_name,
+                               embedded=sess.embedded, frame_delta=sess.frame_delta, timings=engine.public_timings(sess))
+
+@router.post('/update-image/upload', response_model=UpdateImageResponse)
+async def update_image_upload(request: Request):
+    """摄像头连拍：二进制/multipart 上传新帧，session_id 等参数放在 query 或表单字段里"""
+    engine = _engine()
+    data, params, upload_ms = await _read_upload(request)
+    session_id = params.get("session_id")
+    if not session_id:
+        raise HTTPException(status_code=400, detail='session_id required')
+    max_side = _int_param(params, "max_side")
+    try:
+        sess = await run_in_threadpool(engine.update_session_image_b64, session_id, None, max_side,
+                                       image_bytes=data, image_name=params.get("image_name"),
+                                       force_embed=_flag(params, "force_embed"))
+    except InferenceQueueFull as e:
+        raise _busy(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return UpdateImageResponse(session_id=sess.id, width=sess.w, height=sess.h, image_name=sess.image_name,
+                               embedded=sess.embedded, frame_delta=sess.frame_delta,
+                               timings={"upload_ms": upload_ms, "upload_bytes": len(data), **engine.public_timings(sess)})
 
 # ---- 2) 针对单个ROI请求候选掩码 ----
 @router.post("/segment", response_model=SegmentResponse)
 def segment(req: SegmentRequest):
+    engine = _engine()
+    if req.mask_format is not None and req.mask_format not in MASK_FORMATS:
+        raise HTTPException(status_code=400, detail=f"mask_format must be one of {MASK_FORMATS}")
     try:
         # 添加session存在性检查和详细错误信息
-        if req.session_id not in engine.sessions:
-            available_sessions = list(engine.sessions.keys())
+        if engine.get_session(req.session_id) is None:
+            available_sessions = engine.list_sessions()
             raise HTTPException(
                 status_code=404, 
                 detail=f"Session not found: {req.session_id}. Available sessions: {available_sessions}. "
                        f"Note: Sessions are lost when server restarts. Please call /sam/init again."
             )
         
-        outs, (w, h) = engine.segment(
-            req.session_id, req.points, req.labels, req.box, req.multimask, req.top_n, req.smooth
+        timings = {}
+        outs, (w, h), zoom_box = engine.segment(
+            req.session_id, req.points, req.labels, req.box, req.multimask, req.top_n, req.smooth,
+            wait_timeout=req.wait_timeout, parent_mask_id=req.parent_mask_id, zoom=req.zoom, timings=timings
         )
-        masks = [MaskInfo(mask_id=Path(p).stem, score=s, path=p) for (p, s) in outs]
-        return SegmentResponse(masks=masks, width=w, height=h)
+        masks = _mask_infos(engine, req.session_id, outs, req.mask_format, req.contours, req.contour_tolerance)
+        return SegmentResponse(masks=masks, width=w, height=h, zoom_box=zoom_box, timings=timings)
     except HTTPException:
         raise  # 重新抛出HTTP异常
+    except SessionNotReady as e:
+        raise _not_ready(e)
+    except InferenceQueueFull as e:
+        raise _busy(e)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _mask_infos(engine, session_id: str, outs, mask_format: Optional[str], contours: bool = False,
+                contour_tolerance: Optional[float] = None):
+    """segment 结果 -> MaskInfo 列表；按请求附带内联编码的掩码和/或轮廓多边形。"""
+    sess = engine.get_session(session_id) if (mask_format or contours) else None
+    infos = []
+    for (m, p, s) in outs:
+        extra = {}
+        if sess is not None and mask_format:
+            extra["inline"] = engine.inline_mask(sess, m, mask_format)
+        if sess is not None and contours:
+            extra["contours"] = engine.mask_contours(sess, m, contour_tolerance)
+        infos.append(MaskInfo(mask_id=m, score=s, path=p, tier=engine.preview.name, **extra))
+    return infos
+
+# ---- 2b) 同一会话多个ROI批量分割（一次解码器调用）----
+@router.post("/segment-batch", response_model=SegmentBatchResponse)
+def segment_batch(req: SegmentBatchRequest):
+    engine = _engine()
+    if engine.get_session(req.session_id) is None:
+        raise HTTPException(status_code=404, detail=f"Session not found: {req.session_id}")
+    if req.mask_format is not None and req.mask_format not in MASK_FORMATS:
+        raise HTTPException(status_code=400, detail=f"mask_format must be one of {MASK_FORMATS}")
+    try:
+        prompts = [(p.points, p.labels, p.box) for p in req.prompts]
+        timings = {}
+        results, (w, h) = engine.segment_batch(
+            req.session_id, prompts, req.multimask, req.top_n, req.smooth, wait_timeout=req.wait_timeout,
+            timings=timings
+        )
+    except SessionNotReady as e:
+        raise _not_ready(e)
+    except InferenceQueueFull as e:
+        raise _busy(e)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
+    items = [SegmentBatchItem(masks=_mask_infos(engine, req.session_id, outs, req.mask_format, req.contours,
+                                                req.contour_tolerance))
+             for outs in results]
+    return SegmentBatchResponse(results=items, width=w, height=h, timings=timings)
+
+# ---- 2c) 整图自动分割：一次返回所有元素候选（结果按图像缓存）----
+@router.post("/auto-segment", response_model=AutoSegmentResponse)
+def auto_segment(req: AutoSegmentRequest):
+    engine = _engine()
+    if engine.get_session(req.session_id) is None:
+        raise HTTPException(status_code=404, detail=f"Session not found: {req.session_id}")
+    t0 = time.perf_counter()
+    try:
+        outs, (w, h), cached = engine.auto_segment(
+            req.session_id, req.points_per_side, req.points_per_batch, req.pred_iou_thresh, req.stability_thresh,
+            req.nms_iou, req.min_area, req.max_area_ratio, req.max_masks, req.smooth, wait_timeout=req.wait_timeout
+        )
+    except SessionNotReady as e:
+        raise _not_ready(e)
+    except InferenceQueueFull as e:
+        raise _busy(e)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    masks = [AutoMaskInfo(mask_id=mid, score=m.score, stability=m.stability, area=m.area, bbox=list(m.bbox),
+                          point=m.point, path=path) for (mid, path, m) in outs]
+    return AutoSegmentResponse(masks=masks, width=w, height=h, cached=cached,
+                               elapsed_ms=round((time.perf_counter() - t0) * 1000, 1))
 
 # ---- 3) 取某个候选掩码的PNG，用于前端预览叠加 ----
 @router.get("/mask/{session_id}/{mask_id}")
 def get_mask_png(session_id: str, mask_id: str):
-    sess = engine.sessions.get(session_id)
+    engine = _engine()
+    sess = engine.get_session(session_id)
     if not sess:
         raise HTTPException(status_code=404, detail="Session not found")
-    target = None
-    for p in sess.tmp_dir.glob(f"{mask_id}*.png"):
-        target = p; break
-    if target is None:
-        cand = sess.tmp_dir / f"{mask_id}.png"
-        if cand.exists(): target = cand
-    if target is None or not target.exists():
+    # PNG 仅在此处按需编码，编码结果缓存在会话的掩码存储里
+    png = engine.get_mask_png(sess, mask_id)
+    if png is None:
         raise HTTPException(status_code=404, detail="Mask not found")
-    return FileResponse(str(target), media_type="image/png")
+    return Response(content=png, media_type="image/png")
+
+# ---- 3b) 列出会话登记的掩码（调试用）----
+@router.get("/masks/{session_id}")
+def list_masks(session_id: str):
+    engine = _engine()
+    sess = engine.get_session(session_id)
+    if not sess:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {"session_id": session_id, "masks": sess.masks.describe()}
 
 # ---- 4) 导出单ROI结果为透明PNG（seg_<stem>_roi_<i>.png）----
 @router.post("/export-roi", response_model=ExportROIResponse)
 def export_roi(req: ExportROIRequest):
-    sess = engine.sessions.get(req.session_id)
+    engine = _engine()
+    sess = engine.get_session(req.session_id)
     if not sess:
         raise HTTPException(status_code=404, detail="Session not found")
-
-    # 最终掩码来源：优先 mask_png_b64（前端笔刷后），否则用候选 mask_id
-    mask01 = None
-    if req.mask_png_b64:
-        b64 = req.mask_png_b64.split(",",1)[1] if "," in req.mask_png_b64 else req.mask_png_b64
-        data = base64.b64decode(b64)
-        arr = np.frombuffer(data, dtype=np.uint8)
-        mk = cv2.imdecode(arr, cv2.IMREAD_UNCHANGED)
-        if mk is None:
-            raise HTTPException(status_code=400, detail="Invalid mask PNG")
-        if mk.ndim == 3 and mk.shape[2] == 4:
-            mask01 = (mk[:, :, 3] > 0).astype(np.uint8)
-        else:
-            if mk.ndim == 3:
-                mk = cv2.cvtColor(mk, cv2.COLOR_BGR2GRAY)
-            mask01 = (mk > 127).astype(np.uint8)
-
-    elif req.mask_id:
-        # 从候选中读取
-        mask_png = None
-        for p in sess.tmp_dir.glob(f"{req.mask_id}*.png"):
-            mask_png = p; break
-        if mask_png is None:
-            cand = sess.tmp_dir / f"{req.mask_id}.png"
-            if cand.exists(): mask_png = cand
-        if mask_png is None or not mask_png.exists():
-            raise HTTPException(status_code=404, detail="Mask not found")
-        mk = cv2.imread(str(mask_png), cv2.IMREAD_GRAYSCALE)
-        mask01 = (mk > 127).astype(np.uint8)
-
-    else:
+    if not req.mask_png_b64 and not req.mask_id:
         raise HTTPException(status_code=400, detail="mask_id or mask_png_b64 required")
+    try:
+        info = _export_item(engine, sess, sess.image_bgr, sess.image_name, req)
+    except InferenceQueueFull as e:
+        raise _busy(e)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return ExportROIResponse(**info)
 
+def _export_item(engine, sess, image_bgr, image_name: str, item, reject: bool = True) -> dict:
+    """导出一项（ExportROIRequest 或 ExportJobItem）：解析最终掩码 -> ROI 裁剪 -> 柔化 -> 写 PNG。
+    掩码来源优先 mask_png_b64（前端笔刷后），否则用候选 mask_id（双档模式下预览候选会在大模型上重新解码）。"""
+    mask01, tier = _item_mask(engine, sess, item, reject)
     # 命名：seg_<stem>_roi_<i>.png
-    out_dir = Path(os.getenv("OUTPUT_DIR", "output"))
-    out_path = Path(make_output_path(sess.image_name, str(out_dir), req.roi_index))
-
-    # 如果提供了ROI坐标，使用ROI区域进行裁剪
-    roi_box = req.roi_box
-    print(f"Debug: roi_box = {roi_box}")
-    print(f"Debug: mask01.shape = {mask01.shape}")
-    print(f"Debug: sess.image_bgr.shape = {sess.image_bgr.shape}")
-    
-    if roi_box:
-        x, y, w, h = roi_box
-        print(f"Debug: ROI coordinates - x={x}, y={y}, w={w}, h={h}")
-        # 确保坐标在图像范围内
-        x = max(0, int(x))
-        y = max(0, int(y))
-        w = min(sess.w - x, int(w))
-        h = min(sess.h - y, int(h))
-        print(f"Debug: Adjusted ROI coordinates - x={x}, y={y}, w={w}, h={h}")
-        
-        # 裁剪图像和mask到ROI区域
-        roi_image = sess.image_bgr[y:y+h, x:x+w]
-        roi_mask = mask01[y:y+h, x:x+w]
-        print(f"Debug: roi_image.shape = {roi_image.shape}")
-        print(f"Debug: roi_mask.shape = {roi_mask.shape}")
-        
-        info = export_single(roi_image, roi_mask, out_path, feather_px=req.feather_px)
-        # 更新返回的坐标信息，加上ROI偏移
-        if "bbox" in info:
-            info["bbox"]["xmin"] += x
-            info["bbox"]["ymin"] += y
-            info["bbox"]["xmax"] += x
-            info["bbox"]["ymax"] += y
-    else:
-        info = export_single(sess.image_bgr, mask01, out_path, feather_px=req.feather_px)
-    return ExportROIResponse(**info)
+    out_path = Path(make_output_path(image_name, os.getenv("OUTPUT_DIR", "output"), item.roi_index))
+    info = export_roi_png(image_bgr, mask01, out_path, item.roi_box, feather_px=item.feather_px)
+    return {**info, "tier": tier}
+
+def _item_mask(engine, sess, item, reject: bool = True):
+    """导出/拆分用的最终掩码 (mask01, tier)：mask_png_b64 优先，否则按 mask_id 解析。"""
+    if item.mask_png_b64:
+        mask01 = decode_mask_png(item.mask_png_b64)
+        if mask01 is None:
+            raise ValueError("Invalid mask PNG")
+        return mask01, None
+    mask01, tier = engine.resolve_export_mask(sess, item.mask_id, reject=reject)
+    if mask01 is None:
+        raise LookupError("Mask not found")
+    return mask01, tier
+
+# ---- 4b) 异步批量导出：立即返回任务ID，导出在线程池中并行执行 ----
+@router.post("/export-jobs", response_model=ExportJobsResponse)
+def submit_export_jobs(req: ExportJobsRequest):
+    engine = _engine()
+    sess = engine.get_session(req.session_id)
+    if not sess:
+        raise HTTPException(status_code=404, detail="Session not found")
+    if not req.items:
+        raise HTTPException(status_code=400, detail="items must not be empty")
+    for i, item in enumerate(req.items):
+        if not item.mask_png_b64 and not item.mask_id:
+            raise HTTPException(status_code=400, detail=f"items[{i}]: mask_id or mask_png_b64 required")
+        if not item.mask_png_b64 and sess.masks.get(item.mask_id) is None:
+            raise HTTPException(status_code=404, detail=f"items[{i}]: Mask not found: {item.mask_id}")
+    # 提交时固定当前画面：任务执行前换图也不会把掩码贴到新画面上（换图后旧的 mask_id 已失效，任务会失败）
+    image_bgr, image_name = sess.image_bgr, sess.image_name
+    tasks = [(item.roi_index, partial(_export_item, engine, sess, image_bgr, image_name, item, False))
+             for item in req.items]
+    try:
+        jobs = exports.submit(sess.id, tasks)
+    except InferenceQueueFull as e:
+        raise _busy(e)
+    return ExportJobsResponse(job_ids=[j.id for j in jobs])
+
+@router.get("/export-jobs/{job_id}", response_model=ExportJobStatus)
+def export_job_status(job_id: str, wait: float = 0):
+    """查询单个导出任务；wait>0 时最多等待 wait 秒（上限 30）直到任务结束。"""
+    return _export_statuses([job_id], wait).jobs[0]
+
+@router.get("/export-jobs", response_model=ExportJobsStatusResponse)
+def export_jobs_status(ids: str, wait: float = 0):
+    """批量查询：ids 为逗号分隔的任务ID；wait 同上，等到全部结束或超时。"""
+    job_ids = [j for j in ids.split(",") if j]
+    if not job_ids:
+        raise HTTPException(status_code=400, detail="ids required")
+    return _export_statuses(job_ids, wait)
+
+def _export_statuses(job_ids, wait: float) -> ExportJobsStatusResponse:
+    jobs = [exports.get(j) for j in job_ids]
+    missing = [j for j, job in zip(job_ids, jobs) if job is None]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Export job not found: {', '.join(missing)}")
+    if wait > 0:
+        exports.wait(jobs, min(wait, 30.0))
+    statuses = [ExportJobStatus(**job.describe()) for job in jobs]
+    return ExportJobsStatusResponse(jobs=statuses, pending=sum(1 for s in statuses if s.status in ("queued", "running")))
+
+# ---- 4c) 把一个掩码按连通域拆成多个元素 sprite，返回清单（同时写 manifest.json）----
+@router.post("/split", response_model=SplitResponse)
+def split(req: SplitRequest):
+    engine = _engine()
+    sess = engine.get_session(req.session_id)
+    if not sess:
+        raise HTTPException(status_code=404, detail="Session not found")
+    if not req.mask_png_b64 and not req.mask_id:
+        raise HTTPException(status_code=400, detail="mask_id or mask_png_b64 required")
+    image_bgr, image_name = sess.image_bgr, sess.image_name
+    try:
+        mask01, tier = _item_mask(engine, sess, req)
+        if mask01.shape != image_bgr.shape[:2]:
+            raise ValueError(f"Mask shape {mask01.shape} doesn't match image shape {image_bgr.shape[:2]}")
+        timings = {}
+        out_root = Path(make_split_dir(image_name, os.getenv("OUTPUT_DIR", "output")))
+        manifest, manifest_path = split_and_export(image_bgr, mask01, out_root, req.min_area, req.max_elements,
+                                                   feather_px=req.feather_px, executor=exports.executor,
+                                                   timings=timings)
+    except InferenceQueueFull as e:
+        raise _busy(e)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    print(f"[SAM][Split] sid={sess.id[:8]} components={manifest['components']} elements={len(manifest['elements'])} "
+          f"dropped={manifest['dropped']} truncated={manifest['truncated']} "
+          f"label={timings['label_ms']:.1f}ms encode={timings['encode_ms']:.1f}ms")
+    return SplitResponse(elements=manifest["elements"], manifest_path=str(manifest_path),
+                         components=manifest["components"], dropped=manifest["dropped"],
+                         truncated=manifest["truncated"], tier=tier, timings=timings)
 
 # ---- 5) 画笔删补接口 ----
 @router.post("/brush-refinement", response_model=BrushRefinementResponse)
 def brush_refinement(req: BrushRefinementRequest):
-    sess = engine.sessions.get(req.session_id)
+    engine = _engine()
+    sess = engine.get_session(req.session_id)
     if not sess:
         raise HTTPException(status_code=404, detail="Session not found")
 
-    # 读取基础mask
-    base_mask_path = None
-    for p in sess.tmp_dir.glob(f"{req.mask_id}*.png"):
-        base_mask_path = p
-        break
-    if base_mask_path is None:
-        cand = sess.tmp_dir / f"{req.mask_id}.png"
-        if cand.exists():
-            base_mask_path = cand
-    if base_mask_path is None or not base_mask_path.exists():
-        raise HTTPException(status_code=404, detail="Base mask not found")
-
-    # 读取基础mask
-    base_mask = cv2.imread(str(base_mask_path), cv2.IMREAD_GRAYSCALE)
-    if base_mask is None:
-        raise HTTPException(status_code=400, detail="Failed to load base mask")
+    if req.mode not in ("raster", "smart"):
+        raise HTTPException(status_code=400, detail="mode must be 'raster' or 'smart'")
+    samples = _brush_samples(req, sess.w, sess.h)
+    if req.mode == "smart":
+        try:
+            state, rect, score = engine.smart_brush(req.session_id, req.mask_id, samples, req.smooth,
+                                                    wait_timeout=req.wait_timeout)
+        except SessionNotReady as e:
+            raise _not_ready(e)
+        except InferenceQueueFull as e:
+            raise _busy(e)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if state is None:
+            raise HTTPException(status_code=404, detail="Base mask not found")
+        return _brush_response(sess, state, rect, score)
 
-    # 创建可编辑的mask副本
-    refined_mask = base_mask.copy()
+    # 笔画只叠加到会话内存中的笔刷链上（O(笔画面积)），不再读回基础掩码或写 PNG
+    state, rect = engine.brush_apply(sess, req.mask_id, samples)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Base mask not found")
+    return _brush_response(sess, state, rect)
 
-    # 应用画笔操作
+def _brush_samples(req: BrushRefinementRequest, width: int, height: int):
+    samples = []
     for stroke in req.strokes:
+        if stroke.brush_mode not in ("add", "erase"):
+            continue
         # 如果提供了ROI信息，将ROI相对坐标转换为图像坐标
         if req.roi_box:
             roi_x, roi_y, roi_w, roi_h = req.roi_box
@@ -210,33 +472,39 @@ def brush_refinement(req: BrushRefinementRequest):
             abs_brush_size = stroke.brush_size * max(roi_w, roi_h)
         else:
             # 直接使用整个图像的归一化坐标
-            abs_x = stroke.x * base_mask.shape[1]
-            abs_y = stroke.y * base_mask.shape[0]
-            abs_brush_size = stroke.brush_size * max(base_mask.shape[1], base_mask.shape[0])
-        
-        x = int(abs_x)
-        y = int(abs_y)
-        radius = max(1, int(abs_brush_size))
-
-        if stroke.brush_mode == 'add':
-            # 添加模式：在mask上画白色
-            cv2.circle(refined_mask, (x, y), radius, 255, -1)
-        elif stroke.brush_mode == 'erase':
-            # 擦除模式：在mask上画黑色
-            cv2.circle(refined_mask, (x, y), radius, 0, -1)
-
-    # 生成新的mask ID和保存路径
-    refined_mask_id = f"{req.mask_id}_refined_{len(req.strokes)}"
-    refined_mask_path = sess.tmp_dir / f"{refined_mask_id}.png"
-
-    # 保存refined mask
-    success = cv2.imwrite(str(refined_mask_path), refined_mask)
-    if not success:
-        raise HTTPException(status_code=500, detail="Failed to save refined mask")
+            abs_x = stroke.x * width
+            abs_y = stroke.y * height
+            abs_brush_size = stroke.brush_size * max(width, height)
+        samples.append(BrushSample(x=abs_x, y=abs_y, radius=max(1, int(abs_brush_size)),
+                                   value=1 if stroke.brush_mode == "add" else 0, stroke_id=stroke.stroke_id))
+    return samples
 
+def _brush_response(sess, state, rect, score=None) -> BrushRefinementResponse:
     return BrushRefinementResponse(
-        refined_mask_id=refined_mask_id,
-        refined_mask_path=str(refined_mask_path),
-        width=base_mask.shape[1],
-        height=base_mask.shape[0]
+        refined_mask_id=state.head_id,
+        refined_mask_path=f"/sam/mask/{sess.id}/{state.head_id}",
+        width=state.mask.shape[1],
+        height=state.mask.shape[0],
+        dirty_rect=list(rect) if rect is not None else None,
+        can_undo=bool(state.undo),
+        can_redo=bool(state.redo),
+        score=score,
     )
+
+@router.post("/brush-refinement/undo", response_model=BrushRefinementResponse)
+def brush_undo(req: BrushHistoryRequest):
+    return _brush_history(req, redo=False)
+
+@router.post("/brush-refinement/redo", response_model=BrushRefinementResponse)
+def brush_redo(req: BrushHistoryRequest):
+    return _brush_history(req, redo=True)
+
+def _brush_history(req: BrushHistoryRequest, redo: bool) -> BrushRefinementResponse:
+    engine = _engine()
+    sess = engine.get_session(req.session_id)
+    if not sess:
+        raise HTTPException(status_code=404, detail="Session not found")
+    state, rect = engine.brush_history(sess, req.mask_id, redo=redo)
+    if state is None:
+        raise HTTPException(status_code=404, detail="No brush history for this mask (expected the latest refined_mask_id)")
+    return _brush_response(sess, state, rect)
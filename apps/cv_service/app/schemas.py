@@ -11,12 +11,24 @@ class InitRequest(BaseModel):
     image_name: Optional[str] = None       # 可用于命名，如 drawing_0030.png
     keep_session: bool = False             # 默认为 False: 启动新图片时清空旧会话，避免坐标/图片错配
     max_side: Optional[int] = Field(default=None, description="可选：限制图像最大边，后端统一缩放以加速")
+    async_embed: bool = Field(default=False, description="为 True 时立即返回 session_id，embedding 在后台计算")
 
 class InitResponse(BaseModel):
     session_id: str
     width: int
     height: int
     image_name: str
+    status: str = "ready"                  # pending | ready | failed
+    timings: dict = Field(default_factory=dict)  # upload_ms / decode_ms / resize_ms / embed_ms ...
+
+# ---- 会话 embedding 状态（后台编码进度） ----
+class SessionStatusResponse(BaseModel):
+    session_id: str
+    status: str                            # pending | ready | failed
+    error: Optional[str] = None
+    elapsed_ms: float                      # 从登记到完成（或到现在）的耗时
+    timings: dict = Field(default_factory=dict)
+    final_status: Optional[str] = None     # 双档模式下大模型 embedding 的状态
 
 # ---- 更新已存在会话的图像（摄像头连续拍照复用 predictor） ----
 class UpdateImageRequest(BaseModel):
@@ -25,12 +37,16 @@ class UpdateImageRequest(BaseModel):
     image_b64: Optional[str] = None
     image_name: Optional[str] = None
     max_side: Optional[int] = Field(default=None, description="可选：更新时限制最大边")
+    force_embed: bool = Field(default=False, description="为 True 时即使画面几乎没变也重新编码")
 
 class UpdateImageResponse(BaseModel):
     session_id: str
     width: int
     height: int
     image_name: str
+    embedded: bool = True                  # False：画面与上次编码帧几乎相同，沿用原 embedding 与掩码
+    frame_delta: Optional[float] = None    # 与上次编码帧相比变化的格子比例（0~1），关闭检测时为 None
+    timings: dict = Field(default_factory=dict)
 
 # ---- 每个 ROI 的分割（候选） ----
 class SegmentRequest(BaseModel):
@@ -41,16 +57,94 @@ class SegmentRequest(BaseModel):
     multimask: bool = True
     top_n: int = 3
     smooth: bool = True
+    wait_timeout: Optional[float] = Field(default=None, description="embedding 未就绪时最多等待的秒数；0=立即失败，默认 SAM_READY_TIMEOUT")
+    parent_mask_id: Optional[str] = Field(default=None, description="上一轮选中的候选ID：用其低分辨率 logits 作为 mask_input 继续细化")
+    zoom: Optional[bool] = Field(default=None, description="放大模式：true 在源图框周围裁剪区域上重新编码后解码，false 关闭，默认按 SAM_ZOOM 自动判断")
+    mask_format: Optional[str] = Field(default=None, description="rle | bitmap：在响应中内联 bbox 裁剪后的掩码，省去逐个 GET /sam/mask")
+    contours: bool = Field(default=False, description="为 True 时每个候选附带简化后的轮廓多边形（含孔洞）")
+    contour_tolerance: Optional[float] = Field(default=None, description="轮廓简化容差（像素），默认 SAM_CONTOUR_TOLERANCE")
+
+class InlineMask(BaseModel):
+    format: str                            # rle | bitmap
+    bbox: Optional[List[int]] = None       # x0,y0,x1,y1（x1/y1 不含），空掩码为 None
+    size: List[int]                        # 裁剪区域 [h, w]
+    counts: Optional[List[int]] = None     # rle：列优先游程，从 0 的游程开始
+    data: Optional[str] = None             # bitmap：行优先 np.packbits 后 base64
+
+class MaskPolygon(BaseModel):
+    outer: List[List[int]]                 # 外轮廓 [[x,y],...]
+    holes: List[List[List[int]]] = Field(default_factory=list)
 
 class MaskInfo(BaseModel):
     mask_id: str
     score: float
-    path: str
+    path: str                              # 预览 URL 路径：/sam/mask/{session_id}/{mask_id}
+    tier: Optional[str] = None             # 产生该掩码的模型档位：preview | final
+    inline: Optional[InlineMask] = None    # 请求 mask_format 时的内联编码
+    contours: Optional[List[MaskPolygon]] = None  # 请求 contours 时的轮廓多边形
 
 class SegmentResponse(BaseModel):
     masks: List[MaskInfo]
     width: int
     height: int
+    zoom_box: Optional[List[int]] = None   # 放大模式实际编码的裁剪区域（会话坐标 x1,y1,x2,y2），未放大为 None
+    timings: Optional[dict] = None         # decode_ms 与后处理各阶段耗时（bbox_ms / smooth_ms / holes_ms / regions_ms，全部候选累计）
+
+# ---- 多个 ROI 一次性批量分割 ----
+class SegmentPrompt(BaseModel):
+    points: List[Tuple[float, float]] = Field(default_factory=list)   # 原图坐标
+    labels: List[int] = Field(default_factory=list)                   # 1=FG,0=BG
+    box: Tuple[float, float, float, float]                            # x1,y1,x2,y2
+
+class SegmentBatchRequest(BaseModel):
+    session_id: str
+    prompts: List[SegmentPrompt]
+    multimask: bool = True
+    top_n: int = 3
+    smooth: bool = True
+    wait_timeout: Optional[float] = None
+    mask_format: Optional[str] = None      # rle | bitmap，同 SegmentRequest
+    contours: bool = False
+    contour_tolerance: Optional[float] = None
+
+class SegmentBatchItem(BaseModel):
+    masks: List[MaskInfo]                  # 与 prompts 一一对应
+
+class SegmentBatchResponse(BaseModel):
+    results: List[SegmentBatchItem]
+    width: int
+    height: int
+    timings: Optional[dict] = None         # 后处理各阶段耗时（全部提示的候选累计）
+
+# ---- 整图自动分割（网格撒点 + 过滤 + NMS）----
+class AutoSegmentRequest(BaseModel):
+    session_id: str
+    points_per_side: int = 16          # 网格每边点数（共 N*N 个点）
+    points_per_batch: int = 32         # 单次解码的点数，越大越快但峰值内存越高
+    pred_iou_thresh: float = 0.88      # 解码器预测 IoU 下限
+    stability_thresh: float = 0.92     # 稳定性分数下限
+    nms_iou: float = 0.7               # 框 NMS 的 IoU 阈值
+    min_area: int = 500                # 最小面积（像素）
+    max_area_ratio: float = 0.9        # 超过整图该比例的掩码（通常是纸面背景）丢弃
+    max_masks: int = 64
+    smooth: bool = True
+    wait_timeout: Optional[float] = None
+
+class AutoMaskInfo(BaseModel):
+    mask_id: str
+    score: float
+    stability: float
+    area: int
+    bbox: List[int]                        # x1,y1,x2,y2（x2/y2 不含）
+    point: Tuple[float, float]             # 产生该掩码的网格点
+    path: str
+
+class AutoSegmentResponse(BaseModel):
+    masks: List[AutoMaskInfo]
+    width: int
+    height: int
+    cached: bool                           # 结果来自缓存（同一张图 + 相同参数）
+    elapsed_ms: float
 
 # ---- 导出单个 ROI 的最终 PNG ----
 class ExportROIRequest(BaseModel):
@@ -65,6 +159,64 @@ class ExportROIRequest(BaseModel):
 class ExportROIResponse(BaseModel):
     sprite_path: str
     bbox: dict
+    tier: Optional[str] = None             # 最终掩码来自哪个模型档位（上传掩码时为 None）
+    timings: Optional[dict] = None         # 导出各阶段耗时（bbox_ms / feather_ms / encode_ms）
+
+# ---- 异步批量导出 ----
+class ExportJobItem(BaseModel):
+    mask_id: Optional[str] = None      # 二选一：mask_id 或 mask_png_b64（同 ExportROIRequest）
+    mask_png_b64: Optional[str] = None
+    roi_index: int = 1
+    feather_px: int = 0
+    roi_box: Optional[Tuple[float, float, float, float]] = None
+
+class ExportJobsRequest(BaseModel):
+    session_id: str
+    items: List[ExportJobItem]
+
+class ExportJobsResponse(BaseModel):
+    job_ids: List[str]                 # 与 items 一一对应
+
+class ExportJobStatus(BaseModel):
+    job_id: str
+    session_id: str
+    roi_index: int
+    status: str                        # queued | running | done | failed
+    error: Optional[str] = None
+    sprite_path: Optional[str] = None  # 以下在 done 时给出
+    bbox: Optional[dict] = None
+    tier: Optional[str] = None
+    timings: Optional[dict] = None
+    queued_ms: Optional[float] = None
+    elapsed_ms: Optional[float] = None
+
+class ExportJobsStatusResponse(BaseModel):
+    jobs: List[ExportJobStatus]
+    pending: int                       # 其中尚未结束的任务数
+
+# ---- 按连通域拆分为多个元素 sprite ----
+class SplitRequest(BaseModel):
+    session_id: str
+    mask_id: Optional[str] = None      # 二选一：mask_id 或 mask_png_b64（同 ExportROIRequest）
+    mask_png_b64: Optional[str] = None
+    min_area: int = 500                # 小于该面积（像素）的连通域丢弃
+    max_elements: int = 20             # 最多导出的元素数（超出时保留面积最大的）
+    feather_px: int = 0                # >0 时每个 sprite 外扩并柔化边缘
+
+class SplitElement(BaseModel):
+    uuid: str
+    sprite_path: str
+    bbox: dict                         # sprite 在原图中的位置 xmin,ymin,xmax,ymax（含）
+    area: int
+
+class SplitResponse(BaseModel):
+    elements: List[SplitElement]
+    manifest_path: str
+    components: int                    # 连通域总数
+    dropped: int                       # 因面积过小（< min_area）被丢弃的连通域数
+    truncated: int = 0                 # 面积达标但超出 max_elements 而未导出的连通域数
+    tier: Optional[str] = None         # 掩码来自哪个模型档位（上传掩码时为 None）
+    timings: Optional[dict] = None     # label_ms / encode_ms / manifest_ms
 
 # ---- 画笔删补接口 ----
 class BrushStroke(BaseModel):
@@ -72,15 +224,29 @@ class BrushStroke(BaseModel):
     y: float
     brush_size: float
     brush_mode: str  # 'add' 或 'erase'
+    stroke_id: Optional[int] = None  # 同一笔画的采样点用相同 id，相邻点之间连线；缺省时按间距判断
 
 class BrushRefinementRequest(BaseModel):
     session_id: str
     mask_id: str  # 基础mask的ID
     strokes: List[BrushStroke]  # 画笔操作序列
     roi_box: Optional[Tuple[float, float, float, float]] = None  # ROI坐标 (x, y, width, height)
+    # raster：按笔画直接删补像素；smart：笔画转为正/负点提示 + 当前掩码 logits，解码一次并吸附到画面边缘
+    mode: str = "raster"
+    smooth: bool = True                    # smart 模式下对解码结果做形态学平滑
+    wait_timeout: Optional[float] = None   # smart 模式需要 embedding，未就绪时的等待秒数
 
 class BrushRefinementResponse(BaseModel):
     refined_mask_id: str
     refined_mask_path: str
     width: int
     height: int
+    dirty_rect: Optional[List[int]] = None  # 本次改动的区域 x0,y0,x1,y1（x1/y1 不含），无改动为 None
+    can_undo: bool = False
+    can_redo: bool = False
+    score: Optional[float] = None           # smart 模式：解码器预测 IoU
+
+# ---- 笔刷撤销 / 重做（mask_id 为笔刷链当前的 refined_mask_id） ----
+class BrushHistoryRequest(BaseModel):
+    session_id: str
+    mask_id: str
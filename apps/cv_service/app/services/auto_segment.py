@@ -0,0 +1,114 @@
+"""
+“一键分割全部元素”的辅助函数与结果缓存
+
+- 网格撒点 -> 会话已有 embedding 上批量解码（每点 3 个多掩码候选）
+- 过滤：预测 IoU、稳定性分数（低分辨率 logits 上计算）、最小面积，最后按框做 NMS
+- 结果按 (图像 embedding key + 参数) 缓存，只保存 bbox 内的裁剪掩码，同一张画重复调用直接返回
+"""
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+@dataclass
+class AutoMask:
+    crop: np.ndarray                      # bbox 内的 uint8 0/1 掩码
+    bbox: Tuple[int, int, int, int]       # x0,y0,x1,y1（x1/y1 不含），会话坐标
+    score: float                          # 解码器预测 IoU
+    stability: float
+    area: int
+    point: Tuple[float, float]            # 产生该掩码的网格点
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.crop.nbytes)
+
+    def full(self, h: int, w: int) -> np.ndarray:
+        x0, y0, x1, y1 = self.bbox
+        mask = np.zeros((h, w), dtype=np.uint8)
+        mask[y0:y1, x0:x1] = self.crop
+        return mask
+
+
+def point_grid(w: int, h: int, points_per_side: int) -> np.ndarray:
+    """均匀网格点（格子中心），返回 (N,2) 的会话坐标。"""
+    n = max(1, int(points_per_side))
+    offset = 1.0 / (2 * n)
+    ticks = np.linspace(offset, 1 - offset, n)
+    xs, ys = np.meshgrid(ticks * w, ticks * h)
+    return np.stack([xs.reshape(-1), ys.reshape(-1)], axis=1).astype(np.float32)
+
+
+def stability_score(logits: np.ndarray, threshold: float = 0.0, offset: float = 1.0) -> np.ndarray:
+    """阈值上下浮动 offset 时掩码面积之比（越接近 1 越稳定）。logits: (N,h,w)。"""
+    high = (logits > threshold + offset).sum(axis=(-1, -2)).astype(np.float64)
+    low = (logits > threshold - offset).sum(axis=(-1, -2)).astype(np.float64)
+    return np.where(low > 0, high / np.maximum(low, 1), 0.0)
+
+
+def box_nms(boxes: np.ndarray, scores: np.ndarray, iou_thresh: float) -> List[int]:
+    """标准框 NMS，返回保留下标（按分数降序）。boxes: (N,4) x0,y0,x1,y1。"""
+    order = np.argsort(scores)[::-1]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = []
+    while order.size:
+        i = int(order[0])
+        keep.append(i)
+        rest = order[1:]
+        xx0 = np.maximum(boxes[i, 0], boxes[rest, 0])
+        yy0 = np.maximum(boxes[i, 1], boxes[rest, 1])
+        xx1 = np.minimum(boxes[i, 2], boxes[rest, 2])
+        yy1 = np.minimum(boxes[i, 3], boxes[rest, 3])
+        inter = np.clip(xx1 - xx0, 0, None) * np.clip(yy1 - yy0, 0, None)
+        iou = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-6)
+        order = rest[iou <= iou_thresh]
+    return keep
+
+
+class AutoSegmentCache:
+    """key -> List[AutoMask] 的 LRU，按裁剪掩码字节数限制总量。"""
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        if max_bytes is None:
+            try:
+                max_bytes = int(os.getenv("SAM_AUTO_CACHE_MB", "64")) * 1024 * 1024
+            except ValueError:
+                max_bytes = 64 * 1024 * 1024
+        self.max_bytes = max(0, max_bytes)
+        self._items: "OrderedDict[str, List[AutoMask]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[List[AutoMask]]:
+        with self._lock:
+            items = self._items.get(key)
+            if items is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return items
+
+    def put(self, key: str, items: List[AutoMask]):
+        size = sum(m.nbytes for m in items)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= sum(m.nbytes for m in old)
+            self._items[key] = items
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._items:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= sum(m.nbytes for m in evicted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._items), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
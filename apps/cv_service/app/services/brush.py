@@ -0,0 +1,199 @@
+"""
+会话内的笔刷删补状态（内存）
+
+- 每条笔刷链（从某个候选掩码开始的一串删补）持有一份可写的 0/1 掩码，后续请求只在其上叠加新笔画，
+  不再每次读回基础掩码、也不做 PNG 往返
+- 同一笔画的相邻采样点用粗线段（两端圆头，即胶囊形）连接，快速拖动时不会出现断点
+- 每次请求是一个撤销步：只记录笔画外接矩形内修改前/后的像素（np.packbits 压缩），撤销/重做同样只改该矩形
+- 单次请求的开销与笔画覆盖面积成正比，与整幅图像大小无关
+- 智能笔刷：笔画沿线采样为正/负点提示，连同当前掩码的 logits 一起在会话 embedding 上解码一次，
+  结果吸附到画面真实边缘；解码结果作为一个整体编辑写回同一条链，撤销/重做照常
+"""
+from collections import deque
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+Rect = Tuple[int, int, int, int]  # x0,y0,x1,y1（x1/y1 不含）
+
+
+@dataclass
+class BrushSample:
+    x: float                   # 图像像素坐标
+    y: float
+    radius: int
+    value: int                 # 1=补，0=删
+    stroke_id: Optional[int] = None
+
+
+@dataclass
+class BrushEdit:
+    """一个撤销步：脏矩形及其修改前/后的像素（按位压缩）。"""
+    rect: Rect
+    before: np.ndarray
+    after: np.ndarray
+
+    @staticmethod
+    def pack(crop: np.ndarray) -> np.ndarray:
+        return np.packbits(crop, axis=None)
+
+    def unpack(self, which: str) -> np.ndarray:
+        x0, y0, x1, y1 = self.rect
+        h, w = y1 - y0, x1 - x0
+        return np.unpackbits(getattr(self, which), count=h * w).reshape(h, w)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.before.nbytes + self.after.nbytes)
+
+
+def stroke_segments(samples: Iterable[BrushSample], join_gap: float) -> List[Tuple[Optional[BrushSample], BrushSample]]:
+    """把采样点序列切成 (上一点, 当前点) 线段；上一点为 None 表示笔画起点（只盖一个圆）。
+    带 stroke_id 时同一 id 的相邻点相连；都没有 id 时，模式相同且间距不超过 join_gap 倍半径的相邻点相连。"""
+    segments = []
+    prev: Optional[BrushSample] = None
+    for s in samples:
+        joined = False
+        if prev is not None and prev.value == s.value:
+            if s.stroke_id is not None or prev.stroke_id is not None:
+                joined = s.stroke_id == prev.stroke_id
+            else:
+                gap = float(np.hypot(s.x - prev.x, s.y - prev.y))
+                joined = gap <= join_gap * max(s.radius, prev.radius)
+        segments.append((prev if joined else None, s))
+        prev = s
+    return segments
+
+
+def stroke_prompts(samples: List[BrushSample], per_stroke: int, join_gap: float):
+    """把笔画转换为 SAM 点提示：每笔按弧长均匀取 per_stroke 个点（含两端），补=1、删=0。
+    返回 (points [[x,y],...], labels [...])。"""
+    strokes: List[List[BrushSample]] = []
+    for prev, cur in stroke_segments(samples, join_gap):
+        if prev is None:
+            strokes.append([cur])
+        else:
+            strokes[-1].append(cur)
+    points, labels = [], []
+    for stroke in strokes:
+        xy = np.array([[s.x, s.y] for s in stroke], dtype=np.float64)
+        seg = np.hypot(*np.diff(xy, axis=0).T) if len(xy) > 1 else np.zeros(0)
+        arc = np.concatenate([[0.0], np.cumsum(seg)])
+        n = 1 if arc[-1] < 1 else max(1, int(per_stroke))
+        targets = np.linspace(0.0, arc[-1], n) if n > 1 else np.array([arc[-1] / 2])
+        xs = np.interp(targets, arc, xy[:, 0])
+        ys = np.interp(targets, arc, xy[:, 1])
+        points.extend([[float(x), float(y)] for x, y in zip(xs, ys)])
+        labels.extend([stroke[0].value] * len(xs))
+    return points, labels
+
+
+def segments_rect(segments, h: int, w: int) -> Optional[Rect]:
+    xs0, ys0, xs1, ys1 = [], [], [], []
+    for prev, cur in segments:
+        for p in (prev, cur):
+            if p is None:
+                continue
+            xs0.append(p.x - cur.radius - 1)
+            ys0.append(p.y - cur.radius - 1)
+            xs1.append(p.x + cur.radius + 2)
+            ys1.append(p.y + cur.radius + 2)
+    if not xs0:
+        return None
+    x0, y0 = max(0, int(min(xs0))), max(0, int(min(ys0)))
+    x1, y1 = min(w, int(np.ceil(max(xs1)))), min(h, int(np.ceil(max(ys1))))
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1, y1
+
+
+def rasterize(crop: np.ndarray, segments, origin: Tuple[int, int]):
+    """在裁剪区域上画线段：粗线（thickness=2r+1，OpenCV 粗线两端为圆头）+ 端点圆盘。"""
+    ox, oy = origin
+    for prev, cur in segments:
+        p1 = (int(round(cur.x)) - ox, int(round(cur.y)) - oy)
+        cv2.circle(crop, p1, cur.radius, cur.value, -1)
+        if prev is not None:
+            p0 = (int(round(prev.x)) - ox, int(round(prev.y)) - oy)
+            if p0 != p1:
+                cv2.line(crop, p0, p1, cur.value, thickness=2 * cur.radius + 1)
+
+
+class BrushState:
+    """一条笔刷链：可写掩码 + 撤销/重做栈。head_id 是当前登记在会话里的掩码 ID。"""
+
+    def __init__(self, base_id: str, mask01: np.ndarray, max_undo: int):
+        self.base_id = base_id
+        self.mask = (mask01 > 0).astype(np.uint8)   # 唯一一次整图拷贝
+        self.head_id = base_id
+        self.undo: deque = deque(maxlen=max(1, max_undo))
+        self.redo: List[BrushEdit] = []
+        # 头部掩码对应的 SAM 低分辨率 logits 与提示：只有最近一次编辑是智能笔刷解码时才有效，
+        # 像素级编辑/撤销/重做之后置空（下次智能笔刷改由掩码像素推出 mask_input）
+        self.logits: Optional[np.ndarray] = None
+        self.prompt: Optional[dict] = None
+
+    def apply(self, samples: List[BrushSample], join_gap: float) -> Optional[Rect]:
+        """叠加一批笔画采样，返回脏矩形（没有改动时为 None）。join_gap 见 stroke_segments。"""
+        h, w = self.mask.shape
+        segments = stroke_segments(samples, join_gap)
+        rect = segments_rect(segments, h, w)
+        if rect is None:
+            return None
+        x0, y0, x1, y1 = rect
+        before = self.mask[y0:y1, x0:x1].copy()
+        crop = before.copy()
+        rasterize(crop, segments, (x0, y0))
+        if np.array_equal(crop, before):
+            return None
+        self.logits = self.prompt = None
+        self.mask[y0:y1, x0:x1] = crop
+        self._push(rect, before, crop)
+        return rect
+
+    def replace(self, mask01: np.ndarray, logits: Optional[np.ndarray] = None, prompt: Optional[dict] = None) -> Optional[Rect]:
+        """用一整幅新掩码（智能笔刷解码结果）替换当前掩码，只记录变化区域的外接矩形。"""
+        new = (mask01 > 0).astype(np.uint8)
+        changed = new != self.mask
+        self.logits, self.prompt = logits, prompt
+        rows = np.flatnonzero(changed.any(axis=1))
+        if rows.size == 0:
+            return None
+        cols = np.flatnonzero(changed.any(axis=0))
+        x0, y0, x1, y1 = int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+        before = self.mask[y0:y1, x0:x1].copy()
+        after = new[y0:y1, x0:x1]
+        self.mask[y0:y1, x0:x1] = after
+        self._push((x0, y0, x1, y1), before, after)
+        return x0, y0, x1, y1
+
+    def _push(self, rect: Rect, before: np.ndarray, after: np.ndarray):
+        self.undo.append(BrushEdit(rect, BrushEdit.pack(before), BrushEdit.pack(after)))
+        self.redo.clear()
+
+    def undo_step(self) -> Optional[Rect]:
+        if not self.undo:
+            return None
+        edit = self.undo.pop()
+        self._write(edit, "before")
+        self.redo.append(edit)
+        return edit.rect
+
+    def redo_step(self) -> Optional[Rect]:
+        if not self.redo:
+            return None
+        edit = self.redo.pop()
+        self._write(edit, "after")
+        self.undo.append(edit)
+        return edit.rect
+
+    def _write(self, edit: BrushEdit, which: str):
+        self.logits = self.prompt = None
+        x0, y0, x1, y1 = edit.rect
+        self.mask[y0:y1, x0:x1] = edit.unpack(which)
+
+    @property
+    def history_bytes(self) -> int:
+        return sum(e.nbytes for e in self.undo) + sum(e.nbytes for e in self.redo)
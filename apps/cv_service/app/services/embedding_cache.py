@@ -0,0 +1,175 @@
+"""
+图像 embedding 缓存（按内容寻址）
+
+- key：解码后像素的哈希 + max_side + model_type，同一张图重复 /sam/init 不再跑 ViT 编码器
+- 内存层：按字节预算的 LRU
+- 磁盘层：<key>.npy（mmap 方式读取）+ <key>.json（尺寸信息）
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+@dataclass
+class CachedEmbedding:
+    features: np.ndarray              # (1,256,64,64)，CPU 上的 numpy
+    original_size: Tuple[int, int]    # (h, w)
+    input_size: Tuple[int, int]       # 送入编码器前 ResizeLongestSide 后的 (h, w)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.features.nbytes)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+class EmbeddingCache:
+    def __init__(self, max_bytes: Optional[int] = None, disk_dir: Optional[str] = None,
+                 max_disk_bytes: Optional[int] = None):
+        if max_bytes is None:
+            max_bytes = _env_int("SAM_EMBED_CACHE_MB", 256) * 1024 * 1024
+        if disk_dir is None:
+            disk_dir = os.getenv("SAM_EMBED_CACHE_DIR", "assets/embed_cache")
+        if max_disk_bytes is None:
+            max_disk_bytes = _env_int("SAM_EMBED_DISK_MB", 2048) * 1024 * 1024
+        self.max_bytes = max(0, max_bytes)
+        self.max_disk_bytes = max(0, max_disk_bytes)
+        # 空字符串表示关闭磁盘层
+        self.disk_dir: Optional[Path] = Path(disk_dir) if disk_dir else None
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+        self._mem: "OrderedDict[str, CachedEmbedding]" = OrderedDict()
+        self._mem_bytes = 0
+        self._lock = threading.Lock()
+        self.hits_mem = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(image_bgr: np.ndarray, max_side: Optional[int], model_type: str) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(str(image_bgr.shape).encode())
+        h.update(np.ascontiguousarray(image_bgr).data)
+        h.update(f"|{max_side or 0}|{model_type}".encode())
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[CachedEmbedding]:
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None:
+                self._mem.move_to_end(key)
+                self.hits_mem += 1
+                return entry
+        entry = self._load_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits_disk += 1
+            self._put_mem(key, entry)
+        return entry
+
+    def put(self, key: str, entry: CachedEmbedding):
+        with self._lock:
+            self._put_mem(key, entry)
+        self._save_disk(key, entry)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits_mem + self.hits_disk + self.misses
+            return {
+                "hits_mem": self.hits_mem,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "hit_rate": round((self.hits_mem + self.hits_disk) / lookups, 3) if lookups else 0.0,
+                "mem_entries": len(self._mem),
+                "mem_bytes": self._mem_bytes,
+                "mem_budget_bytes": self.max_bytes,
+                "disk_dir": str(self.disk_dir) if self.disk_dir else None,
+            }
+
+    # ---------------- 内部辅助 -----------------
+    def _put_mem(self, key: str, entry: CachedEmbedding):
+        if entry.nbytes > self.max_bytes:
+            return
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._mem_bytes -= old.nbytes
+        self._mem[key] = entry
+        self._mem_bytes += entry.nbytes
+        while self._mem_bytes > self.max_bytes and self._mem:
+            _, ev = self._mem.popitem(last=False)
+            self._mem_bytes -= ev.nbytes
+
+    def _load_disk(self, key: str) -> Optional[CachedEmbedding]:
+        if self.disk_dir is None:
+            return None
+        npy = self.disk_dir / f"{key}.npy"
+        meta = self.disk_dir / f"{key}.json"
+        if not (npy.exists() and meta.exists()):
+            return None
+        try:
+            info = json.loads(meta.read_text())
+            # mmap 读取，只在真正上传到 device 时才触页
+            feats = np.load(str(npy), mmap_mode="r")
+            os.utime(npy)  # 刷新 mtime，磁盘层按 mtime 做 LRU
+            return CachedEmbedding(features=feats,
+                                   original_size=tuple(info["original_size"]),
+                                   input_size=tuple(info["input_size"]))
+        except Exception as e:
+            print(f"[SAM][EmbedCache] failed to load {key[:8]} from disk: {e}")
+            return None
+
+    def _save_disk(self, key: str, entry: CachedEmbedding):
+        if self.disk_dir is None or self.max_disk_bytes <= 0:
+            return
+        npy = self.disk_dir / f"{key}.npy"
+        if npy.exists():
+            return
+        try:
+            # 先写临时文件再改名，避免并发读到半截文件
+            # 临时文件后缀不是 .npy，_trim_disk 的 glob 不会把写到一半的文件计入预算或删掉
+            tmp = self.disk_dir / f"{key}.npy.tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, np.ascontiguousarray(entry.features))
+            (self.disk_dir / f"{key}.json").write_text(json.dumps({
+                "original_size": list(entry.original_size),
+                "input_size": list(entry.input_size),
+            }))
+            os.replace(tmp, npy)
+        except Exception as e:
+            print(f"[SAM][EmbedCache] failed to save {key[:8]} to disk: {e}")
+            return
+        self._trim_disk()
+
+    def _trim_disk(self):
+        files = []
+        for p in self.disk_dir.glob("*.npy"):
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue  # 并发的另一次清理刚删掉
+            files.append((st.st_mtime, st.st_size, p))
+        files.sort(key=lambda f: f[0])
+        total = sum(size for _, size, _ in files)
+        for _, size, p in files:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                total -= size
+                p.unlink(missing_ok=True)
+                p.with_suffix(".json").unlink(missing_ok=True)
+            except Exception:
+                pass
@@ -0,0 +1,118 @@
+"""
+图像编码器（ViT）的降精度模式
+
+- fp32：默认，eager 全精度
+- int8：对 ViT 的 nn.Linear 做动态 int8 量化（仅 CPU）
+- bf16：编码时 torch.autocast(bfloat16)（CPU/GPU 支持时）
+启动时可用合成图对比 fp32，输出提速倍数与掩码 IoU，便于按机器选择模式。
+"""
+import contextlib
+import time
+from typing import Callable, Optional
+
+import cv2
+import numpy as np
+import torch
+from segment_anything import SamPredictor
+from segment_anything.utils.transforms import ResizeLongestSide
+
+ENCODER_MODES = ("fp32", "int8", "bf16")
+
+
+def resolve_mode(mode: str, device: str) -> str:
+    """检查当前设备是否支持该模式，不支持时回退 fp32。"""
+    mode = (mode or "fp32").lower()
+    if mode not in ENCODER_MODES:
+        print(f"[SAM][EncoderMode] unknown mode {mode!r}, using fp32")
+        return "fp32"
+    if mode == "int8" and not str(device).startswith("cpu"):
+        print("[SAM][EncoderMode] int8 dynamic quantization is CPU only, using fp32")
+        return "fp32"
+    if mode == "bf16":
+        if str(device).startswith("cuda"):
+            if not (torch.cuda.is_available() and torch.cuda.is_bf16_supported()):
+                print("[SAM][EncoderMode] bf16 not supported on this GPU, using fp32")
+                return "fp32"
+        else:
+            try:
+                with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+                    torch.nn.functional.linear(torch.ones(2, 2), torch.ones(2, 2))
+            except Exception:
+                print("[SAM][EncoderMode] bf16 autocast not supported on this CPU, using fp32")
+                return "fp32"
+    return mode
+
+
+def quantize_encoder(encoder: torch.nn.Module) -> torch.nn.Module:
+    """返回 Linear 层动态 int8 量化后的编码器副本（原模块不变）。"""
+    return torch.ao.quantization.quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8, inplace=False)
+
+
+def encoder_context(mode: str, device: str):
+    """编码时使用的上下文：bf16 返回 autocast，其余为空上下文。"""
+    if mode == "bf16":
+        return torch.autocast(device_type="cuda" if str(device).startswith("cuda") else "cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def synthetic_drawing(w: int = 1024, h: int = 768, seed: int = 0) -> np.ndarray:
+    """合成一张“儿童画”风格的测试图：浅色纸面 + 若干粗线条色块（BGR）。"""
+    rng = np.random.default_rng(seed)
+    img = np.full((h, w, 3), 235, dtype=np.uint8)
+    for _ in range(6):
+        color = tuple(int(c) for c in rng.integers(0, 200, size=3))
+        cx, cy = int(rng.integers(100, w - 100)), int(rng.integers(100, h - 100))
+        r = int(rng.integers(40, 110))
+        cv2.circle(img, (cx, cy), r, color, -1)
+        cv2.circle(img, (cx, cy), r, (20, 20, 20), 3)
+    return img
+
+
+def compare_with_fp32(model, device: str, mode: str, encode_ref: Callable, encode_test: Callable,
+                      image_bgr: Optional[np.ndarray] = None) -> dict:
+    """用同一张图分别跑 fp32 与目标模式的编码器，比较耗时和解码出的掩码 IoU。
+    encode_ref / encode_test: (预处理后的 1x3x1024x1024 张量) -> features。"""
+    img = synthetic_drawing() if image_bgr is None else image_bgr
+    rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    transform = ResizeLongestSide(model.image_encoder.img_size)
+    x = torch.as_tensor(transform.apply_image(rgb), device=device).permute(2, 0, 1).contiguous()[None, :, :, :]
+    input_size = tuple(x.shape[-2:])
+    x = model.preprocess(x)
+
+    def run(fn):
+        with torch.no_grad():
+            t0 = time.perf_counter()
+            feats = fn(x).float()
+            return feats, (time.perf_counter() - t0) * 1000
+
+    ref, ref_ms = run(encode_ref)
+    test, test_ms = run(encode_test)
+
+    # 用同一个（fp32）解码器，在几个固定框上比较掩码
+    predictor = SamPredictor(model)
+    h, w = img.shape[:2]
+    boxes = [(0.1, 0.1, 0.5, 0.5), (0.4, 0.3, 0.9, 0.9), (0.05, 0.05, 0.95, 0.95)]
+    ious = []
+    for bx in boxes:
+        box = np.array([bx[0] * w, bx[1] * h, bx[2] * w, bx[3] * h], dtype=np.float32)
+        masks = []
+        for feats in (ref, test):
+            predictor.reset_image()
+            predictor.features = feats
+            predictor.original_size = (h, w)
+            predictor.input_size = input_size
+            predictor.is_image_set = True
+            m, _, _ = predictor.predict(box=box, multimask_output=False)
+            masks.append(m[0])
+        union = np.logical_or(*masks).sum()
+        ious.append(float(np.logical_and(*masks).sum() / union) if union else 1.0)
+    predictor.reset_image()
+
+    return {
+        "mode": mode,
+        "fp32_ms": round(ref_ms, 1),
+        "mode_ms": round(test_ms, 1),
+        "speedup": round(ref_ms / test_ms, 2) if test_ms > 0 else None,
+        "mask_iou": round(float(np.mean(ious)), 4),
+        "mask_iou_min": round(float(np.min(ious)), 4),
+    }
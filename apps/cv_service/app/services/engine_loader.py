@@ -0,0 +1,93 @@
+"""
+SAM 引擎的后台加载与预热
+
+- 服务启动时不再同步加载权重：/health、/assets、/files 在进程启动后立即可用
+- 后台线程依次：导入 torch/segment_anything -> 加载权重 -> 合成图预热（编码 + 解码各一次）
+- 状态：idle | loading | warming | ready | failed，各阶段耗时供 /health 与 /sam/stats 查看
+"""
+import os
+import threading
+import time
+from typing import Optional, TYPE_CHECKING
+
+from .errors import EngineNotReady
+
+if TYPE_CHECKING:
+    from .sam_engine import SamEngine
+
+
+class EngineLoader:
+    def __init__(self, warmup: Optional[bool] = None):
+        if warmup is None:
+            warmup = os.getenv("SAM_WARMUP", "1").lower() in ("1", "true", "yes")
+        self.warmup = warmup
+        self.state = "idle"
+        self.error: Optional[str] = None
+        self.timings: dict = {}
+        self._engine: Optional["SamEngine"] = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._started_at: Optional[float] = None
+
+    def start(self):
+        """启动后台加载线程；重复调用无副作用。"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._started_at = time.perf_counter()
+            self.state = "loading"
+            self._thread = threading.Thread(target=self._run, name="sam-loader", daemon=True)
+            self._thread.start()
+
+    def get(self) -> "SamEngine":
+        if self._engine is not None:
+            return self._engine
+        if self.state == "failed":
+            raise EngineNotReady("failed", f"SAM engine failed to load: {self.error}")
+        raise EngineNotReady(self.state, f"SAM engine is {self.state}, retry later")
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._ready.wait(timeout)
+
+    @property
+    def ready(self) -> bool:
+        return self._engine is not None
+
+    def describe(self) -> dict:
+        elapsed = None
+        if self._started_at is not None:
+            elapsed = round((time.perf_counter() - self._started_at) * 1000, 1)
+        return {
+            "state": self.state,
+            "ready": self.ready,
+            "error": self.error,
+            "elapsed_ms": elapsed,
+            "timings": dict(self.timings),
+        }
+
+    # ---------------- 内部辅助 -----------------
+    def _run(self):
+        try:
+            t0 = time.perf_counter()
+            from .sam_engine import SamEngine
+            t1 = time.perf_counter()
+            engine = SamEngine()
+            t2 = time.perf_counter()
+            self.timings.update(import_ms=round((t1 - t0) * 1000, 1), load_ms=round((t2 - t1) * 1000, 1))
+            if self.warmup:
+                self.state = "warming"
+                self.timings.update(engine.warmup())
+                self.timings["warmup_ms"] = round((time.perf_counter() - t2) * 1000, 1)
+            self.timings["total_ms"] = round((time.perf_counter() - self._started_at) * 1000, 1)
+            self._engine = engine
+            self.state = "ready"
+            print(f"[SAM][Loader] ready import={self.timings['import_ms']}ms load={self.timings['load_ms']}ms "
+                  f"warmup={self.timings.get('warmup_ms', 'skipped')}{'ms' if self.warmup else ''} total={self.timings['total_ms']}ms")
+        except Exception as e:
+            # 部分异常（如 concurrent.futures.TimeoutError）没有消息文本，带上类型名
+            self.error = f"{type(e).__name__}: {e}"
+            self.state = "failed"
+            print(f"[SAM][Loader] failed: {self.error}")
+        finally:
+            self._ready.set()
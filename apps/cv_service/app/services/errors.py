@@ -0,0 +1,26 @@
+"""
+SAM 服务共用的异常类型（不依赖 torch，路由层可以在模型加载前导入）
+"""
+
+
+class SessionNotReady(RuntimeError):
+    """会话的 embedding 尚未就绪（pending）或已失败（failed）。"""
+    def __init__(self, session_id: str, status: str, detail: str):
+        super().__init__(detail)
+        self.session_id = session_id
+        self.status = status
+
+
+class EngineNotReady(RuntimeError):
+    """SAM 引擎仍在后台加载/预热（loading / warming），或加载失败（failed）。"""
+    def __init__(self, state: str, detail: str):
+        super().__init__(detail)
+        self.state = state
+
+
+class InferenceQueueFull(RuntimeError):
+    """推理队列已满或排队超时，客户端应在 retry_after 秒后重试。"""
+    def __init__(self, depth: int, retry_after: int):
+        super().__init__(f"Inference queue is full ({depth} waiting), retry later")
+        self.depth = depth
+        self.retry_after = retry_after
@@ -0,0 +1,139 @@
+"""
+异步导出任务：批量 ROI 导出交给线程池执行，接口立即返回任务 ID，前端轮询状态/结果
+
+- 每个导出项（掩码 + roi_box + roi_index + feather_px）是一个独立任务，批内各项并行
+- 掩码解码、裁剪、距离变换柔化、PNG 编码都在 OpenCV 里执行并释放 GIL，线程池即可用满多核
+- SAM_EXPORT_WORKERS：工作线程数（0 = 自动，min(4, CPU 核数)）
+- SAM_EXPORT_QUEUE：允许排队/执行中的任务上限，超出时拒绝（路由层返回 429 + Retry-After）
+- SAM_EXPORT_HISTORY：保留的已结束任务数，超出后最早结束的任务被清理（查询返回 404）
+"""
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from .errors import InferenceQueueFull
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+class ExportJob:
+    """一个导出项的状态：queued -> running -> done | failed。"""
+
+    def __init__(self, session_id: str, roi_index: int):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.roi_index = roi_index
+        self.status = "queued"
+        self.result: Optional[dict] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.done_event = threading.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def describe(self) -> dict:
+        out = {"job_id": self.id, "session_id": self.session_id, "roi_index": self.roi_index,
+               "status": self.status, "error": self.error}
+        if self.started_at is not None:
+            out["queued_ms"] = round((self.started_at - self.created_at) * 1000, 1)
+        if self.finished_at is not None and self.started_at is not None:
+            out["elapsed_ms"] = round((self.finished_at - self.started_at) * 1000, 1)
+        if self.result:
+            out.update(self.result)
+        return out
+
+
+class ExportJobQueue:
+    def __init__(self, workers: Optional[int] = None, max_pending: Optional[int] = None,
+                 history: Optional[int] = None):
+        if workers is None:
+            workers = _env_int("SAM_EXPORT_WORKERS", 0)
+        if workers <= 0:
+            workers = min(4, os.cpu_count() or 1)
+        self.workers = workers
+        self.max_pending = max(1, _env_int("SAM_EXPORT_QUEUE", 64) if max_pending is None else max_pending)
+        self.history = max(1, _env_int("SAM_EXPORT_HISTORY", 256) if history is None else history)
+        # 线程按需创建，服务启动时不占资源
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sam-export")
+        self._lock = threading.Lock()
+        self._jobs: "OrderedDict[str, ExportJob]" = OrderedDict()
+        self._pending = 0
+        self._finished: "OrderedDict[str, None]" = OrderedDict()   # 按结束顺序，用于清理
+        self._counts: Dict[str, int] = {"submitted": 0, "done": 0, "failed": 0, "rejected": 0}
+
+    def submit(self, session_id: str, tasks: List[tuple]) -> List[ExportJob]:
+        """tasks 为 [(roi_index, fn), ...]，fn() 返回结果字典（sprite_path、bbox 等）。
+        整批要么全部入队，要么（超过 SAM_EXPORT_QUEUE）整批拒绝。"""
+        with self._lock:
+            if self._pending + len(tasks) > self.max_pending:
+                self._counts["rejected"] += len(tasks)
+                raise InferenceQueueFull(self._pending, self.retry_after())
+            jobs = [ExportJob(session_id, roi_index) for roi_index, _ in tasks]
+            for job in jobs:
+                self._jobs[job.id] = job
+            self._pending += len(jobs)
+            self._counts["submitted"] += len(jobs)
+        for job, (_, fn) in zip(jobs, tasks):
+            self._executor.submit(self._run, job, fn)
+        return jobs
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """共享的导出线程池（/sam/split 用它并行编码各元素的 sprite）。"""
+        return self._executor
+
+    def get(self, job_id: str) -> Optional[ExportJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def wait(self, jobs: List[ExportJob], timeout: float):
+        """等待这些任务结束，最多 timeout 秒（长轮询用）。"""
+        deadline = time.monotonic() + max(0.0, timeout)
+        for job in jobs:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            job.done_event.wait(remaining)
+
+    def retry_after(self) -> int:
+        # 粗略估计：排队任务按 worker 数分摊，每个约 1 秒
+        return max(1, self._pending // self.workers)
+
+    def stats(self) -> dict:
+        with self._lock:
+            running = sum(1 for j in self._jobs.values() if j.status == "running")
+            return {"workers": self.workers, "pending": self._pending, "running": running,
+                    "max_pending": self.max_pending, "tracked": len(self._jobs), **self._counts}
+
+    def _run(self, job: ExportJob, fn: Callable[[], dict]):
+        job.started_at = time.time()
+        job.status = "running"
+        try:
+            job.result = fn()
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e) or type(e).__name__
+            job.status = "failed"
+            print(f"[SAM][Export] job={job.id[:8]} sid={job.session_id[:8]} roi={job.roi_index} failed: {job.error}")
+        job.finished_at = time.time()
+        with self._lock:
+            self._pending -= 1
+            self._counts[job.status] += 1
+            self._finished[job.id] = None
+            while len(self._finished) > self.history:
+                old, _ = self._finished.popitem(last=False)
+                self._jobs.pop(old, None)
+        job.done_event.set()
@@ -0,0 +1,46 @@
+"""
+摄像头连拍的画面变化检测：画面基本没变时跳过重新编码
+
+- 签名：灰度图按面积插值缩到 SIG_SIZE x SIG_SIZE，再减去均值（抵消自动曝光带来的整体亮度漂移）
+- 变化量 frame_delta：签名中差异超过 SAM_FRAME_PIXEL_THRESH（0~1）的格子所占比例
+- frame_delta < SAM_FRAME_CHANGE_THRESH 时认为画面未变；阈值为 0 时关闭检测，每帧都重新编码
+- 总是与会话“上一次编码的帧”比较，而不是上一帧，缓慢累积的变化最终仍会触发重新编码
+"""
+import os
+from typing import Optional
+
+import cv2
+import numpy as np
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+class FrameChangeDetector:
+    def __init__(self, change_thresh: Optional[float] = None, pixel_thresh: Optional[float] = None,
+                 size: Optional[int] = None):
+        self.change_thresh = _env_float("SAM_FRAME_CHANGE_THRESH", 0.01) if change_thresh is None else change_thresh
+        self.pixel_thresh = _env_float("SAM_FRAME_PIXEL_THRESH", 0.08) if pixel_thresh is None else pixel_thresh
+        self.size = max(8, int(_env_float("SAM_FRAME_SIG_SIZE", 64) if size is None else size))
+
+    @property
+    def enabled(self) -> bool:
+        return self.change_thresh > 0
+
+    def signature(self, image_bgr: np.ndarray) -> np.ndarray:
+        gray = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2GRAY) if image_bgr.ndim == 3 else image_bgr
+        small = cv2.resize(gray, (self.size, self.size), interpolation=cv2.INTER_AREA).astype(np.float32) / 255.0
+        return small - small.mean()
+
+    def delta(self, prev: Optional[np.ndarray], sig: np.ndarray) -> float:
+        """两帧签名的变化比例（0~1）；没有可比较的旧签名时返回 1。"""
+        if prev is None or prev.shape != sig.shape:
+            return 1.0
+        return float((np.abs(sig - prev) > self.pixel_thresh).mean())
+
+    def unchanged(self, delta: float) -> bool:
+        return self.enabled and delta < self.change_thresh
@@ -0,0 +1,120 @@
+"""
+统一的图像解码：路径 / base64 / 上传字节共用，按目标最大边选择缩小解码
+
+- 先用 PIL 只读文件头拿到尺寸与格式（不解码像素）
+- JPEG 且远大于 max_side 时用 cv2.IMREAD_REDUCED_COLOR_2/4/8 在 DCT 域直接按 1/2、1/4、1/8 解码，
+  选择仍不小于 max_side 的最大缩小倍数，最后再做一次小幅 INTER_AREA 缩放
+- 其他格式（PNG 等）没有 DCT 缩小解码，照常全尺寸解码后缩放
+- SAM_DECODE_REDUCED=0 关闭缩小解码
+- 缩小解码或缩放时保留原始编码字节（encoded），放大模式需要源图细节时再用 decode_full 全尺寸解码
+"""
+import base64
+import io
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+_REDUCED_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+@dataclass
+class DecodedImage:
+    image: np.ndarray                      # 缩放到 max_side 以内的 BGR 图
+    source: Optional[np.ndarray]           # 最终缩放前的解码结果（未缩放时为 None，与 image 相同）
+    original_size: Optional[Tuple[int, int]]  # 文件头中的 (w, h)，读不到时为 None
+    scale_denom: int = 1                   # 缩小解码倍数：1 | 2 | 4 | 8
+    timings: dict = field(default_factory=dict)
+    encoded: Optional[bytes] = None        # 原始编码字节（路径输入时为读入的文件内容），未缩小/缩放时为 None
+
+    @property
+    def resized(self) -> bool:
+        return self.source is not None
+
+    def zoom_source(self, keep_decoded: bool = True):
+        """会话为放大模式保留的源图，返回 (source_bgr, source_bytes)：
+        keep_decoded 且全尺寸解码时直接保留缩放前的解码结果；否则（缩小解码的 source 本身已是低分辨率，
+        或放大模式未自动开启、不值得常驻一份全尺寸 BGR）只保留编码字节，首次放大时再 decode_full。"""
+        if not self.resized and self.scale_denom == 1:
+            return None, None                  # image 就是全尺寸图
+        if keep_decoded and self.scale_denom == 1:
+            return self.source, None
+        return None, self.encoded
+
+
+def reduced_decode_enabled() -> bool:
+    return os.getenv("SAM_DECODE_REDUCED", "1").lower() in ("1", "true", "yes")
+
+
+def b64_to_bytes(image_b64: str) -> bytes:
+    """dataURL 或纯 base64 -> 原始编码字节。"""
+    if "," in image_b64:
+        image_b64 = image_b64.split(",", 1)[1]
+    return base64.b64decode(image_b64)
+
+
+def probe(data: Optional[bytes] = None, path: Optional[str] = None):
+    """只读文件头，返回 ((w, h), 格式)；失败时返回 (None, None)。"""
+    try:
+        with Image.open(io.BytesIO(data) if data is not None else path) as im:
+            return im.size, (im.format or "").upper()
+    except Exception:
+        return None, None
+
+
+def reduction_factor(long_side: int, max_side: int) -> int:
+    """缩小解码后最长边仍 >= max_side 的最大倍数。"""
+    for denom in (8, 4, 2):
+        if long_side // denom >= max_side:
+            return denom
+    return 1
+
+
+def decode_image(data: Optional[bytes] = None, path: Optional[str] = None, max_side: Optional[int] = None,
+                 reduce: bool = True) -> DecodedImage:
+    """解码编码字节或文件，并把最长边限制到 max_side。reduce=False 时总是全尺寸解码（放大模式需要源图细节）。"""
+    if data is None and not path:
+        raise ValueError("One of image_path, image_b64 or an uploaded image must be provided.")
+    t0 = time.perf_counter()
+    size, fmt = probe(data, path)
+    denom = 1
+    if reduce and max_side and max_side > 0 and size and fmt == "JPEG" and reduced_decode_enabled():
+        denom = reduction_factor(max(size), max_side)
+    flag = _REDUCED_FLAGS.get(denom, cv2.IMREAD_COLOR)
+    if data is None:
+        # 先读字节再解码（与 imread 同样快），缩小解码时字节要留给放大模式
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            raise ValueError(f"Failed to read image: {path}")
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+    if img is None:
+        raise ValueError(f"Failed to read image: {path}" if path else "Failed to decode image data")
+    t1 = time.perf_counter()
+    decoded = img
+    h0, w0 = img.shape[:2]
+    if max_side and max_side > 0 and max(h0, w0) > max_side:
+        scale = max_side / max(h0, w0)
+        img = cv2.resize(img, (int(w0*scale), int(h0*scale)), interpolation=cv2.INTER_AREA)
+    t2 = time.perf_counter()
+    return DecodedImage(
+        image=img,
+        source=decoded if img is not decoded else None,
+        original_size=size,
+        scale_denom=denom,
+        timings={"decode_ms": round((t1-t0)*1000, 1), "resize_ms": round((t2-t1)*1000, 1), "decode_scale": denom},
+        encoded=data if denom > 1 or img is not decoded else None,
+    )
+
+
+def decode_full(data: bytes) -> np.ndarray:
+    """全尺寸解码编码字节（放大模式的源图）。"""
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Failed to decode source image")
+    return img
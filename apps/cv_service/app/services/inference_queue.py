@@ -0,0 +1,136 @@
+"""
+全局推理准入队列：限制同时进行的编码/解码数量，排队过长时直接拒绝（路由层返回 429 + Retry-After）
+
+- SAM_INFER_CONCURRENCY：同时执行的解码数（0 = 自动：推理池 worker 数，无推理池时为 1）
+- SAM_EMBED_CONCURRENCY：同时执行的编码数，与解码名额分开计算（0 = 同 SAM_INFER_CONCURRENCY）
+- SAM_INFER_QUEUE：每类（编码 / 解码）允许排队等待的请求数，超出立即拒绝
+- SAM_INFER_QUEUE_TIMEOUT：单个请求最多排队秒数，超时同样拒绝
+- 统计排队深度、等待/执行耗时（最近 256 次的均值与 p95），供 /sam/stats 查看
+"""
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from .errors import InferenceQueueFull
+
+_WINDOW = 256
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _summary(samples: deque) -> dict:
+    if not samples:
+        return {"avg_ms": None, "p95_ms": None}
+    ordered = sorted(samples)
+    return {
+        "avg_ms": round(sum(ordered) / len(ordered), 1),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 1),
+    }
+
+
+class _Budget:
+    """一类推理（编码或解码）的名额与排队计数。"""
+
+    def __init__(self, name: str, concurrency: int):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.slots = threading.Semaphore(self.concurrency)
+        self.waiting = 0
+        self.running = 0
+        self.max_waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_ms: deque = deque(maxlen=_WINDOW)
+
+
+class InferenceQueue:
+    def __init__(self, concurrency: int = 1, max_queue: Optional[int] = None, timeout: Optional[float] = None,
+                 embed_concurrency: Optional[int] = None):
+        """concurrency：解码类请求（decode / decode_batch / decode_final / auto）的名额；
+        embed_concurrency：编码类请求（embed / embed_final）的独立名额，缺省取 SAM_EMBED_CONCURRENCY（0 = 同 concurrency）。
+        两类各自排队、各自计算队列长度：一个会话耗时数秒的编码不会占住其他会话点击的解码名额。"""
+        if max_queue is None:
+            max_queue = int(_env_float("SAM_INFER_QUEUE", 8))
+        if timeout is None:
+            timeout = _env_float("SAM_INFER_QUEUE_TIMEOUT", 30)
+        if embed_concurrency is None:
+            embed_concurrency = int(_env_float("SAM_EMBED_CONCURRENCY", 0))
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max(0, max_queue)
+        self.timeout = timeout
+        self._budgets = {"decode": _Budget("decode", self.concurrency),
+                         "embed": _Budget("embed", embed_concurrency if embed_concurrency > 0 else self.concurrency)}
+        self._lock = threading.Lock()
+        self._run_ms: Dict[str, deque] = {}
+
+    @staticmethod
+    def budget_of(kind: str) -> str:
+        return "embed" if kind.startswith("embed") else "decode"
+
+    @contextmanager
+    def slot(self, kind: str, reject: bool = True):
+        """占用一个推理名额（按 kind 归入编码或解码预算）。reject=False 用于后台任务：不受队列长度限制，一直等到有空位。"""
+        b = self._budgets[self.budget_of(kind)]
+        t0 = time.perf_counter()
+        # 有空位直接占用；否则进入排队，队列已满时立即拒绝
+        acquired = b.slots.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                if reject and b.waiting >= self.max_queue:
+                    b.rejected += 1
+                    raise InferenceQueueFull(b.waiting, self._retry_after(b))
+                b.waiting += 1
+                b.max_waiting = max(b.max_waiting, b.waiting)
+            acquired = b.slots.acquire(timeout=self.timeout if reject else None)
+            with self._lock:
+                b.waiting -= 1
+                if not acquired:
+                    b.rejected += 1
+                    raise InferenceQueueFull(b.waiting, self._retry_after(b))
+        t1 = time.perf_counter()
+        with self._lock:
+            b.running += 1
+            b.admitted += 1
+            b.wait_ms.append((t1 - t0) * 1000)
+        try:
+            yield
+        finally:
+            with self._lock:
+                b.running -= 1
+                self._run_ms.setdefault(kind, deque(maxlen=_WINDOW)).append((time.perf_counter() - t1) * 1000)
+            b.slots.release()
+
+    def retry_after(self, kind: str = "decode") -> int:
+        return self._retry_after(self._budgets[self.budget_of(kind)])
+
+    def _retry_after(self, b: _Budget) -> int:
+        """按该预算的排队深度与平均执行时间估算客户端重试前应等待的秒数（至少 1 秒）。"""
+        runs = [v for k, d in self._run_ms.items() if self.budget_of(k) == b.name for v in d]
+        avg_s = (sum(runs) / len(runs) / 1000) if runs else 1.0
+        return max(1, int(round(avg_s * (b.waiting + 1) / b.concurrency)))
+
+    def stats(self) -> dict:
+        with self._lock:
+            budgets = self._budgets.values()
+            return {
+                "concurrency": self.concurrency,
+                "max_queue": self.max_queue,
+                "depth": sum(b.waiting for b in budgets),
+                "max_depth": max(b.max_waiting for b in budgets),
+                "running": sum(b.running for b in budgets),
+                "admitted": sum(b.admitted for b in budgets),
+                "rejected": sum(b.rejected for b in budgets),
+                "budgets": {name: {"concurrency": b.concurrency, "depth": b.waiting, "max_depth": b.max_waiting,
+                                   "running": b.running, "admitted": b.admitted, "rejected": b.rejected,
+                                   "wait": _summary(b.wait_ms)}
+                            for name, b in self._budgets.items()},
+                "run": {kind: _summary(d) for kind, d in self._run_ms.items()},
+            }
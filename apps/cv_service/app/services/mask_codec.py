@@ -0,0 +1,103 @@
+"""
+掩码的紧凑内联编码：segment 响应直接携带候选掩码，前端不必再逐个 GET /sam/mask/... 下载整幅 PNG
+
+- 只编码掩码外接框内的部分，附带 bbox 偏移 (x0,y0,x1,y1)（x1/y1 不含）
+- rle：COCO 风格未压缩 RLE，按列优先（Fortran 序）展开，counts 从 0 的游程开始
+- bitmap：裁剪区域按行优先 np.packbits 后 base64
+- 轮廓：只需要描边的预览叠加可以直接拿简化后的多边形（含孔洞），不用下载位图
+"""
+import base64
+
+import cv2
+import numpy as np
+
+from .postprocess import mask_bbox
+
+FORMATS = ("rle", "bitmap")
+
+
+def rle_counts(mask01: np.ndarray) -> list:
+    """列优先展开后的游程长度，第一个数是 0 的游程（可以为 0）。"""
+    flat = mask01.ravel(order="F").astype(np.uint8)
+    if flat.size == 0:
+        return []
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate([[0], change, [flat.size]])
+    counts = np.diff(bounds).tolist()
+    if flat[0]:
+        counts.insert(0, 0)
+    return counts
+
+
+def encode_mask(mask: np.ndarray, fmt: str) -> dict:
+    """把 0/1 掩码编码为 {format, bbox, size, counts | data}；空掩码时 bbox 为 None。"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported mask_format: {fmt} (expected one of {FORMATS})")
+    m = mask > 0
+    box = mask_bbox(m)
+    if box is None:
+        return {"format": fmt, "bbox": None, "size": [0, 0]}
+    x0, y0, x1, y1 = box
+    crop = m[y0:y1, x0:x1]
+    out = {"format": fmt, "bbox": [x0, y0, x1, y1], "size": [y1 - y0, x1 - x0]}
+    if fmt == "rle":
+        out["counts"] = rle_counts(crop)
+    else:
+        out["data"] = base64.b64encode(np.packbits(crop, axis=None).tobytes()).decode("ascii")
+    return out
+
+
+def decode_mask(payload: dict, height: int, width: int) -> np.ndarray:
+    """encode_mask 的逆过程，还原为整幅 (height,width) 的 uint8 0/1 掩码。"""
+    mask = np.zeros((height, width), dtype=np.uint8)
+    if not payload.get("bbox"):
+        return mask
+    x0, y0, x1, y1 = payload["bbox"]
+    ch, cw = payload["size"]
+    if payload["format"] == "rle":
+        values = np.zeros(len(payload["counts"]), dtype=np.uint8)
+        values[1::2] = 1
+        crop = np.repeat(values, payload["counts"]).reshape((ch, cw), order="F")
+    else:
+        bits = np.unpackbits(np.frombuffer(base64.b64decode(payload["data"]), np.uint8), count=ch * cw)
+        crop = bits.reshape(ch, cw)
+    mask[y0:y1, x0:x1] = crop
+    return mask
+
+
+def mask_polygons(mask: np.ndarray, tolerance: float = 1.5, min_area: float = 4.0) -> list:
+    """掩码轮廓矢量化：findContours(RETR_CCOMP) 得到外轮廓与孔洞两级结构，
+    approxPolyDP（Douglas-Peucker，tolerance 像素）简化。
+    返回 [{"outer": [[x,y],...], "holes": [[[x,y],...], ...]}]，整图坐标。"""
+    m = (mask > 0).astype(np.uint8)
+    box = mask_bbox(m)
+    if box is None:
+        return []
+    x0, y0, x1, y1 = box
+    contours, hierarchy = cv2.findContours(np.ascontiguousarray(m[y0:y1, x0:x1]), cv2.RETR_CCOMP,
+                                           cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+    if hierarchy is None:
+        return []
+    hierarchy = hierarchy[0]
+
+    def simplify(i):
+        if cv2.contourArea(contours[i]) < min_area:
+            return None
+        poly = cv2.approxPolyDP(contours[i], tolerance, True).reshape(-1, 2)
+        return poly.tolist() if len(poly) >= 3 else None
+
+    polygons = []
+    for i, (_, _, child, parent) in enumerate(hierarchy):
+        if parent != -1:
+            continue
+        outer = simplify(i)
+        if outer is None:
+            continue
+        holes = []
+        while child != -1:
+            hole = simplify(child)
+            if hole is not None:
+                holes.append(hole)
+            child = hierarchy[child][0]
+        polygons.append({"outer": outer, "holes": holes})
+    return polygons
@@ -0,0 +1,234 @@
+"""
+会话内的候选掩码存储（内存）与掩码登记表
+
+- segment 产出的 0/1 掩码直接留在内存，不再逐个 PNG 编码落盘
+- 只有前端真正 GET /sam/mask/... 时才编码 PNG，并缓存编码结果
+- 超出字节预算时按 LRU 淘汰；开启 spill 时淘汰项写到磁盘（<tmp_dir>/<mask_id>.png）
+- MaskRegistry：mask_id -> 元数据（类型、分数、父掩码、logits、存储位置），O(1) 查找，替代目录 glob
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+
+
+@dataclass
+class _Entry:
+    mask: np.ndarray                  # uint8 0/1，(H,W)
+    png: Optional[bytes] = None       # 懒编码后的 PNG
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.mask.nbytes) + (len(self.png) if self.png else 0)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+class MaskStore:
+    def __init__(self, spill_dir: Optional[Path] = None, max_bytes: Optional[int] = None,
+                 spill: Optional[bool] = None):
+        if max_bytes is None:
+            max_bytes = _env_int("SAM_MASK_STORE_MB", 64) * 1024 * 1024
+        if spill is None:
+            spill = os.getenv("SAM_MASK_SPILL", "1").lower() in ("1", "true", "yes")
+        self.max_bytes = max(0, max_bytes)
+        self.spill_dir = spill_dir if spill else None
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._spilled: set = set()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, mask_id: str, mask01: np.ndarray, copy: bool = True):
+        """copy=False 时直接引用调用方的 uint8 0/1 数组（笔刷链的可写掩码），不做整图拷贝。"""
+        entry = _Entry(mask=(mask01 > 0).astype(np.uint8) if copy else mask01)
+        with self._lock:
+            self._drop(mask_id)
+            self._entries[mask_id] = entry
+            self._bytes += entry.nbytes
+            self._evict()
+
+    def get(self, mask_id: str) -> Optional[np.ndarray]:
+        """返回 0/1 掩码；内存中没有时尝试读 spill 文件。"""
+        with self._lock:
+            entry = self._entries.get(mask_id)
+            if entry is not None:
+                self._entries.move_to_end(mask_id)
+                return entry.mask
+        path = self.spill_path(mask_id)
+        if path is None or mask_id not in self._spilled:
+            return None
+        mk = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+        return None if mk is None else (mk > 127).astype(np.uint8)
+
+    def get_png(self, mask_id: str) -> Optional[bytes]:
+        """返回 PNG 字节：首次访问时编码并缓存。"""
+        with self._lock:
+            entry = self._entries.get(mask_id)
+            if entry is not None:
+                self._entries.move_to_end(mask_id)
+                if entry.png is None:
+                    ok, buf = cv2.imencode(".png", entry.mask * 255)
+                    if not ok:
+                        return None
+                    entry.png = buf.tobytes()
+                    self._bytes += len(entry.png)
+                    self._evict(keep=mask_id)
+                return entry.png
+        path = self.spill_path(mask_id)
+        if path is None or mask_id not in self._spilled:
+            return None
+        return path.read_bytes()
+
+    def discard(self, mask_id: str):
+        with self._lock:
+            self._drop(mask_id)
+            spilled = mask_id in self._spilled
+            self._spilled.discard(mask_id)
+        if spilled:
+            self.spill_path(mask_id).unlink(missing_ok=True)
+
+    def clear(self):
+        with self._lock:
+            spilled = list(self._spilled)
+            self._entries.clear()
+            self._spilled.clear()
+            self._bytes = 0
+        for mask_id in spilled:
+            self.spill_path(mask_id).unlink(missing_ok=True)
+
+    def location(self, mask_id: str) -> Optional[str]:
+        """memory | disk | None"""
+        if mask_id in self._entries:
+            return "memory"
+        if mask_id in self._spilled:
+            return "disk"
+        return None
+
+    def spill_path(self, mask_id: str) -> Optional[Path]:
+        return self.spill_dir / f"{mask_id}.png" if self.spill_dir is not None else None
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    # ---------------- 内部辅助 -----------------
+    def _drop(self, mask_id: str):
+        old = self._entries.pop(mask_id, None)
+        if old is not None:
+            self._bytes -= old.nbytes
+
+    def _evict(self, keep: Optional[str] = None):
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            mask_id, entry = next(iter(self._entries.items()))
+            if mask_id == keep:
+                self._entries.move_to_end(mask_id)
+                mask_id, entry = next(iter(self._entries.items()))
+            self._entries.pop(mask_id)
+            self._bytes -= entry.nbytes
+            self._spill(mask_id, entry)
+
+    def _spill(self, mask_id: str, entry: _Entry):
+        path = self.spill_path(mask_id)
+        if path is None:
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if entry.png is not None:
+                path.write_bytes(entry.png)
+            else:
+                cv2.imwrite(str(path), entry.mask * 255)
+            self._spilled.add(mask_id)
+        except Exception as e:
+            print(f"[SAM][MaskStore] spill {mask_id[:8]} failed: {e}")
+
+
+@dataclass
+class MaskRecord:
+    mask_id: str
+    kind: str                          # candidate（segment 候选）| refined（笔刷细化）| auto（整图自动分割）
+    score: Optional[float] = None
+    parent: Optional[str] = None       # 由哪个掩码细化而来
+    logits: Optional[np.ndarray] = None  # SAM 低分辨率 logits (256,256)，作为下一轮 mask_input
+    tier: Optional[str] = None         # 产生该掩码的模型档位：preview | final
+    prompt: Optional[dict] = None      # 生成时的提示（points/labels/box...），用于在最终档上重新解码
+    created_at: float = field(default_factory=time.time)
+
+
+class MaskRegistry:
+    """会话内 mask_id -> MaskRecord 的登记表，像素数据放在 MaskStore 里。"""
+
+    def __init__(self, spill_dir: Optional[Path] = None):
+        self.store = MaskStore(spill_dir=spill_dir)
+        self._records: Dict[str, MaskRecord] = {}
+        self._lock = threading.Lock()
+
+    def register(self, mask01: np.ndarray, record: MaskRecord, copy: bool = True) -> MaskRecord:
+        self.store.put(record.mask_id, mask01, copy=copy)
+        with self._lock:
+            self._records[record.mask_id] = record
+        return record
+
+    def get(self, mask_id: str) -> Optional[MaskRecord]:
+        return self._records.get(mask_id)
+
+    def __contains__(self, mask_id: str) -> bool:
+        return mask_id in self._records
+
+    def mask(self, mask_id: str) -> Optional[np.ndarray]:
+        if mask_id not in self._records:
+            return None
+        return self.store.get(mask_id)
+
+    def png(self, mask_id: str) -> Optional[bytes]:
+        if mask_id not in self._records:
+            return None
+        return self.store.get_png(mask_id)
+
+    def discard(self, mask_id: str):
+        with self._lock:
+            self._records.pop(mask_id, None)
+        self.store.discard(mask_id)
+
+    def drop_kind(self, kind: str, keep: Optional[str] = None) -> int:
+        """丢弃某一类掩码（如上一轮的 candidate），返回丢弃数量。"""
+        with self._lock:
+            stale = [m for m, r in self._records.items() if r.kind == kind and m != keep]
+            for mask_id in stale:
+                self._records.pop(mask_id, None)
+        for mask_id in stale:
+            self.store.discard(mask_id)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+        self.store.clear()
+
+    def describe(self) -> List[dict]:
+        with self._lock:
+            records = list(self._records.values())
+        return [{
+            "mask_id": r.mask_id,
+            "kind": r.kind,
+            "score": r.score,
+            "parent": r.parent,
+            "has_logits": r.logits is not None,
+            "tier": r.tier,
+            "location": self.store.location(r.mask_id),
+            "created_at": r.created_at,
+        } for r in records]
+
+    @property
+    def nbytes(self) -> int:
+        return self.store.nbytes
@@ -0,0 +1,277 @@
+"""
+单个 SAM 模型档位（tier）：模型 + 共享 predictor + 编码器精度模式 + 解码器后端
+
+SamEngine 可以同时持有两个档位：
+- preview：小模型（如 vit_b），负责交互式 /sam/segment 预览
+- final：大模型（如 vit_h），负责 /sam/export-roi 的最终掩码
+只配置一个模型时两者是同一个档位。
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+import torch
+from segment_anything import sam_model_registry, SamPredictor
+
+from .embedding_cache import EmbeddingCache, CachedEmbedding
+from .onnx_decoder import OnnxDecoder
+from .encoder_modes import resolve_mode, quantize_encoder, encoder_context, compare_with_fp32
+
+
+@dataclass
+class Embedding:
+    """会话的图像 embedding 记录：只保存 features 与尺寸，不持有 SamPredictor。"""
+    features: torch.Tensor            # (1,256,64,64)，可为 fp16 压缩存储
+    original_size: Tuple[int, int]    # (h, w)
+    input_size: Tuple[int, int]       # ResizeLongestSide 之后的 (h, w)
+
+    @property
+    def nbytes(self) -> int:
+        return self.features.element_size() * self.features.nelement()
+
+
+class ModelTier:
+    def __init__(self, name: str, model_type: str, weights_path: str, device: str, embed_cache: Optional[EmbeddingCache],
+                 embed_fp16: bool = False, encoder_mode: str = "fp32", decoder_backend: str = "torch",
+                 model=None, pooled: bool = False, in_worker: bool = False):
+        """model：直接使用已加载（共享内存中）的模型，推理池 worker 用；
+        pooled：编码/解码交给推理池，本进程保留 fp32 权重作为共享源；
+        in_worker：在推理池 worker 内构建，跳过启动基准与 ONNX 校验（父进程已做过）。"""
+        if model is None and (not weights_path or not os.path.exists(weights_path)):
+            raise RuntimeError(f"SAM weights not found for {name} tier: {weights_path}")
+        self.name = name
+        self.model_type = model_type
+        self.weights_path = weights_path
+        self.device = device
+        self.embed_cache = embed_cache
+        self.embed_fp16 = embed_fp16
+        self.pooled = pooled
+        self.pool = None  # InferencePool，SAM_INFER_WORKERS>0 时由 SamEngine 挂上
+        t0 = time.perf_counter()
+        self.model = model if model is not None else sam_model_registry[model_type](checkpoint=weights_path).to(device)
+        # 编码与解码各用一个 predictor（共享同一份模型权重）：编码器跑 set_image 的几秒内，
+        # 其他会话的解码只需要解码器的锁，不会排在编码后面
+        self._predictor = SamPredictor(self.model)
+        self._predictor_lock = threading.Lock()
+        self._encoder = SamPredictor(self.model)
+        self._encoder_lock = threading.Lock()
+        t1 = time.perf_counter()
+        if in_worker:
+            self.encoder_mode = encoder_mode
+            self.encoder_report = None
+            if encoder_mode == "int8":
+                self.model.image_encoder = quantize_encoder(self.model.image_encoder)
+            self.decoder_backend = decoder_backend
+            self._onnx = OnnxDecoder(self.model, model_type, weights_path) if decoder_backend == "onnx" else None
+            return
+        print(f"[SAM][Init] tier={name} model_type={model_type} device={device} cuda_available={torch.cuda.is_available()} load_time={(t1-t0)*1000:.1f}ms")
+        # 编码器精度模式：fp32（默认）| int8（CPU 动态量化 Linear）| bf16（autocast）
+        self.encoder_mode = resolve_mode(encoder_mode, device)
+        self.encoder_report: Optional[dict] = None
+        if self.encoder_mode != "fp32":
+            self._apply_encoder_mode()
+        # 解码器后端：torch（默认）| onnx（ONNX Runtime CPU，适合无 GPU 的展台机）
+        self.decoder_backend = decoder_backend
+        self._onnx: Optional[OnnxDecoder] = None
+        if self.decoder_backend == "onnx":
+            self._onnx = self._load_onnx_decoder()
+            if self._onnx is None:
+                self.decoder_backend = "torch"
+
+    @property
+    def cache_tag(self) -> str:
+        # 缓存 key 里的模型标识：不同模型/权重/编码器精度得到的 features 不能混用
+        tag = f"{self.model_type}/{Path(self.weights_path).stem}"
+        return tag if self.encoder_mode == "fp32" else f"{tag}/{self.encoder_mode}"
+
+    def cache_key(self, image_bgr: np.ndarray, max_side: Optional[int]) -> str:
+        return EmbeddingCache.make_key(image_bgr, max_side, self.cache_tag)
+
+    def describe(self) -> dict:
+        return {
+            "name": self.name,
+            "model_type": self.model_type,
+            "decoder_backend": self.decoder_backend,
+            "encoder_mode": self.encoder_mode,
+            "encoder_report": self.encoder_report,
+        }
+
+    # ---------------- 编码 -----------------
+    def embed(self, image_bgr: np.ndarray, key: str, affinity: Optional[str] = None) -> Tuple[Embedding, bool]:
+        """生成图像 embedding 记录：命中缓存则直接恢复 features/original_size/input_size，
+        否则跑编码器（本进程或推理池）并写入缓存。返回 (embedding, 是否命中)。"""
+        entry = self.embed_cache.get(key)
+        if entry is not None:
+            return self.make_embedding(torch.from_numpy(np.array(entry.features)), entry.original_size, entry.input_size), True
+        if self.pool is not None:
+            emb = self.pool.call(self.name, affinity, "encode_local", image_bgr)
+            emb = self.make_embedding(emb.features, emb.original_size, emb.input_size)
+        else:
+            emb = self.encode_local(image_bgr)
+        self.embed_cache.put(key, CachedEmbedding(
+            features=emb.features.cpu().numpy(),
+            original_size=emb.original_size,
+            input_size=emb.input_size,
+        ))
+        return emb, False
+
+    def encode_local(self, image_bgr: np.ndarray) -> Embedding:
+        """在本进程用编码专用的 predictor 跑编码器（不占解码 predictor 的锁）。"""
+        with self._encoder_lock, encoder_context(self.encoder_mode, self.device):
+            self._encoder.set_image(cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB))
+            emb = self.make_embedding(self._encoder.features, self._encoder.original_size, self._encoder.input_size)
+            self._encoder.reset_image()  # 不让 predictor 长期持有任何会话的 features
+        return emb
+
+    def warmup(self, image_bgr: np.ndarray) -> dict:
+        """跑一次编码 + 一次解码，让首个真实请求不再承担 kernel 选择/分配器初始化的开销。
+        推理池模式下每个 worker 各预热一次，取最慢的耗时。"""
+        if self.pool is not None:
+            results = self.pool.broadcast(self.name, "warmup", image_bgr)
+            return {k: max((r[k] for r in results), default=None) for k in ("embed_ms", "decode_ms")}
+        t0 = time.perf_counter()
+        emb = self.encode_local(image_bgr)
+        t1 = time.perf_counter()
+        h, w = image_bgr.shape[:2]
+        box = np.array([w * 0.25, h * 0.25, w * 0.75, h * 0.75], dtype=np.float32)
+        self.decode_local(emb, None, None, box, None, True)
+        t2 = time.perf_counter()
+        return {"embed_ms": round((t1 - t0) * 1000, 1), "decode_ms": round((t2 - t1) * 1000, 1)}
+
+    def make_embedding(self, features: torch.Tensor, original_size, input_size) -> Embedding:
+        features = features.detach().to(self.device)
+        features = features.half() if self.embed_fp16 else features.float()
+        return Embedding(features=features, original_size=tuple(original_size), input_size=tuple(input_size))
+
+    # ---------------- 解码 -----------------
+    @contextmanager
+    def bound_predictor(self, emb: Embedding):
+        """共享解码路径：持锁把会话的 embedding 换入 predictor，用完即清空。"""
+        with self._predictor_lock:
+            p = self._predictor
+            p.reset_image()
+            p.features = emb.features.float()
+            p.original_size = emb.original_size
+            p.input_size = emb.input_size
+            p.is_image_set = True
+            try:
+                yield p
+            finally:
+                p.reset_image()
+
+    def predict(self, emb: Embedding, **kwargs):
+        with self.bound_predictor(emb) as p:
+            return p.predict(**kwargs)
+
+    def decode(self, emb: Embedding, point_coords: Optional[np.ndarray], point_labels: Optional[np.ndarray],
+               box: Optional[np.ndarray], mask_input: Optional[np.ndarray], multimask: bool,
+               affinity: Optional[str] = None):
+        """单提示解码，按 SAM_DECODER 选择 ONNX Runtime 或 torch。返回 masks (C,H,W)、scores (C,)、logits (C,256,256)。"""
+        if self.pool is not None:
+            return self.pool.call(self.name, affinity, "decode_local", emb, point_coords, point_labels, box, mask_input, multimask)
+        return self.decode_local(emb, point_coords, point_labels, box, mask_input, multimask)
+
+    def decode_local(self, emb: Embedding, point_coords: Optional[np.ndarray], point_labels: Optional[np.ndarray],
+                     box: Optional[np.ndarray], mask_input: Optional[np.ndarray], multimask: bool):
+        if self._onnx is not None:
+            return self._onnx.predict(emb.features.float().cpu().numpy(), emb.original_size,
+                                      point_coords, point_labels, box, mask_input, multimask)
+        masks, scores, low_res = self.predict(emb, point_coords=point_coords, point_labels=point_labels, box=box,
+                                              mask_input=mask_input, multimask_output=multimask)
+        # 统一为 (K,H,W)
+        if masks.ndim == 2:
+            masks = masks[None, ...]
+            scores = np.array([float(scores)])
+            low_res = low_res[None, ...]
+        return masks, scores, low_res
+
+    @property
+    def batched(self) -> bool:
+        # ONNX 解码图的 batch 维固定为 1，只有 torch 路径支持一次 predict_torch 解多个提示
+        return self._onnx is None
+
+    def predict_batch(self, emb: Embedding, point_coords: Optional[np.ndarray], point_labels: Optional[np.ndarray],
+                      boxes: Optional[np.ndarray], multimask: bool, affinity: Optional[str] = None):
+        """一次 predict_torch 解码 B 个提示：point_coords (B,N,2)、point_labels (B,N)、boxes (B,4) 或 None，原图坐标。
+        返回 numpy 的 masks (B,C,H,W)、scores (B,C)、low_res_logits (B,C,256,256)。"""
+        if self.pool is not None:
+            return self.pool.call(self.name, affinity, "predict_batch_local", emb, point_coords, point_labels, boxes, multimask)
+        return self.predict_batch_local(emb, point_coords, point_labels, boxes, multimask)
+
+    def predict_batch_local(self, emb: Embedding, point_coords: Optional[np.ndarray], point_labels: Optional[np.ndarray],
+                            boxes: Optional[np.ndarray], multimask: bool):
+        with self.bound_predictor(emb) as p:
+            dev = p.device
+            coords_t = labels_t = None
+            if point_coords is not None:
+                coords_t = torch.as_tensor(p.transform.apply_coords(point_coords, p.original_size), dtype=torch.float, device=dev)
+                labels_t = torch.as_tensor(point_labels, dtype=torch.int, device=dev)
+            boxes_t = None
+            if boxes is not None:
+                boxes_t = torch.as_tensor(p.transform.apply_boxes(boxes, p.original_size), dtype=torch.float, device=dev)
+            masks, scores, low_res = p.predict_torch(coords_t, labels_t, boxes=boxes_t, multimask_output=multimask)
+            return masks.cpu().numpy(), scores.float().cpu().numpy(), low_res.float().cpu().numpy()
+
+    # ---------------- 内部辅助 -----------------
+    def _apply_encoder_mode(self):
+        """切换编码器到降精度模式，并（默认）用合成图对比 fp32 报告提速与掩码 IoU。"""
+        fp32_encoder = self.model.image_encoder
+        test_encoder = quantize_encoder(fp32_encoder) if self.encoder_mode == "int8" else fp32_encoder
+        if not self.pooled:
+            # 推理池模式下本进程保留 fp32 编码器作为共享权重，由各 worker 自行量化
+            self.model.image_encoder = test_encoder
+        if os.getenv("SAM_ENCODER_BENCH", "1").lower() in ("0", "false", "no"):
+            print(f"[SAM][EncoderMode] tier={self.name} mode={self.encoder_mode} (benchmark skipped)")
+            return
+
+        def encode_test(x):
+            with encoder_context(self.encoder_mode, self.device):
+                return test_encoder(x)
+
+        try:
+            self.encoder_report = compare_with_fp32(self.model, self.device, self.encoder_mode, fp32_encoder, encode_test)
+            r = self.encoder_report
+            print(f"[SAM][EncoderMode] tier={self.name} mode={r['mode']} fp32={r['fp32_ms']:.1f}ms {r['mode']}={r['mode_ms']:.1f}ms "
+                  f"speedup={r['speedup']}x mask_iou={r['mask_iou']:.4f} (min {r['mask_iou_min']:.4f})")
+        except Exception as e:
+            print(f"[SAM][EncoderMode] tier={self.name} mode={self.encoder_mode} benchmark failed: {e}")
+
+    def _load_onnx_decoder(self) -> Optional[OnnxDecoder]:
+        """加载（必要时导出）ONNX 解码器，并与 torch 路径比对；失败或误差超限时回退 torch。"""
+        try:
+            dec = OnnxDecoder(self.model, self.model_type, self.weights_path)
+        except Exception as e:
+            print(f"[SAM][ONNX] unavailable, falling back to torch decoder: {e}")
+            return None
+        if os.getenv("SAM_ONNX_VERIFY", "1").lower() in ("0", "false", "no"):
+            return dec
+        try:
+            min_iou = float(os.getenv("SAM_ONNX_MIN_IOU", "0.98"))
+        except ValueError:
+            min_iou = 0.98
+        # 固定随机 embedding + 固定提示，两条路径各跑一次
+        g = torch.Generator().manual_seed(0)
+        pe = self.model.prompt_encoder
+        feats = torch.randn(1, pe.embed_dim, *pe.image_embedding_size, generator=g)
+        emb = Embedding(features=feats.to(self.device), original_size=(768, 1024), input_size=(768, 1024))
+        pc = np.array([[400.0, 300.0]], dtype=np.float32)
+        pl = np.array([1], dtype=np.int32)
+        bx = np.array([200.0, 150.0, 700.0, 550.0], dtype=np.float32)
+        m_t, s_t, l_t = self.predict(emb, point_coords=pc, point_labels=pl, box=bx, multimask_output=True)
+        m_o, s_o, l_o = dec.predict(feats.numpy(), emb.original_size, pc, pl, bx, None, True)
+        inter = np.logical_and(m_t, m_o).sum(axis=(1, 2))
+        union = np.logical_or(m_t, m_o).sum(axis=(1, 2))
+        iou = float(np.min(np.where(union > 0, inter / np.maximum(union, 1), 1.0)))
+        logit_diff = float(np.max(np.abs(l_t - l_o)))
+        score_diff = float(np.max(np.abs(s_t - s_o)))
+        print(f"[SAM][ONNX] verify mask_iou={iou:.4f} max_logit_diff={logit_diff:.4f} max_score_diff={score_diff:.4f}")
+        if iou < min_iou:
+            print(f"[SAM][ONNX] mask IoU {iou:.4f} < {min_iou}, falling back to torch decoder")
+            return None
+        return dec
@@ -0,0 +1,118 @@
+"""
+SAM 提示编码器 + 掩码解码器的 ONNX Runtime 后端（CPU）
+
+- 首次使用时用 segment_anything.utils.onnx.SamOnnxModel 导出解码器，缓存到 SAM_ONNX_DIR
+- 图像编码器仍走 torch；这里只替换每次点击都要跑的解码部分，省掉 PyTorch eager 开销
+- 输出与 SamPredictor.predict 对齐：masks (C,H,W) bool、scores (C,)、low_res_logits (C,256,256)
+"""
+import os
+import warnings
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+from segment_anything.utils.transforms import ResizeLongestSide
+
+
+class OnnxDecoder:
+    def __init__(self, model, model_type: str, weights_path: str, cache_dir: Optional[str] = None,
+                 threads: Optional[int] = None):
+        import onnxruntime as ort
+
+        cache_dir = Path(cache_dir or os.getenv("SAM_ONNX_DIR", "assets/onnx"))
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self.onnx_path = cache_dir / f"sam_{model_type}_{Path(weights_path).stem}_decoder.onnx"
+        if not self.onnx_path.exists():
+            self.export(model, self.onnx_path)
+
+        if threads is None:
+            try:
+                threads = int(os.getenv("SAM_ORT_THREADS", "0"))
+            except ValueError:
+                threads = 0
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            opts.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(str(self.onnx_path), sess_options=opts,
+                                            providers=["CPUExecutionProvider"])
+        self.transform = ResizeLongestSide(model.image_encoder.img_size)
+        self.mask_threshold = float(model.mask_threshold)
+        self.mask_input_size = tuple(4 * x for x in model.prompt_encoder.image_embedding_size)
+        print(f"[SAM][ONNX] decoder={self.onnx_path} threads={threads or 'auto'}")
+
+    @staticmethod
+    def export(model, path: Path, opset: int = 17):
+        """导出解码器（points 数量为动态维度），先写临时文件再改名。"""
+        from segment_anything.utils.onnx import SamOnnxModel
+
+        import time
+        t0 = time.perf_counter()
+        onnx_model = SamOnnxModel(model, return_single_mask=False)
+        device = next(model.parameters()).device
+        embed_dim = model.prompt_encoder.embed_dim
+        embed_size = model.prompt_encoder.image_embedding_size
+        mask_input_size = [4 * x for x in embed_size]
+        dummy = {
+            "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float, device=device),
+            "point_coords": torch.randint(low=0, high=1024, size=(1, 5, 2), dtype=torch.float, device=device),
+            "point_labels": torch.randint(low=0, high=4, size=(1, 5), dtype=torch.float, device=device),
+            "mask_input": torch.randn(1, 1, *mask_input_size, dtype=torch.float, device=device),
+            "has_mask_input": torch.tensor([1], dtype=torch.float, device=device),
+            "orig_im_size": torch.tensor([1500, 2250], dtype=torch.float, device=device),
+        }
+        dynamic_axes = {"point_coords": {1: "num_points"}, "point_labels": {1: "num_points"}}
+        tmp = path.with_suffix(".tmp")
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", category=torch.jit.TracerWarning)
+            warnings.filterwarnings("ignore", category=UserWarning)
+            with open(tmp, "wb") as f:
+                torch.onnx.export(
+                    onnx_model, tuple(dummy.values()), f,
+                    export_params=True, verbose=False, opset_version=opset, do_constant_folding=True,
+                    input_names=list(dummy.keys()),
+                    output_names=["masks", "iou_predictions", "low_res_masks"],
+                    dynamic_axes=dynamic_axes,
+                )
+        os.replace(tmp, path)
+        print(f"[SAM][ONNX] exported decoder to {path} in {(time.perf_counter()-t0)*1000:.1f}ms")
+
+    def predict(self, features: np.ndarray, original_size: Tuple[int, int],
+                point_coords: Optional[np.ndarray] = None, point_labels: Optional[np.ndarray] = None,
+                box: Optional[np.ndarray] = None, mask_input: Optional[np.ndarray] = None,
+                multimask_output: bool = True):
+        """参数与 SamPredictor.predict 一致（原图坐标）。"""
+        coords, labels = [], []
+        if point_coords is not None:
+            coords.append(np.asarray(point_coords, dtype=np.float32).reshape(-1, 2))
+            labels.append(np.asarray(point_labels, dtype=np.float32).reshape(-1))
+        if box is not None:
+            # 框编码为左上/右下两个角点，label 2/3
+            coords.append(np.asarray(box, dtype=np.float32).reshape(2, 2))
+            labels.append(np.array([2, 3], dtype=np.float32))
+        else:
+            # 没有框时补一个 not-a-point 占位点（与 torch 路径 pad 行为一致）
+            coords.append(np.zeros((1, 2), dtype=np.float32))
+            labels.append(np.array([-1], dtype=np.float32))
+        onnx_coord = self.transform.apply_coords(np.concatenate(coords)[None, :, :], original_size).astype(np.float32)
+        onnx_label = np.concatenate(labels)[None, :].astype(np.float32)
+
+        if mask_input is not None:
+            onnx_mask = np.asarray(mask_input, dtype=np.float32).reshape(1, 1, *self.mask_input_size)
+            has_mask = np.ones(1, dtype=np.float32)
+        else:
+            onnx_mask = np.zeros((1, 1, *self.mask_input_size), dtype=np.float32)
+            has_mask = np.zeros(1, dtype=np.float32)
+
+        masks, scores, low_res = self.session.run(None, {
+            "image_embeddings": np.ascontiguousarray(features, dtype=np.float32),
+            "point_coords": onnx_coord,
+            "point_labels": onnx_label,
+            "mask_input": onnx_mask,
+            "has_mask_input": has_mask,
+            "orig_im_size": np.array(original_size, dtype=np.float32),
+        })
+        # 解码器总是输出 1 个单掩码 + 3 个多掩码，与 MaskDecoder.forward 相同的切片规则
+        sel = slice(1, None) if multimask_output else slice(0, 1)
+        return masks[0, sel] > self.mask_threshold, scores[0, sel], low_res[0, sel]
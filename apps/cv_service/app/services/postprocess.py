@@ -1,57 +1,197 @@
 """
 掩码平滑、生成软边 alpha、保存 RGBA、以及命名工具
 
+- 平滑 / 填孔 / 去小连通域 / 柔化都先用 cv2.boundingRect 求前景外接框，
+  外扩核（或柔化）半径后只在该窗口内计算
 """
+import base64
 import os
+import time
 from pathlib import Path
+from typing import Optional, Tuple
 
 import cv2
 import numpy as np
 
 
-def smooth_mask(mask, open_ks=3, close_ks=3):
+Window = Tuple[int, int, int, int]  # x0,y0,x1,y1（x1/y1 不含）
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _add_timing(timings: Optional[dict], key: str, t0: float) -> float:
+    """把 t0 到现在的耗时累加进 timings[key]（毫秒），返回当前时间。"""
+    t1 = time.perf_counter()
+    if timings is not None:
+        timings[key] = round(timings.get(key, 0.0) + (t1 - t0) * 1000, 2)
+    return t1
+
+
+def binary01(mask: np.ndarray) -> np.ndarray:
+    """任意 0/1、0/255 或 bool 掩码 -> 新的 uint8 0/1 拷贝（uint8 输入走 cv2.threshold，比 numpy 比较快数倍）。"""
+    if mask.dtype == np.uint8:
+        return cv2.threshold(mask, 0, 1, cv2.THRESH_BINARY)[1]
+    return (mask > 0).astype(np.uint8)
+
+
+def tight_bbox(mask: np.ndarray, pad: int = 0) -> Optional[Window]:
+    """
+    前景外接框（cv2.boundingRect 直接扫描 8 位掩码，等价于 findNonZero + boundingRect 但不生成点集），
+    四周外扩 pad 像素并夹到图像范围内；空掩码返回 None
     """
-    掩码平滑与去噪：开闭运算 + 轻羽化
+    src = mask.view(np.uint8) if mask.dtype == np.bool_ else mask
+    if src.dtype != np.uint8:
+        src = (mask > 0).astype(np.uint8)
+    x, y, w, h = cv2.boundingRect(src)
+    if w == 0 or h == 0:
+        return None
+    H, W = mask.shape[:2]
+    return max(0, x - pad), max(0, y - pad), min(W, x + w + pad), min(H, y + h + pad)
+
+
+def mask_bbox(mask: np.ndarray) -> Optional[Window]:
+    """前景外接框（按行/列 any 求，任意 dtype 均可，不外扩）；空掩码返回 None"""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+def fill_small_holes(m01: np.ndarray, max_area: int) -> np.ndarray:
+    """填掉面积不超过 max_area 的孔洞（不接触窗口边界的背景连通域）。原地修改并返回 m01。"""
+    if max_area <= 0:
+        return m01
+    num, labels, stats, _ = cv2.connectedComponentsWithStats(1 - m01, connectivity=4)
+    if num <= 2:
+        return m01
+    h, w = m01.shape
+    x, y, bw, bh, area = stats.T
+    holes = (area <= max_area) & (x > 0) & (y > 0) & (x + bw < w) & (y + bh < h)
+    holes[0] = False
+    if holes.any():
+        m01[holes[labels]] = 1
+    return m01
+
+
+def remove_small_regions(m01: np.ndarray, min_area: int) -> np.ndarray:
+    """去掉面积小于 min_area 的前景连通域；全部都小时保留最大的一块，避免掩码被清空。原地修改并返回 m01。"""
+    if min_area <= 0:
+        return m01
+    num, labels, stats, _ = cv2.connectedComponentsWithStats(m01, connectivity=8)
+    if num <= 2:
+        return m01
+    area = stats[:, cv2.CC_STAT_AREA]
+    small = area < min_area
+    small[0] = False
+    if small[1:].all():
+        small[int(np.argmax(area[1:])) + 1] = False
+    if small.any():
+        m01[small[labels]] = 0
+    return m01
+
+
+def refine_mask(mask: np.ndarray, open_ks: Optional[int] = None, close_ks: Optional[int] = None,
+                hole_area: Optional[int] = None, min_region: Optional[int] = None, blur: bool = False,
+                timings: Optional[dict] = None) -> np.ndarray:
     """
-    m = (mask > 0).astype(np.uint8)
+    候选掩码后处理流水线，只在前景外接框（外扩核半径）窗口内计算，耗时与物体大小成正比而不是整幅图像：
+    开运算去毛刺 -> 闭运算补缝 -> 填小孔 -> 去小连通域（-> 可选 3x3 高斯轻羽化后二值化）
+    参数缺省时取 SAM_SMOOTH_KERNEL / SAM_MASK_HOLE_AREA / SAM_MASK_MIN_REGION；
+    timings 不为 None 时按阶段累加耗时（bbox_ms / smooth_ms / holes_ms / regions_ms）
+    """
+    t = time.perf_counter()
+    ks = _env_int("SAM_SMOOTH_KERNEL", 3)
+    open_ks = ks if open_ks is None else open_ks
+    close_ks = ks if close_ks is None else close_ks
+    hole_area = _env_int("SAM_MASK_HOLE_AREA", 32) if hole_area is None else hole_area
+    min_region = _env_int("SAM_MASK_MIN_REGION", 32) if min_region is None else min_region
+
+    m = binary01(mask)
+    # 外扩量覆盖开/闭运算与高斯核的作用范围，保证窗口内结果与整图计算一致
+    window = tight_bbox(m, pad=max(open_ks, close_ks, 1) + 2)
+    t = _add_timing(timings, "bbox_ms", t)
+    if window is None:
+        return m
+    x0, y0, x1, y1 = window
+    w = m[y0:y1, x0:x1].copy()
     if open_ks and open_ks >= 3:
-        kernel = np.ones((open_ks, open_ks), np.uint8)
-        m = cv2.morphologyEx(m, cv2.MORPH_OPEN, kernel, iterations=1)
+        w = cv2.morphologyEx(w, cv2.MORPH_OPEN, np.ones((open_ks, open_ks), np.uint8), iterations=1)
     if close_ks and close_ks >= 3:
-        kernel = np.ones((close_ks, close_ks), np.uint8)
-        m = cv2.morphologyEx(m, cv2.MORPH_CLOSE, kernel, iterations=1)
-    # 轻微羽化边缘
-    m = cv2.GaussianBlur(m.astype(np.float32), (3, 3), 0)
-    return (m > 0.5).astype(np.uint8)
+        w = cv2.morphologyEx(w, cv2.MORPH_CLOSE, np.ones((close_ks, close_ks), np.uint8), iterations=1)
+    if blur:
+        w = (cv2.GaussianBlur(w.astype(np.float32), (3, 3), 0) > 0.5).astype(np.uint8)
+    t = _add_timing(timings, "smooth_ms", t)
+    fill_small_holes(w, hole_area)
+    t = _add_timing(timings, "holes_ms", t)
+    remove_small_regions(w, min_region)
+    _add_timing(timings, "regions_ms", t)
+    m[y0:y1, x0:x1] = w  # m 是新拷贝，窗口外本来就全为 0
+    return m
+
+
+def smooth_mask(mask, open_ks=3, close_ks=3):
+    """
+    掩码平滑与去噪：开闭运算 + 轻羽化（只在外接框窗口内计算）
+    """
+    return refine_mask(mask, open_ks=open_ks, close_ks=close_ks, hole_area=0, min_region=0, blur=True)
 
-def feather_edges(mask: np.ndarray, radius_px: int = 6) -> np.ndarray:
+def feather_edges(mask: np.ndarray, radius_px: int = 6, timings: Optional[dict] = None) -> np.ndarray:
     """
     将二值 mask (0/1 或 0/255) 转为带“柔化边缘”的 Alpha (0..255)。
     - 不改变几何，只让边界出现渐变。
     - radius_px：软边半径，像素单位（越大越柔和）。
+    - 距离变换只在外接框外扩 radius_px 的窗口内计算：窗口外到前景的距离都超过半径，alpha 必为 0
     返回：uint8 的 alpha（0..255）
     """
     if radius_px <= 0:
         # 不柔化：直接返回二值 Alpha
-        m01 = (mask > 0).astype(np.uint8)
-        return (m01 * 255).astype(np.uint8)
+        return binary01(mask) * np.uint8(255)
+    m01 = binary01(mask)
 
-    m01 = (mask > 0).astype(np.uint8)
+    t = time.perf_counter()
+    alpha = np.zeros(m01.shape, dtype=np.uint8)
+    window = tight_bbox(m01, pad=int(np.ceil(radius_px)) + 2)
+    if window is None:
+        return alpha
+    x0, y0, x1, y1 = window
+    w = m01[y0:y1, x0:x1]
 
     # 距离变换（像素到最近背景/前景的距离）
     # 内部：到背景的距离
-    dist_in = cv2.distanceTransform(m01, cv2.DIST_L2, 3)
+    dist_in = cv2.distanceTransform(w, cv2.DIST_L2, 3)
     # 外部：到前景的距离（先取反，计算到“1”的距离）
-    dist_out = cv2.distanceTransform(1 - m01, cv2.DIST_L2, 3)
+    dist_out = cv2.distanceTransform(1 - w, cv2.DIST_L2, 3)
 
     # 签名距离：内部为正，外部为负
     signed = dist_in - dist_out  # >0 inside, <0 outside
 
     # 在线性带 [-radius, +radius] 内做 0..255 的渐变，其他区域全0或全255
     r = float(radius_px)
-    alpha = 255.0 * np.clip(0.5 + signed / (2.0 * r), 0.0, 1.0)
+    alpha[y0:y1, x0:x1] = 255.0 * np.clip(0.5 + signed / (2.0 * r), 0.0, 1.0)
+    _add_timing(timings, "feather_ms", t)
+    return alpha
 
-    return alpha.astype(np.uint8)
+
+def decode_mask_png(mask_png_b64: str) -> Optional[np.ndarray]:
+    """
+    前端上传的掩码 PNG（dataURL 或纯 base64）-> 0/1 掩码；带 alpha 通道时取 alpha，否则灰度 >127。
+    解码失败返回 None
+    """
+    b64 = mask_png_b64.split(",", 1)[1] if "," in mask_png_b64 else mask_png_b64
+    mk = cv2.imdecode(np.frombuffer(base64.b64decode(b64), dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if mk is None:
+        return None
+    if mk.ndim == 3 and mk.shape[2] == 4:
+        return (mk[:, :, 3] > 0).astype(np.uint8)
+    if mk.ndim == 3:
+        mk = cv2.cvtColor(mk, cv2.COLOR_BGR2GRAY)
+    return (mk > 127).astype(np.uint8)
 
 
 def rgba_from_bgr_and_mask(image_bgr, mask):
@@ -80,6 +220,17 @@ def save_rgba_soft(image_bgr: np.ndarray, alpha: np.ndarray, out_path: str):
     os.makedirs(os.path.dirname(out_path), exist_ok=True)
     cv2.imwrite(out_path, rgba)
 
+def make_split_dir(image_path: str, output_dir: str) -> str:
+    """
+    /sam/split 的输出目录：<output_dir>/split/<stem>_<yyyymmddHHMMSS>_<rand>/
+    （每个元素一个 <uuid>/sprite.png，外加 manifest.json）
+    """
+    import time, random
+    stem = Path(image_path).stem
+    ts = time.strftime('%Y%m%d%H%M%S')
+    rand = format(random.randint(0, 0xFFFF), '04x')
+    return str(Path(output_dir) / "split" / f"{stem}_{ts}_{rand}")
+
 def make_output_path(image_path: str, output_dir: str, roi_idx: int) -> str:
     """
     输出命名增加时间+短随机后缀，防止同一原图多次分割不同 ROI 覆盖：
@@ -1,14 +1,30 @@
+import math
 import os
 import shutil
-import base64
+import threading
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import List, Optional, Tuple
 
 import cv2
 import numpy as np
-from segment_anything import sam_model_registry, SamPredictor
+
+from .brush import BrushSample, BrushState, stroke_prompts
+from .auto_segment import AutoMask, AutoSegmentCache, point_grid, stability_score, box_nms
+from .embedding_cache import EmbeddingCache
+from .mask_store import MaskRegistry, MaskRecord
+from .model_tier import Embedding, ModelTier
+from .encoder_modes import synthetic_drawing
+from .errors import SessionNotReady, InferenceQueueFull
+from .frame_change import FrameChangeDetector
+from .image_io import DecodedImage, b64_to_bytes, decode_image, decode_full
+from .mask_codec import encode_mask, mask_polygons
+from .postprocess import mask_bbox, refine_mask, tight_bbox
+from .inference_queue import InferenceQueue
+from .worker_pool import InferencePool
 
 @dataclass
 class Session:
@@ -17,11 +33,49 @@ class Session:
     h: int
     w: int
     tmp_dir: Path
-    predictor: SamPredictor
+    embedding: Optional[Embedding]
     image_name: str  # 用于导出命名（stem）
+    embed_key: Optional[str] = None  # 当前底图的 embedding 缓存 key（像素哈希）
+    # 后台 embedding 状态：pending | ready | failed
+    status: str = "ready"
+    error: Optional[str] = None
+    generation: int = 0  # 每次换底图 +1，旧的后台任务结果直接丢弃
+    ready_event: threading.Event = field(default_factory=threading.Event)
+    timings: dict = field(default_factory=dict)
+    # 双档模式下大模型（final）的 embedding，init 之后在后台计算：none | pending | ready | failed
+    final_embedding: Optional[Embedding] = None
+    final_status: str = "none"
+    final_event: threading.Event = field(default_factory=threading.Event)
+    # mask_id -> MaskRecord（分数/父掩码/logits/存储位置）；像素在内存，超预算时 spill 到 tmp_dir
+    masks: Optional[MaskRegistry] = None
+    # 放大模式：max_side 缩小前的源图（未缩小时为 None，直接用 image_bgr；仅 SAM_ZOOM=1 时常驻），
+    # 以及源图坐标裁剪框 (x0,y0,x1,y1) -> 裁剪区域 embedding 的 LRU
+    source_bgr: Optional[np.ndarray] = None
+    # 缩小解码或未常驻 source_bgr 时保留的原始编码字节：首次放大时全尺寸解码成 source_bgr
+    source_bytes: Optional[bytes] = None
+    crops: "OrderedDict[tuple, Embedding]" = field(default_factory=OrderedDict)
+    # 会话锁：换底图 / 解码 / 登记掩码互斥，保证 embedding、底图与掩码始终对应同一张图
+    lock: threading.RLock = field(default_factory=threading.RLock)
+    # 上一次编码帧的画面签名；update-image 时与新帧比较，变化很小则跳过重新编码
+    frame_sig: Optional[np.ndarray] = None
+    frame_delta: Optional[float] = None    # 最近一次 update-image 的画面变化量
+    embedded: bool = True                  # 最近一次 update-image 是否重新编码
+    # 笔刷链：当前头部掩码 ID -> BrushState（可写掩码 + 撤销/重做），LRU
+    brushes: "OrderedDict[str, BrushState]" = field(default_factory=OrderedDict)
     created_at: float = field(default_factory=lambda: __import__('time').time())
     last_used: float = field(default_factory=lambda: __import__('time').time())
 
+    def __post_init__(self):
+        if self.masks is None:
+            self.masks = MaskRegistry(spill_dir=self.tmp_dir)
+
+    def zoom_source(self) -> np.ndarray:
+        """放大模式用的全分辨率源图（调用方持有会话锁）。只保留编码字节的会话在第一次放大时才全尺寸解码。"""
+        if self.source_bgr is None and self.source_bytes is not None:
+            self.source_bgr = decode_full(self.source_bytes)
+            self.source_bytes = None
+        return self.source_bgr if self.source_bgr is not None else self.image_bgr
+
 class SamEngine:
     def __init__(self, weights_path: Optional[str] = None, model_type: Optional[str] = None, device: Optional[str] = None):
         self.model_type = model_type or os.getenv("SAM_MODEL_TYPE", "vit_h")
@@ -30,51 +84,173 @@ class SamEngine:
         if not self.weights_path or not os.path.exists(self.weights_path):
             raise RuntimeError("SAM weights not found. Set SAM_WEIGHTS to a valid .pth file.")
         self.sessions: dict[str, Session] = {}
-        # 最大活跃会话数（超过后自动回收最旧的），避免 GPU / 内存膨胀
+        self._sessions_lock = threading.RLock()  # 保护 sessions 的增删与遍历（路由在线程池中并发执行）
+        # 最大活跃会话数（超过后自动回收最旧的）。会话只保存 embedding 记录，
+        # 单个 vit_h embedding 约 4MB（fp16 时 2MB），可以同时保留几十张画
         try:
-            self.max_sessions = int(os.getenv("SAM_MAX_SESSIONS", "2"))
+            self.max_sessions = int(os.getenv("SAM_MAX_SESSIONS", "32"))
         except ValueError:
-            self.max_sessions = 2
-        import time
-        t0 = time.perf_counter()
-        self._model = sam_model_registry[self.model_type](checkpoint=self.weights_path).to(self.device)
-        t1 = time.perf_counter()
+            self.max_sessions = 32
+        # SAM_EMBED_FP16=1：embedding 以 fp16 存储，解码前再转回 fp32
+        self.embed_fp16 = os.getenv("SAM_EMBED_FP16", "0").lower() in ("1", "true", "yes")
+        # 后台编码线程池（/sam/init async_embed=true 时使用）与 segment 等待就绪的默认超时
         try:
-            import torch
-            print(f"[SAM][Init] model_type={self.model_type} device={self.device} cuda_available={torch.cuda.is_available()} load_time={(t1-t0)*1000:.1f}ms")
-        except Exception:
-            print(f"[SAM][Init] model_type={self.model_type} device={self.device} load_time={(t1-t0)*1000:.1f}ms (torch inspect failed)")
-
-    def _decode_image(self, image_path: Optional[str], image_b64: Optional[str]) -> np.ndarray:
-        if image_path:
-            img = cv2.imread(image_path, cv2.IMREAD_COLOR)
-            if img is None:
-                raise ValueError(f"Failed to read image: {image_path}")
-            return img
-        if image_b64:
-            if "," in image_b64:
-                image_b64 = image_b64.split(",", 1)[1]
-            data = base64.b64decode(image_b64)
-            arr = np.frombuffer(data, np.uint8)
-            img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-            if img is None:
-                raise ValueError("Failed to decode base64 image")
-            return img
-        raise ValueError("Either image_path or image_b64 must be provided.")
-
-    def init_session(self, image_path: Optional[str], image_b64: Optional[str], image_name: Optional[str], max_side: Optional[int] = None) -> Session:
+            embed_workers = int(os.getenv("SAM_EMBED_WORKERS", "1"))
+        except ValueError:
+            embed_workers = 1
+        self._embed_executor = ThreadPoolExecutor(max_workers=max(1, embed_workers), thread_name_prefix="sam-embed")
+        try:
+            self.ready_timeout = float(os.getenv("SAM_READY_TIMEOUT", "30"))
+        except ValueError:
+            self.ready_timeout = 30.0
+        # /sam/segment-batch 单次 predict_torch 的最大提示数（过大时分块，限制峰值内存）
+        try:
+            self.decode_batch = max(1, int(os.getenv("SAM_DECODE_BATCH", "16")))
+        except ValueError:
+            self.decode_batch = 16
+        # 图像 embedding 缓存：同一张画重复打开时跳过 set_image
+        self.embed_cache = EmbeddingCache()
+        # /sam/auto-segment 结果缓存：key = 图像 embedding key + 参数
+        self.auto_cache = AutoSegmentCache()
+        # 摄像头连拍：画面与上次编码帧相比几乎没变时跳过重新编码（SAM_FRAME_CHANGE_THRESH=0 关闭）
+        self.frame_detector = FrameChangeDetector()
+        # 候选掩码轮廓：Douglas-Peucker 容差（像素）与最小轮廓面积
+        try:
+            self.contour_tolerance = float(os.getenv("SAM_CONTOUR_TOLERANCE", "1.5"))
+            self.contour_min_area = float(os.getenv("SAM_CONTOUR_MIN_AREA", "4"))
+        except ValueError:
+            self.contour_tolerance, self.contour_min_area = 1.5, 4.0
+        # 候选掩码后处理（smooth=True 时）：开闭运算核大小、填补的最大孔洞面积、去掉的最小连通域面积（像素，0=关闭）
+        try:
+            self.smooth_kernel = int(os.getenv("SAM_SMOOTH_KERNEL", "3"))
+            self.mask_hole_area = int(os.getenv("SAM_MASK_HOLE_AREA", "32"))
+            self.mask_min_region = int(os.getenv("SAM_MASK_MIN_REGION", "32"))
+        except ValueError:
+            self.smooth_kernel, self.mask_hole_area, self.mask_min_region = 3, 32, 32
+        # 每个会话保留的笔刷链数量（每条链持有一份整图掩码 + 撤销历史）与每条链的撤销步数
+        try:
+            self.max_brushes = max(1, int(os.getenv("SAM_BRUSH_STATES", "8")))
+            self.brush_undo = max(1, int(os.getenv("SAM_BRUSH_UNDO", "50")))
+        except ValueError:
+            self.max_brushes, self.brush_undo = 8, 50
+        # 智能笔刷：每笔采样的点提示数、由像素掩码构造 mask_input 时的 logit 幅值
+        try:
+            self.smart_brush_points = max(1, int(os.getenv("SAM_SMART_BRUSH_POINTS", "6")))
+            self.smart_brush_logit = float(os.getenv("SAM_SMART_BRUSH_LOGIT", "8"))
+            self.brush_join_gap = float(os.getenv("SAM_BRUSH_JOIN_GAP", "3"))
+        except ValueError:
+            self.smart_brush_points, self.smart_brush_logit, self.brush_join_gap = 6, 8.0, 3.0
+        # 按路径更新底图（摄像头保存的大图）时默认的最大边
+        try:
+            self.update_max_side = int(os.getenv("SAM_UPDATE_MAX_SIDE", "1280"))
+        except ValueError:
+            self.update_max_side = 1280
+        # 模型档位：配置了 SAM_PREVIEW_MODEL_TYPE + SAM_PREVIEW_WEIGHTS 时，小模型负责交互预览，
+        # SAM_MODEL_TYPE 的大模型只用于导出最终掩码；否则只有一个档位。
+        # 降精度编码器 / ONNX 解码器只作用于交互档，最终档保持 fp32 + torch 以保证质量
+        encoder_mode = os.getenv("SAM_ENCODER_MODE", "fp32")
+        decoder_backend = os.getenv("SAM_DECODER", "torch").lower()
+        preview_type = os.getenv("SAM_PREVIEW_MODEL_TYPE")
+        preview_weights = os.getenv("SAM_PREVIEW_WEIGHTS")
+        two_tier = bool(preview_type and preview_weights)
+        # 多进程推理池：SAM_INFER_WORKERS>0 时编码/解码在独立 worker 进程里跑，
+        # 模型权重在本进程加载一次并通过共享内存映射给各 worker（仅 CPU；GPU 上单进程已能跑满）
+        try:
+            infer_workers = int(os.getenv("SAM_INFER_WORKERS", "0"))
+        except ValueError:
+            infer_workers = 0
+        if infer_workers > 0 and not self.device.startswith("cpu"):
+            print(f"[SAM][Pool] SAM_INFER_WORKERS is CPU only, ignoring on device={self.device}")
+            infer_workers = 0
+        pooled = infer_workers > 0
+        self.final = ModelTier("final", self.model_type, self.weights_path, self.device, self.embed_cache,
+                               embed_fp16=self.embed_fp16,
+                               encoder_mode="fp32" if two_tier else encoder_mode,
+                               decoder_backend="torch" if two_tier else decoder_backend, pooled=pooled)
+        if two_tier:
+            self.preview = ModelTier("preview", preview_type, preview_weights, self.device, self.embed_cache,
+                                     embed_fp16=self.embed_fp16, encoder_mode=encoder_mode, decoder_backend=decoder_backend,
+                                     pooled=pooled)
+        else:
+            self.preview = self.final
+        self.pool: Optional[InferencePool] = None
+        if pooled:
+            self.pool = InferencePool(self.tiers, infer_workers)
+            for tier in self.tiers:
+                tier.pool = self.pool
+        # 全局推理准入队列：限制并发编码/解码数，排队过长时拒绝（路由返回 429）
+        try:
+            concurrency = int(os.getenv("SAM_INFER_CONCURRENCY", "0"))
+        except ValueError:
+            concurrency = 0
+        if concurrency <= 0:
+            concurrency = self.pool.workers if self.pool is not None else 1
+        self.queue = InferenceQueue(concurrency)
+        # 放大模式：框相对整图较小时，在源图上裁剪框周围区域单独编码再解码，保留细铅笔线边缘。
+        # SAM_ZOOM=1 自动判断（框最长边 <= SAM_ZOOM_MAX_FRACTION * 图像最长边）；请求也可用 zoom 显式开关
+        self.zoom_auto = os.getenv("SAM_ZOOM", "0").lower() in ("1", "true", "yes")
+        try:
+            self.zoom_max_fraction = float(os.getenv("SAM_ZOOM_MAX_FRACTION", "0.35"))
+            self.zoom_pad = float(os.getenv("SAM_ZOOM_PAD", "0.5"))
+            self.zoom_min_crop = int(os.getenv("SAM_ZOOM_MIN_CROP", "256"))
+            self.zoom_cache = max(1, int(os.getenv("SAM_ZOOM_CACHE", "4")))
+        except ValueError:
+            self.zoom_max_fraction, self.zoom_pad, self.zoom_min_crop, self.zoom_cache = 0.35, 0.5, 256, 4
+        self._final_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sam-final")
+        # 导出时等待最终档 embedding 的最长秒数，超时则直接用预览掩码
+        try:
+            self.final_timeout = float(os.getenv("SAM_FINAL_TIMEOUT", "10"))
+        except ValueError:
+            self.final_timeout = 10.0
+
+    @property
+    def two_tier(self) -> bool:
+        return self.preview is not self.final
+
+    @property
+    def tiers(self) -> List[ModelTier]:
+        return [self.preview, self.final] if self.two_tier else [self.final]
+
+    def warmup(self) -> dict:
+        """在合成图上对每个档位跑一次编码 + 解码，预热 kernel 与内存分配器（不写 embedding 缓存）。"""
+        image = synthetic_drawing()
+        timings = {}
+        for tier in self.tiers:
+            r = tier.warmup(image)
+            timings[f"{tier.name}_warmup_embed_ms"] = r["embed_ms"]
+            timings[f"{tier.name}_warmup_decode_ms"] = r["decode_ms"]
+            if r["embed_ms"] is None:
+                print(f"[SAM][Warmup] tier={tier.name} skipped: every worker timed out")
+            else:
+                print(f"[SAM][Warmup] tier={tier.name} embed={r['embed_ms']}ms decode={r['decode_ms']}ms")
+        self._torch_empty_cache()
+        return timings
+
+    def _decode_image(self, image_path: Optional[str], image_b64: Optional[str], image_bytes: Optional[bytes] = None,
+                      max_side: Optional[int] = None) -> DecodedImage:
+        """路径 / base64 / 上传字节统一解码并缩放到 max_side 以内（JPEG 按目标尺寸缩小解码）。
+        优先级：image_bytes > image_path > image_b64。放大模式自动开启时全尺寸解码，保留源图细节。"""
         import time
         t0 = time.perf_counter()
-        image_bgr = self._decode_image(image_path, image_b64)
+        data = image_bytes or None
+        if data is None and not image_path:
+            if not image_b64:
+                raise ValueError("One of image_path, image_b64 or an uploaded image must be provided.")
+            data = b64_to_bytes(image_b64)  # 原始上传（image/jpeg、image/png、multipart）不经过这一步
         t1 = time.perf_counter()
-        resized = False
-        if max_side and max_side > 0:
-            h0, w0 = image_bgr.shape[:2]
-            if max(h0, w0) > max_side:
-                scale = max_side / max(h0, w0)
-                image_bgr = cv2.resize(image_bgr, (int(w0*scale), int(h0*scale)), interpolation=cv2.INTER_AREA)
-                resized = True
-        t2 = time.perf_counter()
+        decoded = decode_image(data=data, path=None if data is not None else image_path, max_side=max_side,
+                               reduce=not self.zoom_auto)
+        if image_b64 and not image_bytes and not image_path:
+            decoded.timings["b64_ms"] = round((t1-t0)*1000, 1)
+        return decoded
+
+    def init_session(self, image_path: Optional[str], image_b64: Optional[str], image_name: Optional[str], max_side: Optional[int] = None,
+                     background: bool = False, image_bytes: Optional[bytes] = None) -> Session:
+        """解码并登记会话。background=True 时 embedding 交给后台线程，立即返回 status=pending 的会话。
+        image_bytes：上传接口传入的原始编码字节（优先于 image_path / image_b64）。"""
+        import time
+        decoded = self._decode_image(image_path, image_b64, image_bytes, max_side)
+        image_bgr = decoded.image
         h, w = image_bgr.shape[:2]
         sid = str(uuid.uuid4())
         # 增加时间前缀，便于溯源与调试：YYYYMMDD_HHMMSS_<session-uuid>
@@ -83,11 +259,9 @@ class SamEngine:
         tmp_dir = Path("assets/tmp") / f"{time_prefix}_{sid}"
         tmp_dir.mkdir(parents=True, exist_ok=True)
 
-        predictor = SamPredictor(self._model)
-        t3 = time.perf_counter()
-        predictor.set_image(cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB))  # 生成图像 embedding（最耗时）
-        t4 = time.perf_counter()
-        print(f"[SAM][SessionInit] sid={sid[:8]} decode={(t1-t0)*1000:.1f}ms resize={(t2-t1)*1000:.1f}ms new_predictor={(t3-t2)*1000:.1f}ms embed={(t4-t3)*1000:.1f}ms total={(t4-t0)*1000:.1f}ms resized={resized} shape={w}x{h}")
+        embed_key = self.preview.cache_key(image_bgr, max_side)
+        source = "upload" if image_bytes else ("path" if image_path else "b64")
+        print(f"[SAM][SessionInit] sid={sid[:8]} source={source} {self._decode_log(decoded)} shape={w}x{h} background={background}")
 
         # 命名：优先用 image_name，否则用路径stem，最后 fallback 为 session_xxx
         if image_name:
@@ -97,121 +271,312 @@ class SamEngine:
         else:
             name = f"session_{sid}.png"
 
-        sess = Session(id=sid, image_bgr=image_bgr, h=h, w=w, tmp_dir=tmp_dir, predictor=predictor, image_name=name)
-        self.sessions[sid] = sess
-        self._trim_sessions()  # 确保不会无限增长
+        source_bgr, source_bytes = decoded.zoom_source(keep_decoded=self.zoom_auto)
+        sess = Session(id=sid, image_bgr=image_bgr, h=h, w=w, tmp_dir=tmp_dir, embedding=None, image_name=name,
+                       embed_key=embed_key, status="pending", source_bgr=source_bgr, source_bytes=source_bytes,
+                       frame_sig=self.frame_detector.signature(image_bgr) if self.frame_detector.enabled else None)
+        sess.timings = {**decoded.timings, "queued_at": time.time()}
+        with self._sessions_lock:
+            self.sessions[sid] = sess
+            self._trim_sessions()  # 确保不会无限增长
+        if background:
+            self._embed_executor.submit(self._run_embed, sess, image_bgr, max_side, sess.generation)
+        else:
+            try:
+                self._run_embed(sess, image_bgr, max_side, sess.generation, reject=True)
+            except InferenceQueueFull:
+                self._drop_session(sess)
+                raise
+            if sess.status == "failed":
+                self._drop_session(sess)  # 同步编码失败的会话不会再被使用，立即释放底图
+                raise RuntimeError(f"Embedding failed: {sess.error}")
+        return sess
+
+    def _run_embed(self, sess: Session, image_bgr: np.ndarray, max_side: Optional[int], generation: int,
+                   reject: bool = False):
+        """生成（交互档）embedding 并写回会话；若期间底图已被更新（generation 变化），丢弃结果。
+        reject=True（同步 init）时推理队列已满直接抛 InferenceQueueFull；后台任务则排队等待。"""
+        import time
+        started = time.time()
+        t0 = time.perf_counter()
+        try:
+            with self.queue.slot("embed", reject=reject):
+                embedding, cache_hit = self.preview.embed(image_bgr, sess.embed_key, affinity=sess.id)  # 生成图像 embedding（最耗时）
+        except InferenceQueueFull:
+            raise
+        except Exception as e:
+            with sess.lock:
+                if sess.generation == generation:
+                    sess.status, sess.error = "failed", str(e)
+                    sess.timings["finished_at"] = time.time()
+                    sess.ready_event.set()
+            print(f"[SAM][Embed] sid={sess.id[:8]} failed: {e}")
+            return
+        t1 = time.perf_counter()
+        with sess.lock:
+            if sess.generation != generation:
+                return
+            sess.embedding = embedding
+            sess.timings.update({
+                "wait_ms": round((started - sess.timings.get("queued_at", started)) * 1000, 1),
+                "embed_ms": round((t1-t0)*1000, 1),
+                "cache": "hit" if cache_hit else "miss",
+                "finished_at": time.time(),
+            })
+            sess.status, sess.error = "ready", None
+            sess.ready_event.set()
+        print(f"[SAM][Embed] sid={sess.id[:8]} tier={self.preview.name} wait={sess.timings['wait_ms']:.1f}ms embed={(t1-t0)*1000:.1f}ms cache={sess.timings['cache']}")
+        self._schedule_final(sess, image_bgr, max_side, generation)
         self._log_memory_state(tag="SessionInit")
+
+    def _schedule_final(self, sess: Session, image_bgr: np.ndarray, max_side: Optional[int], generation: int):
+        """双档模式：交互档就绪后，在后台计算最终档（大模型）的 embedding。"""
+        if not self.two_tier:
+            return
+        sess.final_embedding = None
+        sess.final_status = "pending"
+        sess.final_event.clear()
+        self._final_executor.submit(self._run_final_embed, sess, image_bgr, max_side, generation)
+
+    def _run_final_embed(self, sess: Session, image_bgr: np.ndarray, max_side: Optional[int], generation: int):
+        import time
+        t0 = time.perf_counter()
+        try:
+            with self.queue.slot("embed_final", reject=False):
+                embedding, cache_hit = self.final.embed(image_bgr, self.final.cache_key(image_bgr, max_side), affinity=sess.id)
+        except Exception as e:
+            with sess.lock:
+                if sess.generation == generation:
+                    sess.final_status = "failed"
+                    sess.final_event.set()
+            print(f"[SAM][Embed] sid={sess.id[:8]} tier={self.final.name} failed: {e}")
+            return
+        with sess.lock:
+            if sess.generation != generation:
+                return
+            sess.final_embedding = embedding
+            sess.final_status = "ready"
+            sess.timings["final_embed_ms"] = round((time.perf_counter()-t0)*1000, 1)
+            sess.final_event.set()
+        print(f"[SAM][Embed] sid={sess.id[:8]} tier={self.final.name} embed={sess.timings['final_embed_ms']:.1f}ms cache={'hit' if cache_hit else 'miss'}")
+
+    def wait_ready(self, session_id: str, timeout: Optional[float] = None) -> Session:
+        """等待会话 embedding 就绪。timeout=0 表示不等待直接失败，None 使用 SAM_READY_TIMEOUT。"""
+        sess = self.get_session(session_id)
+        if not sess:
+            raise ValueError(f"Session not found: {session_id}")
+        if sess.status == "pending":
+            sess.ready_event.wait(self.ready_timeout if timeout is None else max(0.0, timeout))
+        if sess.status == "pending":
+            raise SessionNotReady(session_id, "pending", "Session embedding is still being computed, retry later")
+        if sess.status == "failed":
+            raise SessionNotReady(session_id, "failed", f"Session embedding failed: {sess.error}")
         return sess
 
-    def update_session_image(self, session_id: str, image_path: str) -> Session:
-        """更新一个已有会话的底图而不销毁 predictor，提高摄像头连续拍摄速度。
-        会清理该会话 tmp_dir 下旧的临时 mask（保留最终导出的不在此目录的结果）。
+    def session_status(self, session_id: str) -> dict:
+        import time
+        sess = self.get_session(session_id)
+        if not sess:
+            raise ValueError(f"Session not found: {session_id}")
+        end = sess.timings.get("finished_at") or time.time()
+        elapsed = (end - sess.timings.get("queued_at", end)) * 1000
+        return {"session_id": sess.id, "status": sess.status, "error": sess.error,
+                "elapsed_ms": round(elapsed, 1), "timings": self.public_timings(sess),
+                "final_status": sess.final_status if self.two_tier else None}
+
+    def public_timings(self, sess: Session) -> dict:
+        """会话最近一次解码/缩放/编码耗时（去掉内部时间戳），随 init / update-image 响应返回。"""
+        return {k: v for k, v in sess.timings.items() if not k.endswith("_at")}
+
+    def update_session_image(self, session_id: str, image_path: str, force_embed: bool = False,
+                             max_side: Optional[int] = None) -> Session:
+        """更新一个已有会话的底图（只替换 embedding 记录），提高摄像头连续拍摄速度。
+        会清空该会话登记的旧 mask（最终导出的结果在 OUTPUT_DIR，不受影响）。
+        画面与上次编码帧相比几乎没变时（且未 force_embed）直接保留原底图、embedding 与掩码。
+        max_side 缺省时使用 SAM_UPDATE_MAX_SIDE（默认 1280），限制最大边以减少推理耗时。
         """
-        session = self.sessions.get(session_id)
+        session = self.get_session(session_id)
         if not session:
             raise ValueError("Session not found")
         if not Path(image_path).exists():
             raise FileNotFoundError(image_path)
 
-        import cv2
-        image_bgr = cv2.imread(image_path)
-        if image_bgr is None:
-            raise ValueError("Failed to read image for update")
-        # 可选：若分辨率过大，限制最大边，减少后续推理耗时
-        max_side = 1280
-        h0, w0 = image_bgr.shape[:2]
-        if max(h0, w0) > max_side:
-            scale = max_side / max(h0, w0)
-            image_bgr = cv2.resize(image_bgr, (int(w0*scale), int(h0*scale)), interpolation=cv2.INTER_AREA)
-
-        session.image_bgr = image_bgr
-        session.h, session.w = image_bgr.shape[:2]
-        session.image_name = Path(image_path).name
-        # 重新设置 predictor 图像（无需重新实例化 predictor）
-        session.predictor.set_image(cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB))
-
-        # 清空旧的临时 mask 文件，避免混淆
-        for f in session.tmp_dir.glob("*.png"):
-            try:
-                f.unlink()
-            except Exception:
-                pass
-        # 不重建 predictor，只是更新 image 引用
-        session.last_used = __import__('time').time()
-        self._log_memory_state(tag="UpdateImagePath")
-        return session
+        if max_side is None:
+            max_side = self.update_max_side
+        decoded = self._decode_image(image_path, None, max_side=max_side)
+        return self._update_image(session, decoded, max_side, Path(image_path).name, force_embed, "path")
 
-    def update_session_image_b64(self, session_id: str, image_b64: str, max_side: Optional[int] = None) -> Session:
-        """复用已有 predictor，使用 base64 图像更新。"""
-        session = self.sessions.get(session_id)
+    def update_session_image_b64(self, session_id: str, image_b64: Optional[str], max_side: Optional[int] = None,
+                                 image_bytes: Optional[bytes] = None, image_name: Optional[str] = None,
+                                 force_embed: bool = False) -> Session:
+        """使用 base64 图像（或上传接口的原始字节 image_bytes）更新已有会话的底图与 embedding。
+        画面与上次编码帧相比几乎没变时（且未 force_embed）跳过编码，旧掩码与提示继续有效。"""
+        session = self.get_session(session_id)
         if not session:
             raise ValueError("Session not found")
+        decoded = self._decode_image(None, image_b64, image_bytes, max_side)
+        return self._update_image(session, decoded, max_side, image_name, force_embed, "upload" if image_bytes else "b64")
+
+    def _update_image(self, session: Session, decoded: DecodedImage, max_side: Optional[int], image_name: Optional[str],
+                      force_embed: bool, source: str) -> Session:
         import time
         t0 = time.perf_counter()
-        img = self._decode_image(None, image_b64)
+        img = decoded.image
+        skip, frame_sig, delta = self._frame_unchanged(session, img, force_embed)
         t1 = time.perf_counter()
-        resized = False
-        if max_side and max_side > 0:
-            h0, w0 = img.shape[:2]
-            if max(h0, w0) > max_side:
-                scale = max_side / max(h0, w0)
-                img = cv2.resize(img, (int(w0*scale), int(h0*scale)), interpolation=cv2.INTER_AREA)
-                resized = True
+        session.timings.pop("b64_ms", None)  # 上一次可能是 base64 更新
+        session.timings.update({**decoded.timings, "frame_ms": round((t1-t0)*1000, 1)})
+        if skip:
+            self._skip_update(session, delta)
+            return session
+        # 重新生成 embedding（命中缓存时跳过编码器）；编码期间会话仍可用旧底图继续分割
+        embed_key = self.preview.cache_key(img, max_side)
+        with self.queue.slot("embed"):
+            embedding, cache_hit = self.preview.embed(img, embed_key, affinity=session.id)
+        self._swap_image(session, img, embed_key, embedding, max_side, image_name=image_name,
+                         zoom_source=decoded.zoom_source(keep_decoded=self.zoom_auto), frame_sig=frame_sig, frame_delta=delta)
         t2 = time.perf_counter()
-        session.image_bgr = img
-        session.h, session.w = img.shape[:2]
-        # 复用 predictor：重新 set_image
-        session.predictor.set_image(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
-        t3 = time.perf_counter()
-        # 清除旧临时掩码
-        for f in session.tmp_dir.glob("*.png"):
-            try:
-                f.unlink()
-            except Exception:
-                pass
-        print(f"[SAM][UpdateImage] sid={session_id[:8]} decode={(t1-t0)*1000:.1f}ms resize={(t2-t1)*1000:.1f}ms embed={(t3-t2)*1000:.1f}ms total={(t3-t0)*1000:.1f}ms resized={resized} shape={session.w}x{session.h}")
-        session.last_used = __import__('time').time()
-        self._log_memory_state(tag="UpdateImageB64")
+        session.timings.update({"embed_ms": round((t2-t1)*1000, 1), "cache": "hit" if cache_hit else "miss"})
+        print(f"[SAM][UpdateImage] sid={session.id[:8]} source={source} {self._decode_log(decoded)} embed={(t2-t1)*1000:.1f}ms "
+              f"cache={'hit' if cache_hit else 'miss'} shape={session.w}x{session.h}")
+        session.last_used = time.time()
+        self._log_memory_state(tag="UpdateImage")
         return session
 
+    def _decode_log(self, decoded: DecodedImage) -> str:
+        t = decoded.timings
+        b64 = f"b64={t['b64_ms']:.1f}ms " if "b64_ms" in t else ""
+        return (f"{b64}decode={t['decode_ms']:.1f}ms scale=1/{decoded.scale_denom} resize={t['resize_ms']:.1f}ms "
+                f"resized={decoded.resized}")
+
+    def _frame_unchanged(self, session: Session, image_bgr: np.ndarray, force: bool):
+        """新帧（已缩放到会话尺度）与上次编码帧比较，返回 (是否跳过编码, 新帧签名, 变化量)。
+        尺寸变化、会话编码失败或 force 时总是重新编码。"""
+        detector = self.frame_detector
+        if not detector.enabled:
+            return False, None, None
+        sig = detector.signature(image_bgr)
+        if image_bgr.shape[:2] != (session.h, session.w) or session.status == "failed":
+            return False, sig, 1.0
+        delta = detector.delta(session.frame_sig, sig)
+        return (not force and detector.unchanged(delta)), sig, round(delta, 4)
+
+    def _skip_update(self, session: Session, delta: float):
+        """画面几乎没变：沿用 embedding 与掩码，只在会话锁内更新帧差与计时（与 _swap_image 一样持锁写会话状态）。"""
+        import time
+        with session.lock:
+            session.frame_delta, session.embedded = delta, False
+            session.timings.update({"embed_ms": 0.0, "cache": "skipped"})
+            session.last_used = time.time()
+        print(f"[SAM][UpdateImage] sid={session.id[:8]} frame unchanged delta={delta:.4f} "
+              f"< {self.frame_detector.change_thresh} -> keep embedding and masks")
+
+    def _swap_image(self, session: Session, image_bgr: np.ndarray, embed_key: str, embedding: Embedding,
+                    max_side: Optional[int], image_name: Optional[str] = None, zoom_source: tuple = (None, None),
+                    frame_sig: Optional[np.ndarray] = None, frame_delta: Optional[float] = None):
+        """持会话锁一次性替换底图、embedding 并清空旧掩码，进行中的 segment 不会看到新旧混搭的状态。"""
+        with session.lock:
+            session.generation += 1  # 作废仍在后台跑的旧 embedding 任务
+            session.image_bgr = image_bgr
+            session.source_bgr, session.source_bytes = zoom_source
+            session.frame_sig = frame_sig
+            session.frame_delta, session.embedded = frame_delta, True
+            session.crops.clear()
+            session.brushes.clear()
+            session.h, session.w = image_bgr.shape[:2]
+            if image_name:
+                session.image_name = image_name
+            session.embed_key = embed_key
+            session.embedding = embedding
+            session.masks.clear()  # 旧底图的掩码与 logits 不能再用
+            self._mark_ready(session)
+            generation = session.generation
+        self._schedule_final(session, image_bgr, max_side, generation)
+
+    def get_session(self, session_id: str) -> Optional[Session]:
+        with self._sessions_lock:
+            return self.sessions.get(session_id)
+
+    def list_sessions(self) -> List[str]:
+        with self._sessions_lock:
+            return list(self.sessions.keys())
+
     def clear_all_sessions(self):
         """清理所有已存在的会话及其临时目录，防止残留掩码导致坐标错配或磁盘膨胀。"""
-        for sess in list(self.sessions.values()):
-            try:
-                if sess.tmp_dir.exists():
-                    shutil.rmtree(sess.tmp_dir, ignore_errors=True)
-            except Exception:
-                pass
-        self.sessions.clear()
+        with self._sessions_lock:
+            removed = list(self.sessions.values())
+            self.sessions.clear()
+        for sess in removed:
+            with sess.lock:  # 等正在进行的解码结束再释放
+                self._release_session(sess)
         self._torch_empty_cache()
         print("[SAM][GC] Cleared all sessions")
 
+    def stats(self) -> dict:
+        """运行时统计（缓存命中等），供 /sam/stats 调试查看。"""
+        return {
+            "sessions": len(self.sessions),
+            "tiers": [t.describe() for t in self.tiers],
+            "embedding_cache": self.embed_cache.stats(),
+            "inference_pool": self.pool.describe() if self.pool is not None else None,
+            "inference_queue": self.queue.stats(),
+            "auto_segment_cache": self.auto_cache.stats(),
+        }
+
     # ---------------- 内部辅助 -----------------
+    def _mark_ready(self, sess: Session):
+        """同步换图完成后标记就绪。"""
+        sess.status, sess.error = "ready", None
+        sess.ready_event.set()
+
     def _trim_sessions(self):
         if self.max_sessions <= 0:
             return
-        if len(self.sessions) <= self.max_sessions:
-            return
-        # 根据 last_used 排序，淘汰最久未使用的
-        ordered = sorted(self.sessions.values(), key=lambda s: s.last_used)
-        excess = len(self.sessions) - self.max_sessions
-        to_remove = ordered[:excess]
-        for sess in to_remove:
-            try:
-                if sess.tmp_dir.exists():
-                    shutil.rmtree(sess.tmp_dir, ignore_errors=True)
-            except Exception:
-                pass
-            # 显式释放 predictor 引用
-            try:
-                del sess.predictor
-            except Exception:
-                pass
-            self.sessions.pop(sess.id, None)
-            print(f"[SAM][Trim] Removed session {sess.id[:8]}")
-        if to_remove:
+        with self._sessions_lock:
+            if len(self.sessions) <= self.max_sessions:
+                return
+            # 根据 last_used 排序，淘汰最久未使用的；正在解码的会话（锁被占用）跳过
+            ordered = sorted(self.sessions.values(), key=lambda s: s.last_used)
+            excess = len(self.sessions) - self.max_sessions
+            removed = 0
+            for sess in ordered:
+                if removed >= excess:
+                    break
+                if not sess.lock.acquire(blocking=False):
+                    continue
+                try:
+                    self.sessions.pop(sess.id, None)
+                    self._release_session(sess)
+                finally:
+                    sess.lock.release()
+                removed += 1
+                print(f"[SAM][Trim] Removed session {sess.id[:8]}")
+        if removed:
             self._torch_empty_cache()
 
+    def _drop_session(self, sess: Session):
+        with self._sessions_lock:
+            self.sessions.pop(sess.id, None)
+        with sess.lock:
+            self._release_session(sess)
+
+    def _release_session(self, sess: Session):
+        """释放会话资源（调用方持有会话锁）：临时目录、embedding 引用、掩码、推理池亲和绑定。"""
+        try:
+            if sess.tmp_dir.exists():
+                shutil.rmtree(sess.tmp_dir, ignore_errors=True)
+        except Exception:
+            pass
+        # 显式释放 embedding 引用
+        sess.embedding = None
+        sess.final_embedding = None
+        sess.crops.clear()
+        sess.brushes.clear()
+        sess.source_bgr = sess.source_bytes = None
+        sess.masks.clear()
+        if self.pool is not None:
+            self.pool.forget(sess.id)
+
     def _torch_empty_cache(self):
         try:
             import torch
@@ -225,7 +590,15 @@ class SamEngine:
             import psutil, torch, time
             proc = psutil.Process(os.getpid())
             rss = proc.memory_info().rss / 1024 / 1024
-            txt = f"[SAM][Mem][{tag}] sessions={len(self.sessions)} rss={rss:.1f}MB"
+            with self._sessions_lock:
+                sessions = list(self.sessions.values())
+            emb_mb = sum(e.nbytes for s in sessions for e in (s.embedding, s.final_embedding, *s.crops.values()) if e is not None) / 1024 / 1024
+            mask_mb = sum(s.masks.nbytes for s in sessions) / 1024 / 1024
+            # 放大模式源图：常驻的全尺寸 BGR + 待首次放大时解码的编码字节
+            src_mb = sum(s.source_bgr.nbytes for s in sessions if s.source_bgr is not None) / 1024 / 1024
+            enc_mb = sum(len(s.source_bytes) for s in sessions if s.source_bytes is not None) / 1024 / 1024
+            txt = (f"[SAM][Mem][{tag}] sessions={len(sessions)} embeddings={emb_mb:.1f}MB masks={mask_mb:.1f}MB "
+                   f"source={src_mb:.1f}MB encoded={enc_mb:.1f}MB rss={rss:.1f}MB")
             if torch.cuda.is_available():
                 alloc = torch.cuda.memory_allocated() / 1024 / 1024
                 reserved = torch.cuda.memory_reserved() / 1024 / 1024
@@ -234,53 +607,490 @@ class SamEngine:
         except Exception:
             pass
 
-    def segment(self, session_id: str, points, labels, box, multimask: bool, top_n: int, smooth: bool):
-        sess = self.sessions.get(session_id)
-        if not sess:
-            raise ValueError(f"Session not found: {session_id}")
+    def segment(self, session_id: str, points, labels, box, multimask: bool, top_n: int, smooth: bool,
+                wait_timeout: Optional[float] = None, parent_mask_id: Optional[str] = None, zoom: Optional[bool] = None,
+                timings: Optional[dict] = None):
+        """单个提示解码。parent_mask_id 指向上一轮候选时，用其低分辨率 logits 作为 mask_input 继续细化。
+        返回 (候选列表, (w, h), zoom_box)：放大模式下 zoom_box 为裁剪区域的会话坐标，否则为 None。
+        timings 不为 None 时写入 decode_ms 与各候选后处理阶段的累计耗时。"""
+        sess = self.wait_ready(session_id, wait_timeout)
+        self._prepare_zoom(sess, points, box, zoom, parent_mask_id)
+        with sess.lock, self.queue.slot("decode"):
+            return self._segment_locked(sess, points, labels, box, multimask, top_n, smooth, parent_mask_id, zoom,
+                                        timings)
 
-        # 清理旧的候选掩码文件（仅删除纯 32 位 hex 命名的初始候选，保留 *_refined_*）
-        try:
-            for p in sess.tmp_dir.glob('*.png'):
-                stem = p.stem
-                if len(stem) == 32 and '_' not in stem:  # uuid4().hex 长度 32
-                    p.unlink(missing_ok=True)
-        except Exception:
-            pass
+    def _prepare_zoom(self, sess: Session, points, box, zoom: Optional[bool], parent_mask_id: Optional[str]):
+        """放大模式需要新的裁剪 embedding 时，先占编码名额算好并放进会话的裁剪缓存，再去拿解码名额：
+        裁剪编码是一次完整的编码器前向，占着解码名额会让其他会话的点击全部排队。"""
+        with sess.lock:
+            parent = sess.masks.get(parent_mask_id) if parent_mask_id else None
+            if parent_mask_id and parent is None:
+                return  # 由 _segment_locked 报错
+            crop = self._zoom_crop(sess, points, box, zoom, parent)
+            if crop is None or crop in sess.crops:
+                return
+            generation = sess.generation
+            x0, y0, x1, y1 = crop
+            crop_bgr = np.ascontiguousarray(sess.zoom_source()[y0:y1, x0:x1])
+        with self.queue.slot("embed_zoom"):
+            emb = self._embed_crop(sess, crop, crop_bgr)
+        with sess.lock:
+            if sess.generation == generation:  # 期间换了底图则丢弃
+                self._cache_crop(sess, crop, emb)
+
+    def _embed_crop(self, sess: Session, crop: tuple, crop_bgr: np.ndarray):
+        import time
+        t0 = time.perf_counter()
+        emb, cache_hit = self.preview.embed(crop_bgr, self.preview.cache_key(crop_bgr, None), affinity=sess.id)
+        x0, y0, x1, y1 = crop
+        print(f"[SAM][Zoom] sid={sess.id[:8]} crop={crop} size={x1-x0}x{y1-y0} embed={(time.perf_counter()-t0)*1000:.1f}ms "
+              f"cache={'hit' if cache_hit else 'miss'}")
+        return emb
+
+    def _cache_crop(self, sess: Session, crop: tuple, emb):
+        sess.crops[crop] = emb
+        while len(sess.crops) > self.zoom_cache:
+            sess.crops.popitem(last=False)
+
+    def _segment_locked(self, sess: Session, points, labels, box, multimask, top_n, smooth, parent_mask_id, zoom,
+                        timings: Optional[dict] = None):
+        import time
+        mask_input = None
+        parent = None
+        if parent_mask_id:
+            parent = sess.masks.get(parent_mask_id)
+            if parent is None or parent.logits is None:
+                raise ValueError(f"Logits for parent mask not found: {parent_mask_id}")
+            mask_input = parent.logits[None, :, :]
+        crop = self._zoom_crop(sess, points, box, zoom, parent)
+        self._clear_candidates(sess, keep=parent_mask_id)
 
         pc = np.array(points, dtype=np.float32) if points else None
         pl = np.array(labels, dtype=np.int32) if labels else None
         bx = np.array(box, dtype=np.float32) if box is not None else None
 
-        masks, scores, _ = sess.predictor.predict(
-            point_coords=pc,
-            point_labels=pl,
-            box=bx,
-            multimask_output=multimask
-        )
+        prompt = {"points": points, "labels": labels, "box": box, "multimask": multimask, "smooth": smooth}
+        zoom_box = None
+        t0 = time.perf_counter()
+        if crop is None:
+            masks, scores, low_res = self.preview.decode(sess.embedding, pc, pl, bx, mask_input, multimask, affinity=sess.id)
+        else:
+            masks, scores, low_res, zoom_box = self._decode_zoomed(sess, crop, pc, pl, bx, mask_input, multimask)
+            prompt["crop"] = list(crop)  # logits 属于裁剪区域，后续细化必须沿用同一裁剪
+        if timings is not None:
+            timings["decode_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        return self._collect_candidates(sess, masks, scores, low_res, top_n, smooth, parent=parent_mask_id,
+                                        prompt=prompt, timings=timings), (sess.w, sess.h), zoom_box
+
+    def _zoom_crop(self, sess: Session, points, box, zoom: Optional[bool], parent: Optional[MaskRecord]):
+        """决定是否放大，返回源图坐标下的裁剪框 (x0,y0,x1,y1)；不放大返回 None。"""
+        if parent is not None:
+            # 继续细化时 mask_input 必须与父掩码处于同一坐标系
+            crop = (parent.prompt or {}).get("crop")
+            return tuple(crop) if crop else None
+        if box is None or zoom is False or (zoom is None and not self.zoom_auto):
+            return None
+        src_h, src_w = sess.zoom_source().shape[:2]
+        sx, sy = src_w / sess.w, src_h / sess.h  # 会话坐标 -> 源图坐标
+        xs = [box[0], box[2]] + [p[0] for p in points]
+        ys = [box[1], box[3]] + [p[1] for p in points]
+        x0, x1 = max(0.0, min(xs) * sx), min(src_w, max(xs) * sx)
+        y0, y1 = max(0.0, min(ys) * sy), min(src_h, max(ys) * sy)
+        side = max(x1 - x0, y1 - y0)
+        if zoom is None and side > self.zoom_max_fraction * max(src_w, src_h):
+            return None
+        pad = max(self.zoom_pad * side, (self.zoom_min_crop - side) / 2, 0)
+        # 已缓存的裁剪能以至少一半的边距包住当前框、且不比需要的大太多时直接复用
+        need = (max(0, x0 - pad / 2), max(0, y0 - pad / 2), min(src_w, x1 + pad / 2), min(src_h, y1 + pad / 2))
+        for rect in sess.crops:
+            if (rect[0] <= need[0] and rect[1] <= need[1] and rect[2] >= need[2] and rect[3] >= need[3]
+                    and max(rect[2] - rect[0], rect[3] - rect[1]) <= 2 * (side + 2 * pad)):
+                return rect
+        rect = (max(0, int(x0 - pad)), max(0, int(y0 - pad)),
+                min(src_w, int(math.ceil(x1 + pad))), min(src_h, int(math.ceil(y1 + pad))))
+        if rect[2] - rect[0] >= 0.9 * src_w and rect[3] - rect[1] >= 0.9 * src_h:
+            return None  # 裁剪已接近整图，放大没有收益
+        return rect
+
+    def _decode_zoomed(self, sess: Session, crop: tuple, pc, pl, bx, mask_input, multimask: bool):
+        """在源图裁剪区域的 embedding 上解码，再把掩码贴回会话坐标。
+        裁剪 embedding 通常已由 _prepare_zoom 在编码名额里算好；缓存被挤掉时才在这里补算。"""
+        x0, y0, x1, y1 = crop
+        source = sess.zoom_source()
+        emb = sess.crops.get(crop)
+        if emb is None:
+            emb = self._embed_crop(sess, crop, np.ascontiguousarray(source[y0:y1, x0:x1]))
+            self._cache_crop(sess, crop, emb)
+        else:
+            sess.crops.move_to_end(crop)
+
+        src_h, src_w = source.shape[:2]
+        scale = np.array([src_w / sess.w, src_h / sess.h], dtype=np.float32)
+        offset = np.array([x0, y0], dtype=np.float32)
+        cpc = pc * scale - offset if pc is not None else None
+        cbx = (bx.reshape(2, 2) * scale - offset).reshape(4) if bx is not None else None
+        masks, scores, low_res = self.preview.decode(emb, cpc, pl, cbx, mask_input, multimask, affinity=sess.id)
+
+        # 裁剪区域在会话坐标中的位置；掩码按面积插值缩放后贴回整图
+        tx0, ty0 = int(round(x0 / scale[0])), int(round(y0 / scale[1]))
+        tx1 = max(tx0 + 1, min(sess.w, int(round(x1 / scale[0]))))
+        ty1 = max(ty0 + 1, min(sess.h, int(round(y1 / scale[1]))))
+        full = np.zeros((len(masks), sess.h, sess.w), dtype=bool)
+        for i, m in enumerate(masks):
+            m8 = m.astype(np.uint8) * 255
+            if m8.shape != (ty1 - ty0, tx1 - tx0):
+                m8 = cv2.resize(m8, (tx1 - tx0, ty1 - ty0), interpolation=cv2.INTER_AREA)
+            full[i, ty0:ty1, tx0:tx1] = m8 > 127
+        return full, scores, low_res, [tx0, ty0, tx1, ty1]
+
+    def segment_batch(self, session_id: str, prompts, multimask: bool, top_n: int, smooth: bool,
+                      wait_timeout: Optional[float] = None, timings: Optional[dict] = None):
+        """同一会话的多个 (points, labels, box) 提示一次性送入解码器，返回每个提示的候选列表。
+        点数不一致时用 label=-1 的占位点补齐（SAM 的 not-a-point）。timings 同 segment（后处理耗时按全部提示累计）。"""
+        sess = self.wait_ready(session_id, wait_timeout)
+        if not prompts:
+            return [], (sess.w, sess.h)
+        for points, labels, _ in prompts:
+            if len(points) != len(labels):
+                raise ValueError("points and labels must have the same length")
+        with sess.lock, self.queue.slot("decode_batch"):
+            return self._segment_batch_locked(sess, prompts, multimask, top_n, smooth, timings)
 
-        # 统一为 (K,H,W)
-        if masks.ndim == 2:
-            masks = masks[None, ...]
-            scores = np.array([float(scores)])
+    def _segment_batch_locked(self, sess: Session, prompts, multimask: bool, top_n: int, smooth: bool,
+                              timings: Optional[dict] = None):
+        self._clear_candidates(sess)
 
+        results = []
+        if not self.preview.batched:
+            # ONNX 解码图的 batch 维固定为 1，逐个提示跑（ORT 本身开销很小）
+            for points, labels, box in prompts:
+                pc = np.array(points, dtype=np.float32) if points else None
+                pl = np.array(labels, dtype=np.int32) if labels else None
+                masks, scores, low_res = self.preview.decode(sess.embedding, pc, pl, np.array(box, dtype=np.float32), None, multimask,
+                                                              affinity=sess.id)
+                prompt = {"points": points, "labels": labels, "box": box, "multimask": multimask, "smooth": smooth}
+                results.append(self._collect_candidates(sess, masks, scores, low_res, top_n, smooth, prompt=prompt,
+                                                        timings=timings))
+            return results, (sess.w, sess.h)
+        for start in range(0, len(prompts), self.decode_batch):
+            chunk = prompts[start:start + self.decode_batch]
+            n_pts = max(len(points) for points, _, _ in chunk)
+            pc = pl = None
+            if n_pts:
+                pc = np.zeros((len(chunk), n_pts, 2), dtype=np.float32)
+                pl = np.full((len(chunk), n_pts), -1, dtype=np.int32)
+                for i, (points, labels, _) in enumerate(chunk):
+                    if points:
+                        pc[i, :len(points)] = np.array(points, dtype=np.float32)
+                        pl[i, :len(labels)] = np.array(labels, dtype=np.int32)
+            bx = np.array([box for _, _, box in chunk], dtype=np.float32)
+            masks, scores, low_res = self.preview.predict_batch(sess.embedding, pc, pl, bx, multimask, affinity=sess.id)
+            for i, (points, labels, box) in enumerate(chunk):
+                prompt = {"points": points, "labels": labels, "box": box, "multimask": multimask, "smooth": smooth}
+                results.append(self._collect_candidates(sess, masks[i], scores[i], low_res[i], top_n, smooth, prompt=prompt,
+                                                        timings=timings))
+        return results, (sess.w, sess.h)
+
+    def auto_segment(self, session_id: str, points_per_side: int = 16, points_per_batch: int = 32,
+                     pred_iou_thresh: float = 0.88, stability_thresh: float = 0.92, nms_iou: float = 0.7,
+                     min_area: int = 500, max_area_ratio: float = 0.9, max_masks: int = 64, smooth: bool = True,
+                     wait_timeout: Optional[float] = None):
+        """整图自动分割：网格撒点批量解码 + 过滤 + NMS，结果登记为 kind=auto 的掩码。
+        同一张图（embedding key）+ 相同参数的结果走缓存，不再解码。
+        返回 ([(mask_id, path, AutoMask)], (w, h), 是否命中缓存)。"""
+        import time
+        sess = self.wait_ready(session_id, wait_timeout)
+        params = (points_per_side, points_per_batch, pred_iou_thresh, stability_thresh, nms_iou, min_area,
+                  max_area_ratio, max_masks, smooth)
+        t0 = time.perf_counter()
+        with sess.lock:
+            key = f"{sess.embed_key}:{self.preview.name}:" + ",".join(str(p) for p in params)
+            items = self.auto_cache.get(key)
+            cached = items is not None
+            if items is None:
+                with self.queue.slot("auto"):
+                    items = self._auto_masks(sess, *params)
+                self.auto_cache.put(key, items)
+            t1 = time.perf_counter()
+            sess.masks.drop_kind("auto")
+            out = []
+            for m in items:
+                mask_id = uuid.uuid4().hex
+                prompt = {"points": [list(m.point)], "labels": [1], "box": None, "multimask": True, "smooth": smooth}
+                path = self.put_mask(sess, mask_id, m.full(sess.h, sess.w), kind="auto", score=m.score,
+                                     tier=self.preview.name, prompt=prompt)
+                out.append((mask_id, path, m))
+        print(f"[SAM][Auto] sid={sess.id[:8]} masks={len(out)} cache={'hit' if cached else 'miss'} "
+              f"decode={(t1-t0)*1000:.1f}ms register={(time.perf_counter()-t1)*1000:.1f}ms")
+        return out, (sess.w, sess.h), cached
+
+    def _auto_masks(self, sess: Session, points_per_side: int, points_per_batch: int, pred_iou_thresh: float,
+                    stability_thresh: float, nms_iou: float, min_area: int, max_area_ratio: float, max_masks: int,
+                    smooth: bool) -> List[AutoMask]:
+        grid = point_grid(sess.w, sess.h, points_per_side)
+        max_area = max_area_ratio * sess.w * sess.h
+        cands: List[AutoMask] = []
+        for start in range(0, len(grid), max(1, points_per_batch)):
+            pts = grid[start:start + max(1, points_per_batch)]
+            labels = np.ones((len(pts), 1), dtype=np.int32)
+            if self.preview.batched:
+                masks, scores, low_res = self.preview.predict_batch(sess.embedding, pts[:, None, :], labels, None, True,
+                                                                    affinity=sess.id)
+            else:
+                outs = [self.preview.decode(sess.embedding, pt[None, :], lb, None, None, True, affinity=sess.id)
+                        for pt, lb in zip(pts, labels)]
+                masks, scores, low_res = (np.stack(x) for x in zip(*outs))
+            n_out = scores.shape[1]
+            masks = masks.reshape(-1, *masks.shape[-2:])
+            scores = scores.reshape(-1)
+            low_res = low_res.reshape(-1, *low_res.shape[-2:])
+            stability = stability_score(low_res)
+            for i in np.flatnonzero((scores >= pred_iou_thresh) & (stability >= stability_thresh)):
+                m = masks[i] > 0
+                area = int(m.sum())
+                if area < min_area or area > max_area:
+                    continue
+                x0, y0, x1, y1 = mask_bbox(m)
+                point = pts[i // n_out]
+                cands.append(AutoMask(crop=m[y0:y1, x0:x1].astype(np.uint8), bbox=(x0, y0, x1, y1), score=float(scores[i]),
+                                      stability=float(stability[i]), area=area, point=(float(point[0]), float(point[1]))))
+        if not cands:
+            return []
+        boxes = np.array([c.bbox for c in cands], dtype=np.float32)
+        keep = box_nms(boxes, np.array([c.score for c in cands]), nms_iou)
+        result = []
+        for i in keep:
+            c = cands[i]
+            if smooth:
+                # 平滑会改变面积与外接框：重新计算，平滑后不再满足面积条件的丢弃，由 NMS 顺序中的下一个补上
+                c.crop = self._smooth_mask(c.crop)
+                area = int(np.count_nonzero(c.crop))
+                box = tight_bbox(c.crop)
+                if box is None or area < min_area or area > max_area:
+                    continue
+                bx0, by0, bx1, by1 = box
+                x0, y0 = c.bbox[:2]
+                if (bx1 - bx0, by1 - by0) != c.crop.shape[::-1]:
+                    c.crop = c.crop[by0:by1, bx0:bx1].copy()  # 缓存按 nbytes 计费，不留整块父数组
+                c.bbox, c.area = (x0 + bx0, y0 + by0, x0 + bx1, y0 + by1), area
+            result.append(c)
+            if len(result) >= max(1, max_masks):
+                break
+        return result
+
+    def _collect_candidates(self, sess: Session, masks: np.ndarray, scores: np.ndarray, low_res: np.ndarray,
+                            top_n: int, smooth: bool, parent: Optional[str] = None, prompt: Optional[dict] = None,
+                            timings: Optional[dict] = None):
+        """按分数取前 top_n 个候选 (K,H,W)，平滑后登记并记录 logits，返回 [(mask_id, path, score)]。
+        每个候选的后处理只在其外接框窗口内进行，各阶段耗时累加到 timings。"""
         order = np.argsort(scores)[::-1][:max(1, int(top_n))]
         out = []
         for i in order:
             mask = (masks[i] > 0).astype(np.uint8)
+            if smooth:
+                mask = self._smooth_mask(mask, timings)
+            mask_id = uuid.uuid4().hex
+            path = self.put_mask(sess, mask_id, mask, kind="candidate", score=float(scores[i]), parent=parent,
+                                 logits=np.asarray(low_res[i], dtype=np.float32), tier=self.preview.name, prompt=prompt)
+            out.append((mask_id, path, float(scores[i])))
+        return out
+
+    def _clear_candidates(self, sess: Session, keep: Optional[str] = None):
+        # 丢弃上一轮的候选（保留 refined 与正在作为 parent 的那个）
+        n = sess.masks.drop_kind("candidate", keep=keep)
+        if n:
+            print(f"[SAM][Masks] sid={sess.id[:8]} dropped {n} stale candidates")
+
+    # ---------------- 掩码存取 -----------------
+    def put_mask(self, sess: Session, mask_id: str, mask01: np.ndarray, kind: str = "refined",
+                 score: Optional[float] = None, parent: Optional[str] = None,
+                 logits: Optional[np.ndarray] = None, tier: Optional[str] = None,
+                 prompt: Optional[dict] = None) -> str:
+        """登记一个 0/1 掩码（只放内存，不编码 PNG），返回前端可访问的 URL 路径。
+        未指定 tier 时继承父掩码的档位（例如笔刷细化）。"""
+        with sess.lock:
+            if tier is None and parent:
+                parent_rec = sess.masks.get(parent)
+                tier = parent_rec.tier if parent_rec is not None else None
+            sess.masks.register(mask01, MaskRecord(mask_id=mask_id, kind=kind, score=score, parent=parent, logits=logits,
+                                                   tier=tier, prompt=prompt))
+        return f"/sam/mask/{sess.id}/{mask_id}"
+
+    # ---------------- 笔刷删补 -----------------
+    def brush_apply(self, sess: Session, mask_id: str, samples: List[BrushSample]):
+        """在 mask_id 所在的笔刷链上叠加笔画；mask_id 不是任何链的头部时以它为基础新开一条链。
+        返回 (BrushState, 脏矩形)，基础掩码不存在时返回 (None, None)；笔画没有改动任何像素时不发布新版本，
+        脏矩形为 None、头部仍是 mask_id。"""
+        with sess.lock:
+            state = sess.brushes.get(mask_id)
+            if state is None:
+                base = sess.masks.mask(mask_id)
+                if base is None:
+                    return None, None
+                state = BrushState(mask_id, base, self.brush_undo)
+            rect = state.apply(samples, self.brush_join_gap)
+            if rect is not None:
+                self._publish_brush(sess, state, mask_id)
+            return state, rect
+
+    def smart_brush(self, session_id: str, mask_id: str, samples: List[BrushSample], smooth: bool = True,
+                    wait_timeout: Optional[float] = None):
+        """智能笔刷：笔画沿线采样为正/负点提示，与生成该掩码的原提示（框 + 点）合并，
+        以当前掩码的 logits 作 mask_input 在会话 embedding 上解码一次，结果吸附到画面边缘并写回笔刷链。
+        返回 (BrushState, 脏矩形, 分数)，掩码不存在时返回 (None, None, None)。"""
+        import time
+        sess = self.wait_ready(session_id, wait_timeout)
+        t0 = time.perf_counter()
+        with sess.lock, self.queue.slot("decode"):
+            rec = sess.masks.get(mask_id)
+            state = sess.brushes.get(mask_id)
+            if state is None:
+                base = sess.masks.mask(mask_id)
+                if rec is None or base is None:
+                    return None, None, None
+                state = BrushState(mask_id, base, self.brush_undo)
+                state.logits, state.prompt = rec.logits, rec.prompt
+            stroke_pts, stroke_lbs = stroke_prompts(samples, self.smart_brush_points, self.brush_join_gap)
+            if not stroke_pts:
+                raise ValueError("Smart brush needs at least one add/erase stroke")
+            base_prompt = state.prompt or self._origin_prompt(sess, rec) or {}
+            points = list(base_prompt.get("points") or []) + stroke_pts
+            labels = list(base_prompt.get("labels") or []) + stroke_lbs
+            box = base_prompt.get("box")
+            crop = None
+            if state.logits is not None:
+                mask_input, mask_source = state.logits[None, :, :], "logits"
+                crop = base_prompt.get("crop")  # logits 属于放大裁剪区域时沿用同一裁剪
+            else:
+                mask_input, mask_source = self._mask_logits(state.mask)[None, :, :], "pixels"
+
+            pc = np.array(points, dtype=np.float32)
+            pl = np.array(labels, dtype=np.int32)
+            bx = np.array(box, dtype=np.float32) if box is not None else None
+            if crop is None:
+                masks, scores, low_res = self.preview.decode(sess.embedding, pc, pl, bx, mask_input, False, affinity=sess.id)
+            else:
+                masks, scores, low_res, _ = self._decode_zoomed(sess, tuple(crop), pc, pl, bx, mask_input, False)
+            mask = (masks[0] > 0).astype(np.uint8)
             if smooth:
                 mask = self._smooth_mask(mask)
-            path = self._save_mask_png(sess, mask)
-            out.append((path, float(scores[i])))
-        return out, (sess.w, sess.h)
-
-    def _save_mask_png(self, sess: Session, mask: np.ndarray) -> str:
-        path = sess.tmp_dir / f"{uuid.uuid4().hex}.png"
-        cv2.imwrite(str(path), (mask * 255).astype(np.uint8))
-        return str(path)
-
-    def _smooth_mask(self, mask: np.ndarray) -> np.ndarray:
-        kernel = np.ones((3,3), np.uint8)
-        m = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, iterations=1)
-        m = cv2.morphologyEx(m, cv2.MORPH_CLOSE, kernel, iterations=1)
-        return (m > 0).astype(np.uint8)
+            prompt = {"points": points, "labels": labels, "box": box, "multimask": False, "smooth": smooth}
+            if crop is not None:
+                prompt["crop"] = list(crop)
+            rect = state.replace(mask, logits=np.asarray(low_res[0], dtype=np.float32), prompt=prompt)
+            self._publish_brush(sess, state, mask_id)
+        print(f"[SAM][SmartBrush] sid={sess.id[:8]} stroke_points={len(stroke_pts)} base_points={len(points)-len(stroke_pts)} "
+              f"box={box is not None} mask_input={mask_source} "
+              f"score={float(scores[0]):.3f} zoom={crop is not None} decode={(time.perf_counter()-t0)*1000:.1f}ms")
+        return state, rect, float(scores[0])
+
+    def _origin_prompt(self, sess: Session, rec: Optional[MaskRecord]) -> Optional[dict]:
+        """沿 parent 链向上找到最近一个带提示的掩码（像素级笔刷结果本身没有提示）。"""
+        seen = set()
+        while rec is not None and rec.mask_id not in seen:
+            if rec.prompt:
+                return rec.prompt
+            seen.add(rec.mask_id)
+            rec = sess.masks.get(rec.parent) if rec.parent else None
+        return None
+
+    def _mask_logits(self, mask: np.ndarray) -> np.ndarray:
+        """由 0/1 掩码构造 SAM 的 256x256 mask_input：按 ResizeLongestSide 缩放到长边 256、右下补零，
+        前景 +L、背景 -L（L = SAM_SMART_BRUSH_LOGIT）。"""
+        h, w = mask.shape[:2]
+        scale = 256.0 / max(h, w)
+        small = cv2.resize(mask.astype(np.float32), (max(1, int(round(w * scale))), max(1, int(round(h * scale)))),
+                           interpolation=cv2.INTER_AREA)
+        logits = np.full((256, 256), -self.smart_brush_logit, dtype=np.float32)
+        logits[:small.shape[0], :small.shape[1]] = (small * 2 - 1) * self.smart_brush_logit
+        return logits
+
+    def brush_history(self, sess: Session, mask_id: str, redo: bool = False):
+        """撤销/重做 mask_id（笔刷链头部）上的一步，返回 (BrushState, 脏矩形)；不是链头部时返回 (None, None)。"""
+        with sess.lock:
+            state = sess.brushes.get(mask_id)
+            if state is None:
+                return None, None
+            rect = state.redo_step() if redo else state.undo_step()
+            if rect is not None:
+                self._publish_brush(sess, state, mask_id)
+            return state, rect
+
+    def _publish_brush(self, sess: Session, state: BrushState, old_head: str):
+        """以新 ID 登记链的可写掩码（不拷贝），替换旧的头部；基础候选掩码保留。调用方持有会话锁。"""
+        # 同一基础掩码可能同时有多条链，ID 不能按链内序号生成，否则会互相覆盖
+        new_head = f"{state.base_id}_refined_{uuid.uuid4().hex}"
+        base_rec = sess.masks.get(state.base_id)
+        sess.masks.register(state.mask, MaskRecord(mask_id=new_head, kind="refined", parent=state.base_id,
+                                                   logits=state.logits, prompt=state.prompt,
+                                                   tier=base_rec.tier if base_rec is not None else None), copy=False)
+        if old_head != state.base_id:
+            sess.masks.discard(old_head)
+        sess.brushes.pop(old_head, None)
+        sess.brushes[new_head] = state
+        state.head_id = new_head
+        while len(sess.brushes) > self.max_brushes:
+            sess.brushes.popitem(last=False)
+
+    def get_mask(self, sess: Session, mask_id: str) -> Optional[np.ndarray]:
+        """按登记表取 0/1 掩码（内存或 spill 文件），O(1)。"""
+        return sess.masks.mask(mask_id)
+
+    def get_mask_png(self, sess: Session, mask_id: str) -> Optional[bytes]:
+        """取 PNG 字节：首次请求时才编码，之后复用。"""
+        return sess.masks.png(mask_id)
+
+    def inline_mask(self, sess: Session, mask_id: str, fmt: str) -> Optional[dict]:
+        """segment 响应内联用：bbox 裁剪后的 rle / bitmap 编码，掩码已不存在时返回 None。"""
+        mask = sess.masks.mask(mask_id)
+        return None if mask is None else encode_mask(mask, fmt)
+
+    def mask_contours(self, sess: Session, mask_id: str, tolerance: Optional[float] = None) -> Optional[list]:
+        """预览描边用的简化多边形（含孔洞），tolerance 缺省用 SAM_CONTOUR_TOLERANCE。"""
+        mask = sess.masks.mask(mask_id)
+        if mask is None:
+            return None
+        return mask_polygons(mask, self.contour_tolerance if tolerance is None else tolerance, self.contour_min_area)
+
+    def resolve_export_mask(self, sess: Session, mask_id: str,
+                            reject: bool = True) -> Tuple[Optional[np.ndarray], Optional[str]]:
+        """导出用的最终掩码，返回 (mask01, tier)。
+        双档模式下预览档的候选会用相同提示在最终档（大模型）上重新解码，取与预览掩码 IoU 最高的候选；
+        最终档 embedding 未就绪（超时 SAM_FINAL_TIMEOUT）或掩码没有提示（如笔刷细化）时沿用原掩码。
+        reject=False 用于后台导出任务：推理队列满时排队等待而不是抛 InferenceQueueFull。"""
+        with sess.lock:
+            rec = sess.masks.get(mask_id)
+            mask = sess.masks.mask(mask_id)
+            # 笔刷链的头部掩码会被后续笔画原地修改，导出用锁内拷贝
+            if mask is not None and rec is not None and rec.kind == "refined":
+                mask = mask.copy()
+        if rec is None or mask is None:
+            return None, None
+        if not self.two_tier or rec.tier != self.preview.name or rec.prompt is None or rec.prompt.get("crop"):
+            # 放大模式的掩码已在源图分辨率上解码，不再换档重解
+            return mask, rec.tier
+        # 等待最终档时不持会话锁，避免阻塞同一会话的交互点击
+        if sess.final_status == "pending":
+            sess.final_event.wait(self.final_timeout)
+        with sess.lock:
+            final_embedding = sess.final_embedding if mask_id in sess.masks else None
+        if sess.final_status != "ready" or final_embedding is None:
+            print(f"[SAM][Export] sid={sess.id[:8]} final tier {sess.final_status}, using {rec.tier} mask")
+            return mask, rec.tier
+        p = rec.prompt
+        pc = np.array(p["points"], dtype=np.float32) if p["points"] else None
+        pl = np.array(p["labels"], dtype=np.int32) if p["labels"] else None
+        bx = np.array(p["box"], dtype=np.float32) if p["box"] is not None else None
+        with self.queue.slot("decode_final", reject=reject):
+            masks, _, _ = self.final.decode(final_embedding, pc, pl, bx, None, p["multimask"], affinity=sess.id)
+        ref = mask > 0
+        ious = [np.logical_and(m, ref).sum() / max(1, np.logical_or(m, ref).sum()) for m in masks]
+        best = (masks[int(np.argmax(ious))] > 0).astype(np.uint8)
+        if p.get("smooth"):
+            best = self._smooth_mask(best)
+        return best, self.final.name
+
+    def _smooth_mask(self, mask: np.ndarray, timings: Optional[dict] = None) -> np.ndarray:
+        """开闭运算 + 填小孔 + 去小连通域，只在掩码外接框窗口内计算（见 postprocess.refine_mask）。"""
+        return refine_mask(mask, self.smooth_kernel, self.smooth_kernel, self.mask_hole_area, self.mask_min_region,
+                           timings=timings)
@@ -1,46 +1,78 @@
+import json
+import time
 import uuid
 from pathlib import Path
+from typing import Optional
 import cv2
 import numpy as np
-from .postprocess import rgba_from_bgr_and_mask, save_rgba, save_rgba_soft, feather_edges
+from .postprocess import rgba_from_bgr_and_mask, binary01, feather_edges, tight_bbox
 
 def split_and_export(image_bgr: np.ndarray, mask: np.ndarray, out_root: Path,
-                     min_area: int = 500, max_elements: int = 20):
+                     min_area: int = 500, max_elements: int = 20, *,
+                     feather_px: int = 0, executor=None, timings: Optional[dict] = None):
     """
-    备选：把“总掩码”拆成多个元素（连通域），各自导出 sprite.png。
+    把“总掩码”拆成多个元素（连通域），各自导出 sprite.png，并在 out_root 写 manifest.json。
+    - 一次 connectedComponentsWithStats 得到所有连通域的面积与外接框，每个元素只在自己的外接框切片上取 labels == i，
+      不再为每个连通域扫描整幅图像
+    - 面积 < min_area 的丢弃（计入 dropped）；超过 max_elements 时保留面积最大的，其余计入 truncated，
+      输出按标号（自上而下的扫描顺序）排列
+    - feather_px > 0 时外接框外扩 feather_px 再柔化，bbox 为 sprite 在原图中的位置（含外扩）
+    - executor 不为 None 时各元素的裁剪/柔化/PNG 编码并行执行（OpenCV 释放 GIL）
+    返回 (manifest, manifest_path)，manifest["elements"] 为各元素的 uuid / sprite_path / bbox / area
     """
+    t0 = time.perf_counter()
     out_root.mkdir(parents=True, exist_ok=True)
-    m = (mask > 0).astype(np.uint8)
-    num, labels = cv2.connectedComponents(m)
-    elements = []
-    for i in range(1, num):
-        part = (labels == i).astype(np.uint8)
-        area = int(part.sum())
-        if area < min_area:
-            continue
-        ys, xs = np.where(part > 0)
-        ymin, ymax = int(ys.min()), int(ys.max())
-        xmin, xmax = int(xs.min()), int(xs.max())
+    m = binary01(mask)
+    num, labels, stats, _ = cv2.connectedComponentsWithStats(m, connectivity=8)
+    area = stats[:, cv2.CC_STAT_AREA]
+    ids = [i for i in range(1, num) if area[i] >= min_area]
+    dropped = (num - 1) - len(ids)
+    truncated = max(0, len(ids) - max(0, max_elements))
+    if truncated:
+        ids = sorted(sorted(ids, key=lambda i: -area[i])[:max(0, max_elements)])
+    t1 = time.perf_counter()
 
-        crop_rgba = rgba_from_bgr_and_mask(
-            image_bgr[ymin:ymax+1, xmin:xmax+1],
-            part[ymin:ymax+1, xmin:xmax+1]
-        )
+    H, W = m.shape
+    pad = max(0, int(np.ceil(feather_px)))
 
+    def export_one(i):
+        x, y, w, h = (int(v) for v in stats[i, :4])
+        x0, y0 = max(0, x - pad), max(0, y - pad)
+        x1, y1 = min(W, x + w + pad), min(H, y + h + pad)
+        part = (labels[y0:y1, x0:x1] == i).astype(np.uint8)
+        if pad:
+            rgba = cv2.cvtColor(image_bgr[y0:y1, x0:x1], cv2.COLOR_BGR2BGRA)
+            rgba[:, :, 3] = feather_edges(part, radius_px=feather_px)
+        else:
+            rgba = rgba_from_bgr_and_mask(image_bgr[y0:y1, x0:x1], part)
         eid = str(uuid.uuid4())
         el_dir = out_root / eid
         el_dir.mkdir(parents=True, exist_ok=True)
         sprite_path = el_dir / "sprite.png"
-        cv2.imwrite(str(sprite_path), crop_rgba)
-
-        elements.append({
+        cv2.imwrite(str(sprite_path), rgba)
+        return {
             "uuid": eid,
             "sprite_path": str(sprite_path),
-            "bbox": {"xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax}
-        })
-        if len(elements) >= max_elements:
-            break
-    return elements
+            "bbox": {"xmin": x0, "ymin": y0, "xmax": x1 - 1, "ymax": y1 - 1},
+            "area": int(area[i]),
+        }
+
+    if executor is not None and len(ids) > 1:
+        elements = list(executor.map(export_one, ids))
+    else:
+        elements = [export_one(i) for i in ids]
+    t2 = time.perf_counter()
+
+    manifest_path = out_root / "manifest.json"
+    manifest = {"width": W, "height": H, "min_area": min_area, "feather_px": feather_px,
+                "components": num - 1, "dropped": dropped, "truncated": truncated,
+                "elements": elements}
+    manifest_path.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    if timings is not None:
+        timings["label_ms"] = round((t1 - t0) * 1000, 2)
+        timings["encode_ms"] = round((t2 - t1) * 1000, 2)
+        timings["manifest_ms"] = round((time.perf_counter() - t2) * 1000, 2)
+    return manifest, manifest_path
 
 def export_single(image_bgr: np.ndarray,
                   mask01: np.ndarray,
@@ -52,33 +84,64 @@ def export_single(image_bgr: np.ndarray,
     - image_bgr: ROI区域的原图
     - mask01: ROI区域的mask (0/1 或 0/255)
     - 输出: 整个ROI区域的RGBA图像，mask区域保留原图，非mask区域透明
+    - 外接框用 cv2.boundingRect 求得（不再 np.where 整图），柔化只在外接框外扩 feather_px 的窗口内计算
     """
-    m = (mask01 > 0).astype(np.uint8)
-    if m.sum() == 0:
-        raise ValueError("export_single: empty mask")
-
     # 确保image_bgr和mask01的尺寸匹配
     if image_bgr.shape[:2] != mask01.shape[:2]:
         raise ValueError(f"Image shape {image_bgr.shape[:2]} doesn't match mask shape {mask01.shape[:2]}")
 
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-
-    if feather_px and feather_px > 0:
-        # 使用柔化边缘
-        alpha = feather_edges(m, radius_px=feather_px)
-        rgba = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2BGRA)
-        rgba[:, :, 3] = alpha
-        cv2.imwrite(str(out_path), rgba)
-    else:
-        # 直接使用mask作为alpha通道
-        save_rgba(image_bgr, m, str(out_path))
-
+    timings = {}
+    t0 = time.perf_counter()
+    m = binary01(mask01)
     # 计算实际内容的边界框（用于定位）
-    ys, xs = np.where(m > 0)
-    ymin, ymax = int(ys.min()), int(ys.max())
-    xmin, xmax = int(xs.min()), int(xs.max())
+    box = tight_bbox(m)
+    if box is None:
+        raise ValueError("export_single: empty mask")
+    timings["bbox_ms"] = round((time.perf_counter() - t0) * 1000, 2)
 
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    # 使用柔化边缘；feather_px<=0 时直接使用mask作为alpha通道
+    alpha = feather_edges(m, radius_px=feather_px, timings=timings)
+    t1 = time.perf_counter()
+    rgba = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2BGRA)
+    rgba[:, :, 3] = alpha
+    cv2.imwrite(str(out_path), rgba)
+    timings["encode_ms"] = round((time.perf_counter() - t1) * 1000, 2)
+
+    xmin, ymin, xmax, ymax = box[0], box[1], box[2] - 1, box[3] - 1
     return {
         "sprite_path": str(out_path),
-        "bbox": {"xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax}
+        "bbox": {"xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax},
+        "timings": timings,
     }
+
+def export_roi(image_bgr: np.ndarray,
+               mask01: np.ndarray,
+               out_path: Path,
+               roi_box=None,
+               *,
+               feather_px: int = 0):
+    """
+    /sam/export-roi 与导出任务共用：给了 roi_box (x, y, w, h) 时先裁剪到 ROI（坐标夹到图像范围内）再导出，
+    返回的 bbox 仍是整图坐标
+    """
+    if image_bgr.shape[:2] != mask01.shape[:2]:
+        raise ValueError(f"Image shape {image_bgr.shape[:2]} doesn't match mask shape {mask01.shape[:2]}")
+    if not roi_box:
+        return export_single(image_bgr, mask01, out_path, feather_px=feather_px)
+    h_img, w_img = image_bgr.shape[:2]
+    x, y, w, h = roi_box
+    x = max(0, int(x))
+    y = max(0, int(y))
+    w = min(w_img - x, int(w))
+    h = min(h_img - y, int(h))
+    if w <= 0 or h <= 0:
+        raise ValueError(f"roi_box {tuple(roi_box)} is outside the image ({w_img}x{h_img})")
+    info = export_single(image_bgr[y:y+h, x:x+w], mask01[y:y+h, x:x+w], out_path, feather_px=feather_px)
+    # ROI 内坐标加回偏移
+    bbox = info["bbox"]
+    bbox["xmin"] += x
+    bbox["ymin"] += y
+    bbox["xmax"] += x
+    bbox["ymax"] += y
+    return info
@@ -0,0 +1,233 @@
+"""
+SAM 多进程推理池（CPU）
+
+- API 进程加载一次模型并 share_memory()，worker 进程（spawn）通过共享内存映射同一份只读权重，
+  N 个 worker 不会占用 N 份模型内存
+- 每个 worker 各自持有 SamPredictor / ONNX 会话 / int8 编码器等小对象，独立使用 torch 线程
+- 请求按会话亲和（tier + session_id）路由：同一会话的编码/解码始终落在同一个 worker 上，
+  新会话分给当前会话数最少的 worker；不同展台的会话在不同核上并发
+- 会话、掩码、embedding 缓存仍留在 API 进程；embedding 张量通过共享内存传给 worker，不做拷贝
+"""
+import itertools
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Dict, List, Optional, Tuple
+
+import torch
+import torch.multiprocessing as mp
+
+from .model_tier import ModelTier
+
+_MAX_AFFINITY = 4096
+
+
+def _worker_main(index: int, specs: List[dict], threads: int, requests, responses):
+    """worker 进程入口：用共享的模型构建各档位，然后循环执行 (req_id, tier, op, args)。"""
+    torch.set_num_threads(max(1, threads))
+    try:
+        tiers = {s["name"]: ModelTier(s["name"], s["model_type"], s["weights_path"], "cpu", embed_cache=None,
+                                      encoder_mode=s["encoder_mode"], decoder_backend=s["decoder_backend"],
+                                      model=s["model"], in_worker=True)
+                 for s in specs}
+    except Exception as e:
+        responses.put((None, index, False, f"worker init failed: {e}"))
+        return
+    responses.put((None, index, True, os.getpid()))
+    while True:
+        msg = requests.get()
+        if msg is None:
+            break
+        req_id, tier, op, args = msg
+        try:
+            result = getattr(tiers[tier], op)(*args)
+            responses.put((req_id, index, True, result))
+        except Exception as e:
+            responses.put((req_id, index, False, f"{type(e).__name__}: {e}"))
+
+
+class InferencePool:
+    def __init__(self, tiers: List[ModelTier], workers: int, threads: Optional[int] = None,
+                 timeout: Optional[float] = None):
+        if threads is None:
+            try:
+                threads = int(os.getenv("SAM_INFER_THREADS", "0"))
+            except ValueError:
+                threads = 0
+            if threads <= 0:
+                threads = max(1, (os.cpu_count() or 1) // workers)
+        if timeout is None:
+            try:
+                timeout = float(os.getenv("SAM_INFER_TIMEOUT", "120"))
+            except ValueError:
+                timeout = 120.0
+        self.workers = workers
+        self.threads = threads
+        self.timeout = timeout
+        self.tier_names = [t.name for t in tiers]
+
+        t0 = time.perf_counter()
+        specs = []
+        for tier in tiers:
+            tier.model.share_memory()
+            specs.append({
+                "name": tier.name,
+                "model_type": tier.model_type,
+                "weights_path": tier.weights_path,
+                "encoder_mode": tier.encoder_mode,
+                "decoder_backend": tier.decoder_backend,  # 父进程 ONNX 校验失败时这里已回退为 torch
+                "model": tier.model,
+            })
+        ctx = mp.get_context("spawn")
+        self._responses = ctx.Queue()
+        self._requests = [ctx.Queue() for _ in range(workers)]
+        self._procs = [ctx.Process(target=_worker_main, args=(i, specs, threads, self._requests[i], self._responses),
+                                   name=f"sam-infer-{i}", daemon=True)
+                       for i in range(workers)]
+        for p in self._procs:
+            p.start()
+
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, Tuple[int, Future]] = {}
+        self._inflight = [0] * workers
+        self._calls = [0] * workers
+        self._assigned = [0] * workers
+        self._affinity: "OrderedDict[str, int]" = OrderedDict()
+        self._closed = False
+        self._await_workers()
+        self._dispatcher = threading.Thread(target=self._dispatch, name="sam-infer-dispatch", daemon=True)
+        self._dispatcher.start()
+        print(f"[SAM][Pool] workers={workers} threads_per_worker={threads} tiers={self.tier_names} "
+              f"start_time={(time.perf_counter()-t0)*1000:.1f}ms")
+
+    # ---------------- 调用 -----------------
+    def call(self, tier: str, affinity: Optional[str], op: str, *args):
+        """把 ModelTier 的 op 发到会话所属的 worker 上执行，阻塞等待结果。"""
+        return self._submit(self._route(tier, affinity), tier, op, args).result(timeout=self.timeout)
+
+    def broadcast(self, tier: str, op: str, *args) -> list:
+        """在每个 worker 上各执行一次（预热用）。
+        逐个 worker 执行：所有 worker 同时预热时在核数不足的机器上互相抢 CPU，容易整体超过 SAM_INFER_TIMEOUT；
+        单个 worker 仍超时只记日志并跳过（返回结果里不含它），预热失败不应让服务起不来。"""
+        results = []
+        for i in range(self.workers):
+            try:
+                results.append(self._submit(i, tier, op, args).result(timeout=self.timeout))
+            except FutureTimeout:
+                print(f"[SAM][Pool] worker {i} {tier}.{op} timed out after {self.timeout:.0f}s, skipped")
+        return results
+
+    def forget(self, affinity: str):
+        """会话被回收时释放其亲和绑定。"""
+        with self._lock:
+            for tier in self.tier_names:
+                idx = self._affinity.pop(f"{tier}:{affinity}", None)
+                if idx is not None:
+                    self._assigned[idx] -= 1
+
+    def describe(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "threads_per_worker": self.threads,
+                "alive": [p.is_alive() for p in self._procs],
+                "inflight": list(self._inflight),
+                "calls": list(self._calls),
+                "sessions": list(self._assigned),
+            }
+
+    def close(self):
+        self._closed = True
+        for q in self._requests:
+            q.put(None)
+        for p in self._procs:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+
+    # ---------------- 内部辅助 -----------------
+    def _route(self, tier: str, affinity: Optional[str]) -> int:
+        key = f"{tier}:{affinity}" if affinity else None
+        with self._lock:
+            if key is not None and key in self._affinity:
+                idx = self._affinity[key]
+                if self._procs[idx].is_alive():
+                    self._affinity.move_to_end(key)
+                    return idx
+                self._affinity.pop(key)
+                self._assigned[idx] -= 1
+            alive = [i for i, p in enumerate(self._procs) if p.is_alive()] or list(range(self.workers))
+            idx = min(alive, key=lambda i: (self._assigned[i], self._inflight[i]))
+            if key is not None:
+                self._affinity[key] = idx
+                self._assigned[idx] += 1
+                while len(self._affinity) > _MAX_AFFINITY:
+                    _, old = self._affinity.popitem(last=False)
+                    self._assigned[old] -= 1
+            return idx
+
+    def _submit(self, index: int, tier: str, op: str, args: tuple) -> Future:
+        fut: Future = Future()
+        with self._lock:
+            req_id = next(self._ids)
+            self._pending[req_id] = (index, fut)
+            self._inflight[index] += 1
+            self._calls[index] += 1
+        self._requests[index].put((req_id, tier, op, args))
+        return fut
+
+    def _await_workers(self):
+        ready = 0
+        # worker 并行导入 torch 并构建模型：核数少于 worker 数时启动时间近似线性增长，按超售比例放宽
+        oversubscribed = max(1.0, self.workers * self.threads / (os.cpu_count() or 1))
+        deadline = time.perf_counter() + self.timeout * oversubscribed
+        while ready < self.workers:
+            try:
+                _, index, ok, result = self._responses.get(timeout=1.0)
+            except queue.Empty:
+                dead = [i for i, p in enumerate(self._procs) if not p.is_alive()]
+                if dead or time.perf_counter() > deadline:
+                    self.close()
+                    reason = f"worker {dead[0]} exited during startup" if dead else "did not start in time"
+                    raise RuntimeError(f"inference workers failed: {reason}")
+                continue
+            if not ok:
+                self.close()
+                raise RuntimeError(f"inference worker {index}: {result}")
+            ready += 1
+
+    def _dispatch(self):
+        while not self._closed:
+            try:
+                req_id, index, ok, result = self._responses.get(timeout=1.0)
+            except queue.Empty:
+                self._fail_dead_workers()
+                continue
+            except Exception as e:
+                print(f"[SAM][Pool] dispatch error: {e}")
+                continue
+            with self._lock:
+                entry = self._pending.pop(req_id, None)
+                self._inflight[index] -= 1
+            if entry is None:
+                continue
+            if ok:
+                entry[1].set_result(result)
+            else:
+                entry[1].set_exception(RuntimeError(result))
+
+    def _fail_dead_workers(self):
+        with self._lock:
+            dead = {i for i, p in enumerate(self._procs) if not p.is_alive()}
+            if not dead:
+                return
+            lost = [(rid, fut) for rid, (i, fut) in self._pending.items() if i in dead]
+            for rid, _ in lost:
+                index, _ = self._pending.pop(rid)
+                self._inflight[index] -= 1
+        for _, fut in lost:
+            fut.set_exception(RuntimeError("inference worker exited"))
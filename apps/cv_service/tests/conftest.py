@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# 让测试可以直接 import app.*（在 apps/cv_service 下运行 pytest）
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
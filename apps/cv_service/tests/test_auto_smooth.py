@@ -0,0 +1,43 @@
+"""
+整图自动分割平滑后的面积 / 外接框与登记的掩码一致，平滑后面积不足的掩码被丢弃。
+"""
+import numpy as np
+
+from app.services.sam_engine import SamEngine, Session
+
+
+class _FakeTier:
+    name, batched = "preview", False
+
+    def __init__(self, masks):
+        self.masks = masks
+
+    def decode(self, embedding, pc, pl, bx, mask_input, multimask, affinity=None):
+        k = len(self.masks)
+        return self.masks, np.full(k, 0.99, np.float32), np.full((k, 256, 256), 10.0, np.float32)
+
+
+def _with_tail(h, w, x0, y0, side, tail):
+    m = np.zeros((h, w), bool)
+    m[y0:y0 + side, x0:x0 + side] = True
+    m[y0 + side // 2, x0 + side:x0 + side + tail] = True  # 1px 细尾巴，开运算会去掉
+    return m
+
+
+def test_auto_masks_recompute_area_and_bbox_after_smoothing(tmp_path):
+    h, w = 300, 400
+    small = _with_tail(h, w, 20, 20, 40, 200)    # 1600 + 200：平滑前过 min_area，平滑后不过
+    big = _with_tail(h, w, 100, 150, 60, 150)    # 3600 + 150
+    engine = SamEngine.__new__(SamEngine)
+    engine.preview = _FakeTier(np.stack([small, big]))
+    engine.smooth_kernel, engine.mask_hole_area, engine.mask_min_region = 3, 32, 32
+    sess = Session(id="t", image_bgr=np.zeros((h, w, 3), np.uint8), h=h, w=w, tmp_dir=tmp_path,
+                   embedding=object(), image_name="t.png")
+
+    out = engine._auto_masks(sess, 1, 32, 0.5, 0.5, 0.7, 1700, 0.9, 64, True)
+    assert len(out) == 1
+    m = out[0]
+    full = m.full(h, w)
+    assert m.area == int(full.sum()) == 3600
+    assert m.bbox == (100, 150, 160, 210)
+    assert m.crop.shape == (60, 60)
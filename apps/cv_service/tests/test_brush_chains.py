@@ -0,0 +1,32 @@
+"""
+同一基础掩码上的两条笔刷链各自发布头部掩码，互不覆盖。
+"""
+import numpy as np
+
+from app.services.brush import BrushSample
+from app.services.mask_store import MaskRecord
+from app.services.sam_engine import SamEngine, Session
+
+
+def _engine() -> SamEngine:
+    # 只用到笔刷相关的参数，不加载模型
+    engine = SamEngine.__new__(SamEngine)
+    engine.max_brushes, engine.brush_undo, engine.brush_join_gap = 8, 50, 3.0
+    return engine
+
+
+def test_two_chains_from_same_base_do_not_collide(tmp_path):
+    engine = _engine()
+    img = np.zeros((600, 600, 3), np.uint8)
+    sess = Session(id="t", image_bgr=img, h=600, w=600, tmp_dir=tmp_path, embedding=None, image_name="t.png")
+    sess.masks.register(np.zeros((600, 600), np.uint8), MaskRecord(mask_id="B", kind="candidate"))
+
+    s1, r1 = engine.brush_apply(sess, "B", [BrushSample(x=100, y=100, radius=5, value=1)])
+    s2, r2 = engine.brush_apply(sess, "B", [BrushSample(x=500, y=500, radius=5, value=1)])
+    assert r1 is not None and r2 is not None
+    assert s1.head_id != s2.head_id
+
+    m1, m2 = sess.masks.mask(s1.head_id), sess.masks.mask(s2.head_id)
+    assert m1[100, 100] == 1 and m1[500, 500] == 0
+    assert m2[100, 100] == 0 and m2[500, 500] == 1
+    assert sess.brushes[s1.head_id] is s1 and len(s1.undo) == 1
@@ -0,0 +1,73 @@
+"""
+SAM_ZOOM=0 时 JPEG 会按 max_side 缩小解码；请求 zoom=true 时放大裁剪必须来自全分辨率源图，
+而不是缩小解码结果的上采样。
+"""
+import cv2
+import numpy as np
+
+from app.services.image_io import decode_image
+from app.services.sam_engine import Session
+
+
+def _detailed_jpeg(w=2400, h=1800) -> bytes:
+    rng = np.random.default_rng(0)
+    img = np.full((h, w, 3), 245, np.uint8)
+    for _ in range(400):  # 细铅笔线：1px 宽，缩小解码后会被抹掉
+        p0 = tuple(int(v) for v in rng.integers(0, (w, h)))
+        p1 = tuple(int(v) for v in rng.integers(0, (w, h)))
+        cv2.line(img, p0, p1, tuple(int(c) for c in rng.integers(0, 120, 3)), 1)
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    assert ok
+    return buf.tobytes()
+
+
+def test_zoom_crop_matches_full_resolution_decode(tmp_path):
+    data = _detailed_jpeg()
+    # SamEngine._decode_image 在 SAM_ZOOM=0 时用 reduce=True
+    decoded = decode_image(data=data, max_side=512, reduce=True)
+    assert decoded.scale_denom > 1
+
+    source_bgr, source_bytes = decoded.zoom_source()
+    assert source_bgr is None  # 缩小解码结果不能当作源图
+    h, w = decoded.image.shape[:2]
+    sess = Session(id="t", image_bgr=decoded.image, h=h, w=w, tmp_dir=tmp_path, embedding=None,
+                   image_name="t.jpg", source_bgr=source_bgr, source_bytes=source_bytes)
+
+    full = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    source = sess.zoom_source()
+    assert source.shape == full.shape
+
+    x0, y0, x1, y1 = 800, 600, 1312, 1112
+    assert np.array_equal(source[y0:y1, x0:x1], full[y0:y1, x0:x1])
+    # 旧行为：缩小解码图上采样回源图尺寸，细线细节明显不同
+    upsampled = cv2.resize(decoded.source, (full.shape[1], full.shape[0]), interpolation=cv2.INTER_LINEAR)
+    assert np.abs(upsampled[y0:y1, x0:x1].astype(int) - full[y0:y1, x0:x1]).mean() > 1.0
+
+
+def test_full_decode_keeps_source_array():
+    data = _detailed_jpeg(1200, 900)
+    # SAM_ZOOM=1：全尺寸解码，直接保留缩放前的图像，不再保留编码字节
+    decoded = decode_image(data=data, max_side=512, reduce=False)
+    source_bgr, source_bytes = decoded.zoom_source()
+    assert source_bytes is None
+    assert source_bgr is not None and source_bgr.shape[:2] == (900, 1200)
+
+
+def test_resized_session_keeps_only_encoded_bytes_until_zoom(tmp_path):
+    img = cv2.imdecode(np.frombuffer(_detailed_jpeg(1200, 900), np.uint8), cv2.IMREAD_COLOR)
+    ok, buf = cv2.imencode(".png", img)
+    assert ok
+    # SAM_ZOOM=0：缩放后的会话不常驻全尺寸 BGR，只留编码字节
+    decoded = decode_image(data=buf.tobytes(), max_side=512, reduce=True)
+    source_bgr, source_bytes = decoded.zoom_source(keep_decoded=False)
+    assert source_bgr is None and source_bytes is not None
+    h, w = decoded.image.shape[:2]
+    sess = Session(id="t", image_bgr=decoded.image, h=h, w=w, tmp_dir=tmp_path, embedding=None,
+                   image_name="t.png", source_bgr=source_bgr, source_bytes=source_bytes)
+    assert np.array_equal(sess.zoom_source(), img)
+    assert sess.source_bytes is None  # 解码后释放编码字节
+
+
+def test_unscaled_image_keeps_nothing_extra():
+    decoded = decode_image(data=_detailed_jpeg(400, 300), max_side=512, reduce=True)
+    assert decoded.zoom_source(keep_decoded=False) == (None, None)